@@ -0,0 +1,324 @@
+"""Benchmark throughput and memory use of land balancing
+
+Generates synthetic databases of configurable size, in the style of
+`tests/conftest.py`, and measures for `add_samples_for_all_acts` and
+`create_presamples`, at several iteration counts:
+
+- activities per second and samples per second
+- peak resident set size (RSS) of the process, after sampling and overall,
+  and of its largest worker process with `--processes`
+- number of SQLite write statements
+
+Each case is run in its own process, so that peak RSS is that of the case
+only. Peak RSS of worker processes is that of the largest worker, not their
+total: workers run at the same time, so total memory use of a parallel run
+can be up to the peak RSS of the case plus `--processes` times that of the
+largest worker. Brightway projects are created in a temporary directory, unless
+`--directory` is given.
+
+Usage:
+
+    python benchmarks/benchmark_land_balancer.py --activities 1000 --iterations 100 1000
+    python benchmarks/benchmark_land_balancer.py --engine numpy --batch --output results.json
+"""
+import argparse
+import concurrent.futures
+import hashlib
+import json
+import multiprocessing
+import os
+import re
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+
+# Benchmark the working tree, even if the package is not installed
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows
+    resource = None
+
+BIOSPHERE = 'bench_biosphere'
+DATABASE = 'bench_db'
+STRATEGIES = ('default', 'inverse', 'set_static', 'skip')
+WRITE_STATEMENT = re.compile(r"\s*(INSERT|UPDATE|DELETE|REPLACE)\b", re.IGNORECASE)
+
+
+def _uncertainty(amount, uncertainty_type):
+    """Return uncertainty fields of an exchange of `amount`"""
+    import numpy as np
+    if uncertainty_type == 2:
+        return {'uncertainty type': 2, 'loc': np.log(amount), 'scale': 0.1}
+    if uncertainty_type == 3:
+        return {'uncertainty type': 3, 'loc': amount, 'scale': 0.1 * amount}
+    if uncertainty_type == 4:
+        return {'uncertainty type': 4, 'minimum': 0.5 * amount, 'maximum': 1.5 * amount}
+    if uncertainty_type == 5:
+        return {'uncertainty type': 5, 'loc': amount, 'minimum': 0.5 * amount, 'maximum': 1.5 * amount}
+    raise ValueError("Uncertainty type {} not supported in benchmarks".format(uncertainty_type))
+
+
+def synthetic_data(activities, exchanges_per_activity, strategy_mix, uncertainty_types, seed=0):
+    """Return biosphere and database data of a synthetic database
+
+    Each activity has a production exchange, a technosphere exchange and
+    `exchanges_per_activity` land exchanges (at least two), half of them
+    land states prior to transformation. Uncertainty of land exchanges
+    depends on the strategy the activity should have.
+
+    Parameters:
+    -----------
+       activities: int
+           Number of activities
+       exchanges_per_activity: int
+           Number of land exchanges of each activity
+       strategy_mix: dict
+           Fraction of activities of each strategy, e.g. {'default': 0.7, 'skip': 0.3}
+       uncertainty_types: list of int
+           Uncertainty types of uncertain land exchanges, drawn at random
+       seed: int, default=0
+           Seed of the random choices
+    """
+    import numpy as np
+    rs = np.random.RandomState(seed)
+    exchanges_per_activity = max(exchanges_per_activity, 2)
+    n_in = exchanges_per_activity // 2
+    n_out = exchanges_per_activity - n_in
+    biosphere = {}
+    for i in range(max(n_in, n_out)):
+        for prefix in ('from', 'to'):
+            name = 'Transformation, {} {}'.format(prefix, i)
+            biosphere[(BIOSPHERE, name)] = {
+                'name': name, 'categories': ('natural resource', 'land'),
+                'unit': 'square meter', 'exchanges': [], 'type': 'natural resource',
+            }
+
+    strategies = list(strategy_mix)
+    weights = np.array([strategy_mix[strategy] for strategy in strategies], dtype=float)
+    choices = rs.choice(len(strategies), size=activities, p=weights / weights.sum())
+    database = {}
+    for index, choice in enumerate(choices):
+        strategy = strategies[choice]
+        code = 'act_{}'.format(index)
+        land = [('from', i) for i in range(n_in)] + [('to', i) for i in range(n_out)]
+        amounts = rs.uniform(0.5, 2, len(land))
+        if strategy == 'default':
+            uncertain = np.ones(len(land), dtype=bool)
+        elif strategy == 'inverse':
+            uncertain = np.array([prefix == 'to' for prefix, _ in land])
+        elif strategy == 'set_static':
+            uncertain = np.arange(len(land)) == 0
+        else:
+            uncertain = np.zeros(len(land), dtype=bool)
+        exchanges = [
+            {'input': (DATABASE, code), 'amount': 1.0, 'type': 'production', 'uncertainty type': 0},
+            {'input': (DATABASE, 'act_{}'.format((index + 1) % activities)), 'amount': 0.1,
+             'type': 'technosphere', 'uncertainty type': 0},
+        ]
+        for (prefix, i), amount, is_uncertain in zip(land, amounts, uncertain):
+            exchange = {
+                'input': (BIOSPHERE, 'Transformation, {} {}'.format(prefix, i)),
+                'amount': float(amount), 'type': 'biosphere', 'uncertainty type': 0,
+            }
+            if is_uncertain:
+                exchange.update(_uncertainty(float(amount), int(rs.choice(uncertainty_types))))
+            exchanges.append(exchange)
+        database[(DATABASE, code)] = {
+            'name': code, 'unit': 'kilogram', 'location': 'GLO',
+            'reference product': 'product', 'exchanges': exchanges,
+        }
+    return biosphere, database
+
+
+def create_synthetic_project(project, **kwargs):
+    """Create a project with a synthetic database, see `synthetic_data`"""
+    from brightway2 import Database, projects
+    projects.set_current(project)
+    biosphere, database = synthetic_data(**kwargs)
+    Database(BIOSPHERE).write(biosphere)
+    Database(DATABASE).write(database)
+
+
+@contextmanager
+def count_writes(counter):
+    """Count SQLite write statements executed in the block, in `counter['writes']`"""
+    from bw2data.backends.peewee import sqlite3_lci_db
+    from bw2data.parameters import ActivityParameter
+    databases = {id(db): db for db in (sqlite3_lci_db.db, ActivityParameter._meta.database)}
+
+    def counting(execute_sql):
+        def execute(sql, *args, **kwargs):
+            if WRITE_STATEMENT.match(sql):
+                counter['writes'] += 1
+            return execute_sql(sql, *args, **kwargs)
+        return execute
+
+    for db in databases.values():
+        db.execute_sql = counting(db.execute_sql)
+    try:
+        yield counter
+    finally:
+        for db in databases.values():
+            del db.execute_sql
+
+
+def peak_rss(who='self'):
+    """Return peak resident set size in MB, or None
+
+    Peak of the current process if `who` is 'self', or of its largest
+    terminated child process (e.g. worker processes) if 'children'.
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(
+        resource.RUSAGE_SELF if who == 'self' else resource.RUSAGE_CHILDREN).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return peak / (2 ** 20 if sys.platform == 'darwin' else 2 ** 10)
+
+
+def run_case(case):
+    """Balance the synthetic database for one case and return measurements"""
+    import contextlib
+    import io
+    from brightway2 import projects
+    from bw2landbalancer import DatabaseLandBalancer
+
+    projects.set_current(case['project'])
+    counter = {'writes': 0}
+    # Balancers print progress, which would be mixed with results
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output), contextlib.redirect_stderr(output):
+        with count_writes(counter):
+            dlb = DatabaseLandBalancer(
+                DATABASE, biosphere=BIOSPHERE, engine=case['engine'], dtype=case['dtype'],
+                cache_classification=False, prefetch=case['prefetch'],
+            )
+            start = time.perf_counter()
+            dlb.add_samples_for_all_acts(
+                case['iterations'], batch=case['batch'], processes=case['processes'], seed=42
+            )
+            sampling_time = time.perf_counter() - start
+            sampling_peak_rss = peak_rss()
+            workers_peak_rss = peak_rss('children') if case['processes'] else None
+            rows = len(dlb._store)
+            sampling_writes = counter['writes']
+            with tempfile.TemporaryDirectory() as dirpath:
+                start = time.perf_counter()
+                dlb.create_presamples(dirpath=dirpath)
+                writing_time = time.perf_counter() - start
+    return dict(
+        case,
+        rows=rows,
+        sampling_time=sampling_time,
+        activities_per_second=case['activities'] / sampling_time,
+        samples_per_second=rows * case['iterations'] / sampling_time,
+        presamples_time=writing_time,
+        sampling_peak_rss_mb=sampling_peak_rss,
+        workers_peak_rss_mb=workers_peak_rss,
+        peak_rss_mb=peak_rss(),
+        sampling_writes=sampling_writes,
+        presamples_writes=counter['writes'] - sampling_writes,
+        timing=dlb.timing_report.as_dict(),
+    )
+
+
+def run_isolated(case):
+    """Run a case in a new process, so that peak RSS only covers the case
+
+    Unlike those of `multiprocessing.Pool`, processes of the executor are
+    not daemonic, and can start the worker processes of the balancer.
+    """
+    context = multiprocessing.get_context('spawn')
+    with concurrent.futures.ProcessPoolExecutor(1, mp_context=context) as executor:
+        return executor.submit(run_case, case).result()
+
+
+def format_results(results):
+    """Return results as a text table"""
+    columns = [
+        ('iterations', '{}'), ('rows', '{}'), ('sampling_time', '{:.2f}'),
+        ('activities_per_second', '{:.1f}'), ('samples_per_second', '{:.3g}'),
+        ('presamples_time', '{:.2f}'), ('sampling_peak_rss_mb', '{:.0f}'),
+        ('workers_peak_rss_mb', '{:.0f}'), ('peak_rss_mb', '{:.0f}'),
+        ('sampling_writes', '{}'), ('presamples_writes', '{}'),
+    ]
+    rows = [[label for label, _ in columns]]
+    for result in results:
+        rows.append([
+            'n/a' if result[label] is None else template.format(result[label])
+            for label, template in columns
+        ])
+    widths = [max(len(row[i]) for row in rows) for i in range(len(columns))]
+    return "\n".join(
+        "  ".join(value.rjust(width) for value, width in zip(row, widths)) for row in rows
+    )
+
+
+def parse_strategy_mix(value):
+    """Parse a mix like 'default=0.7,inverse=0.1,set_static=0.1,skip=0.1'"""
+    mix = {}
+    for item in value.split(','):
+        strategy, _, fraction = item.partition('=')
+        if strategy not in STRATEGIES:
+            raise argparse.ArgumentTypeError("Unknown strategy {}".format(strategy))
+        mix[strategy] = float(fraction)
+    return mix
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--activities', type=int, default=200)
+    parser.add_argument('--exchanges', type=int, default=4, help="Land exchanges per activity")
+    parser.add_argument('--mix', type=parse_strategy_mix,
+                        default='default=0.7,inverse=0.1,set_static=0.1,skip=0.1',
+                        help="Fraction of activities of each strategy")
+    parser.add_argument('--uncertainty-types', type=int, nargs='+', default=[2, 3, 4, 5])
+    parser.add_argument('--iterations', type=int, nargs='+', default=[100, 1000])
+    parser.add_argument('--engine', choices=['presamples', 'numpy'], default='numpy')
+    parser.add_argument('--batch', action='store_true')
+    parser.add_argument('--processes', type=int, default=None,
+                        help="Worker processes. Database writes of workers are not counted, "
+                             "their peak RSS is reported separately.")
+    parser.add_argument('--dtype', default='float64')
+    parser.add_argument('--prefetch', type=int, default=16,
+                        help="Activities read ahead by background threads, 0 to disable")
+    parser.add_argument('--directory', help="Brightway directory. Temporary if not given.")
+    parser.add_argument('--output', help="Also write results to this JSON file")
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        # Must be set before bw2data is imported, also in case processes
+        os.environ['BRIGHTWAY2_DIR'] = args.directory or temp_dir
+        config = dict(
+            activities=args.activities, exchanges_per_activity=args.exchanges,
+            strategy_mix=args.mix, uncertainty_types=args.uncertainty_types,
+        )
+        project = "bw2landbalancer_benchmark_{}".format(
+            hashlib.md5(json.dumps(config, sort_keys=True).encode('utf-8')).hexdigest()[:8])
+        print("Creating synthetic database with {} activities".format(args.activities))
+        with multiprocessing.get_context('spawn').Pool(1) as pool:
+            pool.apply(create_synthetic_project, (project,), config)
+
+        results = []
+        for iterations in args.iterations:
+            case = dict(
+                project=project, activities=args.activities, exchanges=args.exchanges,
+                iterations=iterations, engine=args.engine, batch=args.batch,
+                processes=args.processes, dtype=args.dtype, prefetch=args.prefetch,
+            )
+            results.append(run_isolated(case))
+            print(format_results(results[-1:]).splitlines()[-1] if len(results) > 1
+                  else format_results(results))
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+    return results
+
+
+if __name__ == '__main__':
+    main()
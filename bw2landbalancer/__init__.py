@@ -1,6 +1,7 @@
 __all__ = [
     'ActivityLandBalancer',
     'DatabaseLandBalancer',
+    'BalancingPlan',
 ]
 
 
@@ -8,3 +9,4 @@ __version__ = (0, 0, 1)
 
 from .database_land_balancer import DatabaseLandBalancer
 from .activity_land_balancer import ActivityLandBalancer
+from .balancing_plan import BalancingPlan
@@ -1,9 +1,22 @@
 from brightway2 import *
+from bw2data.backends.peewee import ExchangeDataset, sqlite3_lci_db
+from bw2data.backends.peewee.utils import dict_as_activitydataset
+from bw2data.parameters import ActivityParameter, ParameterizedExchange
 import warnings
 from .utils import ParameterNameGenerator
+from .parameter_workspace import parameter_workspace
 from presamples.models.parameterized import ParameterizedBrightwayModel as PBM
 from numpy import inf
+import numpy as np
 import copy
+from .array_balancer import (
+    LAND_IN, LAND_OUT, exchanges_to_params, draw_samples, identify_strategies, get_static_ratios,
+    rebalance_samples
+)
+
+# Exchanges per bulk statement, each uses up to 3 SQL variables (SQLite
+# versions before 3.32 allow at most 999 per statement)
+BULK_UPDATE_SIZE = 250
 
 class ActivityLandBalancer():
     """Balances land exchange samples at the activity level
@@ -14,121 +27,211 @@ class ActivityLandBalancer():
     Use Method `generate_samples` to actually generate samples. This is usually
     invoked via a DatabaseLandBalancer instance.
 
+    Two engines are available, and the one used is inherited from the
+    DatabaseLandBalancer. The "presamples" engine expresses the balance as
+    parameters and formulas and evaluates them with a presamples
+    ParameterizedBrightwayModel. The "numpy" engine draws the land exchange
+    samples directly and rescales them with array arithmetic. It gives samples
+    with the same distribution, is much faster and does not need to move
+    formulas around in the database.
+
+    If the DatabaseLandBalancer is read-only, land exchanges are read once
+    and copied to plain dictionaries, and the database is never written to.
+    This requires the "numpy" engine.
+
+    With the "numpy" engine, land exchanges can also be passed as a prebuilt
+    list of exchange dictionaries, e.g. loaded for all activities at once by
+    the DatabaseLandBalancer, in which case they are not read from the
+    database. The "presamples" engine always reads them, as it needs to
+    modify them.
+
     Parameters:
     ------------
        act_key: tuple
            Key of the activity.
        database_land_balancer: DatabaseLandBalancer
            Instance of a DatabaseLandBalancer
+       land_exchanges: list, optional
+           Land exchange dictionaries of the activity, empty if it has none.
+           Read from the database if None.
+       activity: Activity, optional
+           The activity, if already read from the database
+       exchanges: list, optional
+           All exchanges of the activity, if already read from the database.
+           Only used by the "presamples" engine.
 
     """
 
-    def __init__(self, act_key, database_land_balancer):
-        self.act = get_activity(act_key)
+    def __init__(self, act_key, database_land_balancer, land_exchanges=None, activity=None,
+                 exchanges=None):
+        self.act = get_activity(act_key) if activity is None else activity
         for keys in [
             'land_in_keys', 'land_out_keys',
-            'all_land_keys', 'group'
+            'all_land_keys', 'land_types', 'group', 'engine', 'read_only', 'instrumentation'
         ]:
             setattr(self, keys, getattr(database_land_balancer, keys))
-        land_exchanges = [
-            exc for exc in self.act.exchanges()
-            if exc.input.key in self.all_land_keys
-        ]
+        stage = self.instrumentation.stage
+        if land_exchanges is None or self.engine == 'presamples':
+            with stage('load_exchanges'):
+                if exchanges is None:
+                    exchanges = list(self.act.exchanges())
+                land_exchanges = [
+                    exc for exc in exchanges
+                    if exc['input'] in self.all_land_keys
+                ]
+                if self.read_only:
+                    # Work with in-memory copies, detached from the database
+                    land_exchanges = [copy.deepcopy(exc.as_dict()) for exc in land_exchanges]
         if not land_exchanges:
             self.strategy = "skip"
             self.land_exchanges = land_exchanges
         else:
-            self._move_exchange_formulas_to_temp()
-            self.land_exchanges = [
-                exc for exc in self.act.exchanges()
-                if exc.input.key in self.all_land_keys
-            ]
-            self.land_exchange_input_keys = [exc.input.key for exc in self.land_exchanges]
+            if self.engine == 'presamples':
+                # Land exchanges are among `exchanges`, and are updated in place
+                with stage('move_formulas'), self._write_transaction():
+                    self._move_exchange_formulas_to_temp(exchanges)
+            self.land_exchanges = land_exchanges
+            self.land_exchange_input_keys = [exc['input'] for exc in self.land_exchanges]
             self.land_exchange_types = [self._get_type(exc) for exc in self.land_exchanges]
             namer = ParameterNameGenerator()
             self.land_exchange_param_names = [namer['land_param'] for _ in range(len(self.land_exchanges))]
             self.activity_params = []
 
-    def generate_samples(self, iterations=1000):
+    def generate_samples(self, iterations=1000, random_state=None):
         """Calls other methods in order and adds parameters to group
 
         Parameters:
         ------------
            iterations: int
                Number of iterations in sample.
+           random_state: numpy RandomState, optional
+               Random number generator used by the "numpy" engine. The
+               "presamples" engine always uses unseeded generators.
         """
+        if self.engine == 'numpy':
+            return self._generate_samples_numpy(iterations, random_state)
+
+        stage = self.instrumentation.stage
+        try:
+            define_parameters = not self._processed()
+            if define_parameters:
+                self.parameters = []
+                self._identify_strategy()
+            if self.strategy == 'skip':
+                self.matrix_data = []
+            else:
+                self.matrix_data = self._calculate_matrix_data(iterations, define_parameters)
+        finally:
+            # Also restores the database if balancing fails or is interrupted,
+            # except if the process is killed, see `DatabaseLandBalancer.repair_activities`
+            if self.land_exchanges:
+                with stage('restore', self.strategy), self._write_transaction():
+                    self.activity_params = []
+                    self._restore_activity_parameters()
+                    self._restore_exchange_formulas()
+        return self.matrix_data
+
+    def _calculate_matrix_data(self, iterations, define_parameters=False):
+        """Calculate balanced matrix data with presamples
 
-        if not self._processed():
-            self.parameters = []
+        Parameters only live in a scratch workspace, private to this call
+        and discarded once samples are calculated, so that parameter groups
+        and names never conflict with other balancers, workers or processes.
+
+        All database writes (balancing parameters if `define_parameters`,
+        formulas and recalculated amounts) are done in a single transaction,
+        and the write lock is released before presamples evaluates the
+        parameters, so that other processes can write in the meantime.
+        """
+        stage = self.instrumentation.stage
+        # Stages within a transaction do not include its commit
+        with parameter_workspace():
+            with self._write_transaction():
+                if define_parameters:
+                    with stage('define_parameters', self.strategy):
+                        self._define_balancing_parameters()
+                with stage('move_formulas', self.strategy):
+                    self._move_land_formulas_to_exchange()
+                    self._move_activity_parameters_to_temp()
+                with stage('recalculate', self.strategy):
+                    parameters.new_activity_parameters(self.activity_params, self.group)
+                    self._add_exchanges_to_group()
+                    ActivityParameter.recalculate(self.group)
+            with stage('pbm_load', self.strategy):
+                pbm = PBM(self.group)
+                pbm.load_parameter_data()
+            with stage('calculate_stochastic', self.strategy):
+                pbm.calculate_stochastic(iterations, update_amounts=True)
+            with stage('calculate_matrix_presamples', self.strategy):
+                pbm.calculate_matrix_presamples()
+        return pbm.matrix_data
+
+    def _generate_samples_numpy(self, iterations, random_state=None):
+        """Generate balanced samples with array arithmetic
+
+        Land exchange samples are drawn directly, and the variable
+        exchanges are then rescaled for all iterations at once. The
+        returned matrix data has the same format as the one generated
+        via presamples.
+        """
+        if getattr(self, 'strategy', None) is None:
             self._identify_strategy()
-            self._define_balancing_parameters()
         if self.strategy == 'skip':
             return []
 
-        self._move_land_formulas_to_exchange()
-        self._move_activity_parameters_to_temp()
-        parameters.new_activity_parameters(self.activity_params, self.group)
-        parameters.add_exchanges_to_group(self.group, self.act)
-        parameters.recalculate()
-        pbm = PBM(self.group)
-        pbm.load_parameter_data()
-        pbm.calculate_stochastic(iterations, update_amounts=True)
-        pbm.calculate_matrix_presamples()
-        self.matrix_data = pbm.matrix_data
-        parameters.remove_from_group(self.group, self.act)
-        # This adds activity parameters that are actually not wanted. Remove them.
-        self.act['parameters'] = []
-        self.act.save()
-        self.activity_params = []
-        self._restore_activity_parameters()
-        self._restore_exchange_formulas()
+        amounts, in_mask, out_mask, uncertain_mask = self._get_land_arrays()
+        output_key = self.act.key
+        if self.strategy == 'set_static':
+            self.static_ratio = 'Not calculated'
+            self.static_balance = 'Not calculated'
+            # Only the variable exchange is overridden, with its static value
+            index = int(np.flatnonzero(uncertain_mask)[0])
+            samples = np.full((1, iterations), amounts[index])
+            indices = [(self.land_exchange_input_keys[index], output_key)]
+        else:
+            ratios, balances = get_static_ratios(
+                amounts, in_mask, out_mask, np.array([self.strategy]), starts=np.array([0])
+            )
+            self.static_ratio, self.static_balance = ratios[0], balances[0]
+            with self.instrumentation.stage('draw', self.strategy):
+                samples = draw_samples(
+                    exchanges_to_params(self.land_exchanges), iterations, random_state
+                )
+            with self.instrumentation.stage('rebalance', self.strategy):
+                rebalance_samples(
+                    samples, in_mask, out_mask, uncertain_mask,
+                    self.strategy, self.static_ratio
+                )
+            indices = [(key, output_key) for key in self.land_exchange_input_keys]
+        self.matrix_data = [(samples, indices, 'biosphere')]
         return self.matrix_data
 
     def _identify_strategy(self):
-        """Identify appropriate strategy to use for activity"""
-
-        land_out = [
-            exc for i, exc in enumerate(self.land_exchanges)
-            if self.land_exchange_types[i] == 'land_out'
-        ]
-        land_in = [
-            exc for i, exc in enumerate(self.land_exchanges)
-            if self.land_exchange_types[i] == 'land_in'
-        ]
-
-        # Identify non-zero exchanges
-        non_zero_in = [exc for exc in land_in if exc['amount'] != 0]
-        non_zero_out = [exc for exc in land_out if exc['amount'] != 0]
+        """Identify appropriate strategy to use for activity
 
-        # If there isn't at least one non-zero input land exchange and one non-zero
-        # output land exchange, skip
-        if any([not non_zero_in, not non_zero_out]):
-            self.strategy = "skip"
-            return
-
-        # Identify land exchanges with uncertainty
-        exc_with_uncertainty_inputs = [exc for exc in land_in if exc.get('uncertainty type', 0) != 0]
-        exc_with_uncertainty_outputs = [exc for exc in land_out if exc.get('uncertainty type', 0) != 0]
-
-        # If there aren't any uncertain land exchanges, skip
-        if len(exc_with_uncertainty_inputs + exc_with_uncertainty_outputs) == 0:
-            self.strategy = "skip"
-        # If there is only one uncertain land exchange, set_static
-        elif len(exc_with_uncertainty_inputs + exc_with_uncertainty_outputs) == 1:
-            self.strategy = "set_static"
-        # If there are no uncertain inputs, inverse strategy (i.e. rescale outputs)
-        elif len(exc_with_uncertainty_inputs) == 0:
-            self.strategy = "inverse"
-        # Apply default strategy otherwise (i.e. rescale inputs)
-        else:
-            self.strategy = "default"
+        See `array_balancer.identify_strategies` for the rules used.
+        """
+        amounts, in_mask, out_mask, uncertain_mask = self._get_land_arrays()
+        self.strategy = str(identify_strategies(
+            amounts, in_mask, out_mask, uncertain_mask, starts=np.array([0])
+        )[0])
+
+    def _get_land_arrays(self):
+        """Return amounts and in, out and uncertain masks of land exchanges"""
+        in_mask = np.array([t == 'land_in' for t in self.land_exchange_types], dtype=bool)
+        out_mask = np.array([t == 'land_out' for t in self.land_exchange_types], dtype=bool)
+        uncertain_mask = np.array([
+            exc.get('uncertainty type', 0) != 0 for exc in self.land_exchanges
+        ], dtype=bool)
+        amounts = np.array([exc.get('amount', 0) for exc in self.land_exchanges], dtype=float)
+        return amounts, in_mask, out_mask, uncertain_mask
 
     def _define_balancing_parameters(self):
         """Define activity-level and exchange-level parameters for rebalancing
 
         The actual equations used for rebalancing depends on the associated strategy.
         """
-
+        self._check_writable()
         if self.strategy == 'skip':
             return
         if self.strategy == 'default':
@@ -137,6 +240,8 @@ class ActivityLandBalancer():
             self._get_static_data_inverse()
         if self.strategy == 'set_static':
             self._get_static_data_set_static()
+        else:
+            self._save_exchanges(self.land_exchanges)
 
     def _get_static_data_default(self):
         """Define activity-level and exchange-level parameters for default rebalancing
@@ -168,13 +273,11 @@ class ActivityLandBalancer():
                     var_in_terms.append(term)
                     # Add hook to exchange, with scaling
                     exc['formula'] = "{} * scaling".format(param_name)
-                    exc.save()
                 else:
                     # Add term to constant portion of inputs
                     const_in_terms.append(term)
                     # Add hook to exchange, without scaling (constant)
                     exc['formula'] = param_name
-                    exc.save()
             elif land_exchange_type == 'land_out':
                 out_total += exc_amount_value
                 # generate term for ratio equation
@@ -182,7 +285,6 @@ class ActivityLandBalancer():
                 out_terms.append(term)
                 # Add hook to exchange
                 exc['formula'] = param_name
-                exc.save()
                 # Add parameter to activity parameters
                 self.activity_params.append(self.convert_exchange_to_param(exc, param_name))
 
@@ -251,13 +353,11 @@ class ActivityLandBalancer():
                     var_out_terms.append(term)
                     # Add hook to exchange, with scaling
                     exc['formula'] = "{} * scaling".format(param_name)
-                    exc.save()
                 else:
                     # Add term to constant portion of inputs
                     const_out_terms.append(term)
                     # Add hook to exchange, without scaling (constant)
                     exc['formula'] = param_name
-                    exc.save()
             elif land_exchange_type == 'land_in':
                 in_total += exc_amount_value
                 # generate term for ratio equation
@@ -265,7 +365,6 @@ class ActivityLandBalancer():
                 in_terms.append(term)
                 # Add hook to exchange
                 exc['formula'] = param_name
-                exc.save()
                 # Add parameter to activity parameters
                 self.activity_params.append(self.convert_exchange_to_param(exc, param_name))
 
@@ -308,14 +407,14 @@ class ActivityLandBalancer():
         """
         excs = [
             exc for exc in self.act.exchanges()
-            if exc.input.key in self.all_land_keys
+            if exc['input'] in self.all_land_keys
                and exc.get('uncertainty type', 0) != 0
         ]
         if len(excs) != 1:
             raise ValueError("Should only have one variable land exchange for 'set_static' strategy")
         exc = excs[0]
         exc['formula'] = 'cst'
-        exc.save()
+        self._save_exchanges([exc])
         self.static_ratio = 'Not calculated'
         self.static_balance = 'Not calculated'
         self.activity_params.append(self.convert_exchange_to_param(exc, 'cst'))
@@ -359,16 +458,16 @@ class ActivityLandBalancer():
 
     def _get_type(self, exc):
         """Return type of exchange"""
-        input_key = exc.input.key
-        if input_key in self.land_in_keys:
+        land_type = self.land_types.get(exc['input'])
+        if land_type == LAND_IN:
             return 'land_in'
-        elif input_key in self.land_out_keys:
+        elif land_type == LAND_OUT:
             return 'land_out'
         else:
             warnings.warn(
                 "Exchange type not understood for exchange "
                 "between {} and {} ({}), not considered in balance.".format(
-                    exc.input.key, exc.output.key, exc.get('type')
+                    exc['input'], exc['output'], exc.get('type')
                 ))
             return 'skip'
 
@@ -393,7 +492,77 @@ class ActivityLandBalancer():
             return False
         return True
 
-    def _move_exchange_formulas_to_temp(self):
+    def _check_writable(self):
+        """ Raise ValueError if the balancer should not write to the database"""
+        if self.read_only:
+            raise ValueError(
+                "Balancer for {} is read-only and cannot modify the database".format(self.act.key)
+            )
+
+    def _write_transaction(self):
+        """ Return a context manager holding a write lock on the inventory database
+
+        The lock is acquired upfront (`BEGIN IMMEDIATE`). Otherwise, when
+        activities are balanced in several processes, Brightway functions
+        that write while reading can fail with "database is locked" errors
+        instead of waiting for their turn. Parameters are written in a
+        `parameter_workspace`, which needs no lock.
+        """
+        self._check_writable()
+        return sqlite3_lci_db.db.atomic('IMMEDIATE')
+
+    def _save_activity(self):
+        """ Save activity without updating the search index
+
+        The balancer only changes the `parameters` fields of activities,
+        which are not searchable. Skipping the search index also avoids lock
+        conflicts when activities are balanced in several processes.
+        """
+        self._check_writable()
+        databases.set_dirty(self.act['database'])
+        for key, value in dict_as_activitydataset(self.act._data).items():
+            setattr(self.act._document, key, value)
+        self.act._document.save()
+
+    def _save_exchanges(self, exchanges):
+        """ Save exchanges with bulk UPDATE statements
+
+        Same as calling `save` on each exchange, without validation, but
+        with one UPDATE statement per `BULK_UPDATE_SIZE` exchanges instead
+        of one per exchange. Only exchange data is updated: the balancer
+        never changes inputs, outputs or types of exchanges.
+        """
+        self._check_writable()
+        if not exchanges:
+            return
+        databases.set_dirty(self.act['database'])
+        documents = []
+        for exc in exchanges:
+            exc._document.data = exc._data
+            documents.append(exc._document)
+        ExchangeDataset.bulk_update(documents, fields=[ExchangeDataset.data], batch_size=BULK_UPDATE_SIZE)
+
+    def _add_exchanges_to_group(self):
+        """ Store original amounts and add exchanges with formulas to group
+
+        Same as `parameters.add_exchanges_to_group`, with bulk statements
+        instead of one query and save per exchange. Activity parameters
+        must already be defined, so no dummy parameter is needed.
+        """
+        exchanges = [exc for exc in self.act.exchanges() if 'formula' in exc]
+        changed = []
+        for exc in exchanges:
+            if 'original_amount' not in exc:
+                exc['original_amount'] = exc['amount']
+                changed.append(exc)
+        self._save_exchanges(changed)
+        for batch in range(0, len(exchanges), BULK_UPDATE_SIZE):
+            ParameterizedExchange.insert_many([
+                {'exchange': exc._document.id, 'group': self.group, 'formula': exc['formula']}
+                for exc in exchanges[batch:batch + BULK_UPDATE_SIZE]
+            ]).on_conflict_replace().execute()
+
+    def _move_exchange_formulas_to_temp(self, exchanges=None):
         """ Temporarily move existing formulas to avoid conflicts
 
         Existing formulas are moved from `formulas` to `temp_formulas` so they
@@ -402,19 +571,26 @@ class ActivityLandBalancer():
         biosphere exchanges.
 
         Formulas can be restored with the `_restore_exchange_formulas` method.
+        Exchanges are read from the database if `exchanges` is None.
         """
-        for exc in self.act.exchanges():
+        if exchanges is None:
+            exchanges = self.act.exchanges()
+        changed = []
+        for exc in exchanges:
             if 'formula' in exc:
                 exc['temp_formula'] = exc['formula']
                 del exc['formula']
-                exc.save()
+                changed.append(exc)
+        self._save_exchanges(changed)
 
     def _move_land_formulas_to_exchange(self):
         """ Move land balance formulas to formulas field"""
+        changed = []
         for exc in self.act.exchanges():
             if 'land_formula' in exc:
                 exc['formula'] = exc['land_formula']
-                exc.save()
+                changed.append(exc)
+        self._save_exchanges(changed)
 
     def _move_activity_parameters_to_temp(self):
         """ Temporarily move existing activity parameters to avoid conflicts
@@ -426,28 +602,39 @@ class ActivityLandBalancer():
         """
         self.act['parameters_temp'] = copy.copy(self.act.get('parameters'))
         self.act['parameters'] = []
-        self.act.save()
+        self._save_activity()
 
     def _restore_activity_parameters(self):
         """ Restore activity parameters that were temporarily removed
 
-        Should be done once done working with the activity.
+        Should be done once done working with the activity. Does nothing if
+        parameters were not moved.
         """
+        if 'parameters_temp' not in self.act:
+            return
         self.act['parameters'] = self.act.get('parameters_temp')
         del self.act['parameters_temp']
-        self.act.save()
+        self._save_activity()
 
     def _restore_exchange_formulas(self):
         """ Restore exchange formulas that were temporarily removed
 
-        Also moves formulas used for land balancing to 'land_formulas'
+        Also moves formulas used for land balancing to 'land_formulas' and
+        restores original amounts of exchanges that were in the group.
         Should be done once done working with the activity.
         """
+        changed = []
         for exc in self.act.exchanges():
+            if not any(field in exc for field in ('formula', 'temp_formula', 'original_amount')):
+                continue
+            if 'original_amount' in exc:
+                exc['amount'] = exc['original_amount']
+                del exc['original_amount']
             if 'formula' in exc:
                 exc['land_formula'] = copy.copy(exc.get('formula', None))
                 del exc['formula']
             if 'temp_formula' in exc:
                 exc['formula'] = exc.get('temp_formula', None)
                 del exc['temp_formula']
-            exc.save()
+            changed.append(exc)
+        self._save_exchanges(changed)
@@ -0,0 +1,481 @@
+import hashlib
+import numpy as np
+from bw2data.utils import TYPE_DICTIONARY
+from scipy.special import ndtr, ndtri
+from stats_arrays import (
+    UncertaintyBase, UndefinedUncertainty, NoUncertainty, LognormalUncertainty,
+    NormalUncertainty, UniformUncertainty, TriangularUncertainty, uncertainty_choices
+)
+
+LAND_IN = 1
+LAND_OUT = 2
+
+STRATEGIES = np.array(['skip', 'set_static', 'inverse', 'default'])
+
+LAND_EXCHANGE_DTYPE = [
+    ('input', np.uint32),
+    ('output', np.uint32),
+    ('land_type', np.uint8),
+    ('amount', np.float64),
+    ('uncertainty_type', np.uint8),
+    ('loc', np.float64),
+    ('scale', np.float64),
+    ('shape', np.float64),
+    ('minimum', np.float64),
+    ('maximum', np.float64),
+    ('negative', bool),
+]
+
+
+def exchanges_to_params(exchanges):
+    """Return a stats_arrays parameter array for a list of exchanges
+
+    Mirrors how Brightway processes exchanges: exchanges without uncertainty
+    (uncertainty types 0 and 1) are fixed at their `amount`.
+
+    Parameters:
+    ------------
+       exchanges: list
+           Exchanges or exchange dictionaries
+    """
+    dicts = []
+    for exc in exchanges:
+        amount = exc.get('amount', 0)
+        uncertainty_type = exc.get('uncertainty type', 0)
+        param = {
+            'uncertainty_type': uncertainty_type,
+            'loc': amount if uncertainty_type in (0, 1) else exc.get('loc', amount),
+            'negative': bool(exc.get('negative', False)),
+        }
+        for field in ['scale', 'shape', 'minimum', 'maximum']:
+            # Missing values can also be stored as None in exchange dictionaries
+            if exc.get(field) is not None:
+                param[field] = exc[field]
+        dicts.append(param)
+    return UncertaintyBase.from_dicts(*dicts)
+
+
+def land_exchange_table(exchanges, inputs, outputs, land_types):
+    """Return a land exchange table, i.e. a structured array with one row per exchange
+
+    The table holds everything needed to balance samples: integer ids of the
+    exchange input and output, land type (`LAND_IN` or `LAND_OUT`), static
+    amount and stats_arrays uncertainty fields. Exchanges of a same activity
+    should be contiguous.
+
+    Parameters:
+    ------------
+       exchanges: list
+           Exchanges or exchange dictionaries
+       inputs, outputs: sequences of int
+           Integer ids of exchange inputs and outputs
+       land_types: sequence of int
+           Land type of each exchange
+    """
+    table = np.zeros(len(exchanges), dtype=LAND_EXCHANGE_DTYPE)
+    if not exchanges:
+        return table
+    params = exchanges_to_params(exchanges)
+    for field in params.dtype.names:
+        table[field] = params[field]
+    table['input'] = inputs
+    table['output'] = outputs
+    table['land_type'] = land_types
+    table['amount'] = [exc.get('amount', 0) for exc in exchanges]
+    return table
+
+
+def segment_starts(outputs):
+    """Return indices of the first row of each contiguous run of `outputs`"""
+    outputs = np.asarray(outputs)
+    if not len(outputs):
+        return np.zeros(0, dtype=np.intp)
+    return np.flatnonzero(np.r_[True, outputs[1:] != outputs[:-1]])
+
+
+def _segment_sums(values, starts):
+    """Sum rows of `values` within each segment"""
+    return np.add.reduceat(values, starts, axis=0)
+
+
+def identify_strategies(amounts, in_mask, out_mask, uncertain_mask, starts):
+    """Identify appropriate strategy for each segment (activity) of land exchanges
+
+    - "skip" if there isn't at least one non-zero input and one non-zero output
+      land exchange, or if no land exchanges are uncertain
+    - "set_static" if there is only one uncertain land exchange
+    - "inverse" if there are no uncertain inputs (i.e. rescale outputs)
+    - "default" otherwise (i.e. rescale inputs)
+
+    Returns an array of strategy names, one per segment.
+    """
+    if not len(starts):
+        return np.zeros(0, dtype=STRATEGIES.dtype)
+    non_zero = amounts != 0
+    non_zero_in = _segment_sums((in_mask & non_zero).astype(int), starts)
+    non_zero_out = _segment_sums((out_mask & non_zero).astype(int), starts)
+    uncertain_in = _segment_sums((in_mask & uncertain_mask).astype(int), starts)
+    uncertain_out = _segment_sums((out_mask & uncertain_mask).astype(int), starts)
+    uncertain = uncertain_in + uncertain_out
+    choice = np.select(
+        [
+            (non_zero_in == 0) | (non_zero_out == 0) | (uncertain == 0),
+            uncertain == 1,
+            uncertain_in == 0,
+        ],
+        [0, 1, 2],
+        default=3,
+    )
+    return STRATEGIES[choice]
+
+
+def get_static_ratios(amounts, in_mask, out_mask, strategies, starts):
+    """Return static ratios and static balances for each segment
+
+    For the "default" strategy, the ratio is inputs over outputs, and the balance
+    is inputs minus outputs. For the "inverse" strategy, it is outputs over
+    inputs and outputs minus inputs. Other strategies have no ratio (nan).
+    """
+    in_totals = _segment_sums(np.where(in_mask, amounts, 0), starts)
+    out_totals = _segment_sums(np.where(out_mask, amounts, 0), starts)
+    inverse = strategies == 'inverse'
+    numerators = np.where(inverse, out_totals, in_totals)
+    denominators = np.where(inverse, in_totals, out_totals)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ratios = np.where(denominators != 0, numerators / denominators, np.inf)
+    balancing = np.isin(strategies, ['default', 'inverse'])
+    return (
+        np.where(balancing, ratios, np.nan),
+        np.where(balancing, numerators - denominators, np.nan),
+    )
+
+
+def draw_samples(params, iterations, random_state=None):
+    """Return a (len(params), iterations) array of independent samples
+
+    Uniform random numbers are drawn for all rows in a single call, and
+    are then transformed for each group of rows with the same uncertainty
+    type, see `uniforms_to_samples`. Random numbers are drawn iteration by
+    iteration, so that the numbers of a block of iterations are a
+    contiguous part of the random number stream.
+
+    Parameters:
+    ------------
+       params: numpy structured array
+           stats_arrays parameter array, or land exchange table
+       iterations: int
+           Number of iterations in sample.
+       random_state: numpy RandomState, optional
+           Random number generator to use. A new, unseeded one is used if None.
+    """
+    if random_state is None:
+        random_state = np.random.RandomState()
+    uniforms = random_state.random_sample((iterations, len(params))).T
+    return uniforms_to_samples(params, uniforms, random_state)
+
+
+def activity_random_state(seed, act_key, skip=0):
+    """Return random number generator of an activity, derived from a master seed
+
+    The random number stream of each activity is a child of `seed`, keyed
+    by a hash of the activity key. Samples of an activity therefore only
+    depend on the master seed and on the activity itself, and not on the
+    order in which activities are processed, how they are chunked or how
+    many processes are used.
+
+    Streams are generated by PCG64, which can be advanced by any number of
+    draws at no cost. With `skip`, the generator starts where it would be
+    after `skip` uniform random numbers, so that a block of iterations can
+    be drawn without drawing the previous ones.
+
+    Parameters:
+    ------------
+       seed: int
+           Master seed
+       act_key: tuple
+           Key of the activity
+       skip: int, default=0
+           Number of uniform random numbers to skip
+    """
+    digest = hashlib.sha256("\x00".join(act_key).encode('utf-8')).digest()
+    spawn_key = tuple(int(word) for word in np.frombuffer(digest, dtype=np.uint32))
+    bit_generator = np.random.PCG64(np.random.SeedSequence(seed, spawn_key=spawn_key))
+    if skip:
+        bit_generator.advance(skip)
+    return np.random.RandomState(bit_generator)
+
+
+def draw_segment_samples(params, iterations, starts, random_states):
+    """Return samples of several segments (activities), each drawn from its own generator
+
+    For each segment, samples are exactly those `draw_samples` returns for
+    the rows of the segment and the same random number generator, but the
+    inverse distribution functions are applied to all segments at once.
+
+    Parameters:
+    ------------
+       params: numpy structured array
+           stats_arrays parameter array, or land exchange table
+       iterations: int
+           Number of iterations in sample.
+       starts: numpy array of int
+           Index of first row of each segment
+       random_states: iterable of numpy RandomState
+           Random number generator of each segment, e.g. a generator
+           expression, so that they do not all need to be kept in memory.
+    """
+    counts = np.diff(np.r_[starts, len(params)])
+    uniforms = np.empty((len(params), iterations))
+    samples = np.empty((len(params), iterations))
+    # Uncertainty types without inverse distribution function are drawn by
+    # stats_arrays, with the generator of their segment
+    fallback = ~np.isin(params['uncertainty_type'], list(INVERSE_CDFS))
+    for start, count, random_state in zip(starts, counts, random_states):
+        uniforms[start:start + count] = random_state.random_sample((iterations, count)).T
+        rows = start + np.flatnonzero(fallback[start:start + count])
+        if len(rows):
+            samples[rows] = uniforms_to_samples(params[rows], uniforms[rows], random_state)
+    samples[~fallback] = uniforms_to_samples(params[~fallback], uniforms[~fallback])
+    return samples
+
+
+def uniforms_to_samples(params, uniforms, random_state=None):
+    """Transform uniform random numbers into samples of the distributions in `params`
+
+    Rows are grouped by uncertainty type, and each group is transformed
+    with a single vectorized inverse cumulative distribution function
+    evaluated with per-row parameters. Bounds are respected by sampling the
+    truncated distributions, which is equivalent to (but faster than)
+    redrawing out-of-bounds values.
+
+    Inverse distribution functions are available for no uncertainty,
+    lognormal, normal, uniform and triangular distributions. Rows with other
+    uncertainty types are drawn by stats_arrays with `random_state`.
+
+    Parameters:
+    ------------
+       params: numpy structured array
+           stats_arrays parameter array, or land exchange table
+       uniforms: numpy array
+           (len(params), iterations) array of uniform random numbers in [0, 1)
+       random_state: numpy RandomState, optional
+           Random number generator for uncertainty types without inverse
+           distribution function.
+    """
+    samples = np.empty(uniforms.shape)
+    types = params['uncertainty_type']
+    for uncertainty_type in np.unique(types):
+        mask = types == uncertainty_type
+        inverse_cdf = INVERSE_CDFS.get(int(uncertainty_type))
+        if inverse_cdf is not None:
+            samples[mask] = inverse_cdf(params[mask], uniforms[mask])
+        else:
+            if random_state is None:
+                random_state = np.random.RandomState()
+            samples[mask] = uncertainty_choices[int(uncertainty_type)].bounded_random_variables(
+                params[mask], uniforms.shape[1], random_state
+            )
+    return samples
+
+
+def _column(params, field):
+    return params[field].astype(float).reshape(-1, 1)
+
+
+def _truncated_standard_normal(uniforms, lower, upper):
+    """Inverse distribution function of standard normal truncated to [lower, upper]
+
+    Bounds are arrays of standard scores, with nan if unbounded.
+    """
+    lower_cdf = np.where(np.isnan(lower), 0, ndtr(lower))
+    upper_cdf = np.where(np.isnan(upper), 1, ndtr(upper))
+    return ndtri(lower_cdf + uniforms * (upper_cdf - lower_cdf))
+
+
+def _no_uncertainty_inverse_cdf(params, uniforms):
+    return np.repeat(_column(params, 'loc'), uniforms.shape[1], axis=1)
+
+
+def _normal_inverse_cdf(params, uniforms):
+    loc, scale = _column(params, 'loc'), _column(params, 'scale')
+    z = _truncated_standard_normal(
+        uniforms,
+        (_column(params, 'minimum') - loc) / scale,
+        (_column(params, 'maximum') - loc) / scale,
+    )
+    return loc + scale * z
+
+
+def _lognormal_inverse_cdf(params, uniforms):
+    loc, scale = _column(params, 'loc'), _column(params, 'scale')
+    negative = params['negative'].reshape(-1, 1)
+    # Bounds apply to signed values
+    lower = np.where(negative, -_column(params, 'maximum'), _column(params, 'minimum'))
+    upper = np.where(negative, -_column(params, 'minimum'), _column(params, 'maximum'))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        log_lower = np.where(lower <= 0, -np.inf, np.log(lower))
+        log_upper = np.where(upper <= 0, -np.inf, np.log(upper))
+    z = _truncated_standard_normal(
+        uniforms, (log_lower - loc) / scale, (log_upper - loc) / scale
+    )
+    return np.where(negative, -1, 1) * np.exp(loc + scale * z)
+
+
+def _uniform_inverse_cdf(params, uniforms):
+    minimum, maximum = _column(params, 'minimum'), _column(params, 'maximum')
+    return minimum + uniforms * (maximum - minimum)
+
+
+def _triangular_inverse_cdf(params, uniforms):
+    minimum, maximum = _column(params, 'minimum'), _column(params, 'maximum')
+    mode = _column(params, 'loc')
+    width = maximum - minimum
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mode_cdf = (mode - minimum) / width
+    return np.where(
+        uniforms < mode_cdf,
+        minimum + np.sqrt(uniforms * width * (mode - minimum)),
+        maximum - np.sqrt((1 - uniforms) * width * (maximum - mode)),
+    )
+
+
+INVERSE_CDFS = {
+    UndefinedUncertainty.id: _no_uncertainty_inverse_cdf,
+    NoUncertainty.id: _no_uncertainty_inverse_cdf,
+    LognormalUncertainty.id: _lognormal_inverse_cdf,
+    NormalUncertainty.id: _normal_inverse_cdf,
+    UniformUncertainty.id: _uniform_inverse_cdf,
+    TriangularUncertainty.id: _triangular_inverse_cdf,
+}
+
+
+def rebalance_segments(samples, in_mask, out_mask, uncertain_mask, strategies,
+                       static_ratios, starts):
+    """Rescale samples in place so that the static ratio of each segment is conserved
+
+    For the "default" strategy, variable inputs are rescaled. For the "inverse"
+    strategy, variable outputs are rescaled. All segments should have one of
+    these two strategies.
+
+    Parameters:
+    ------------
+       samples: numpy array
+           (number of land exchanges, iterations) array of independent samples
+       in_mask, out_mask: numpy arrays of bool
+           Identify land exchanges prior to and after transformation
+       uncertain_mask: numpy array of bool
+           Identify land exchanges with uncertainty
+       strategies: numpy array of str
+           Strategy of each segment
+       static_ratios: numpy array of float
+           Ratio to conserve across iterations, for each segment
+       starts: numpy array of int
+           Index of first row of each segment
+    """
+    if not np.isin(strategies, ['default', 'inverse']).all():
+        raise ValueError(
+            "Can only rebalance samples with 'default' or 'inverse' strategies"
+        )
+    counts = np.diff(np.r_[starts, len(samples)])
+    inverse = np.repeat(strategies == 'inverse', counts)
+    scaled = np.where(inverse, out_mask, in_mask)
+    reference = np.where(inverse, in_mask, out_mask)
+    var_mask = scaled & uncertain_mask
+    const_mask = scaled & ~uncertain_mask
+
+    reference_sums = _segment_sums(np.where(reference[:, None], samples, 0), starts)
+    const_sums = _segment_sums(np.where(const_mask[:, None], samples, 0), starts)
+    var_sums = _segment_sums(np.where(var_mask[:, None], samples, 0), starts)
+    scaling = (static_ratios[:, None] * reference_sums - const_sums) / var_sums
+    samples[var_mask] *= np.repeat(scaling, counts, axis=0)[var_mask]
+    return samples
+
+
+def rebalance_samples(samples, in_mask, out_mask, uncertain_mask, strategy, static_ratio):
+    """Rescale samples of a single activity in place, see `rebalance_segments`"""
+    return rebalance_segments(
+        samples, in_mask, out_mask, uncertain_mask,
+        np.array([strategy]), np.array([static_ratio], dtype=float), np.array([0])
+    )
+
+
+def ratio_errors(samples, in_mask, out_mask, strategies, static_ratios, starts):
+    """Return largest relative deviation from the static ratio of each segment
+
+    Ratios are computed in double precision from `samples`, which can be of
+    lower precision. Segments without a finite static ratio (e.g. "skip" or
+    "set_static" strategies) have an error of 0.
+
+    Parameters:
+    ------------
+       samples: numpy array
+           (number of land exchanges, iterations) array of balanced samples
+       in_mask, out_mask: numpy arrays of bool
+           Identify land exchanges prior to and after transformation
+       strategies: numpy array of str
+           Strategy of each segment
+       static_ratios: numpy array of float
+           Ratio that should be conserved across iterations, for each segment
+       starts: numpy array of int
+           Index of first row of each segment
+    """
+    samples = samples.astype(np.float64)
+    in_totals = _segment_sums(np.where(in_mask[:, None], samples, 0), starts)
+    out_totals = _segment_sums(np.where(out_mask[:, None], samples, 0), starts)
+    inverse = (np.asarray(strategies) == 'inverse')[:, None]
+    static_ratios = np.asarray(static_ratios, dtype=np.float64)[:, None]
+    checked = np.isfinite(static_ratios) & (static_ratios != 0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ratios = np.where(inverse, out_totals / in_totals, in_totals / out_totals)
+        errors = np.where(checked, np.abs(ratios / static_ratios - 1), 0)
+    return errors.max(axis=1, initial=0)
+
+
+def downcast_samples(samples, dtype, in_mask, out_mask, strategies, static_ratios, starts,
+                     tolerance):
+    """Return balanced samples cast to `dtype`, checking that ratios are conserved
+
+    Raises a ValueError if, after casting, the ratio of any segment deviates
+    from its static ratio by more than `tolerance` (relative), see
+    `ratio_errors`. Arguments are those of `ratio_errors`.
+    """
+    samples = samples.astype(dtype, copy=False)
+    if len(starts):
+        errors = ratio_errors(samples, in_mask, out_mask, strategies, static_ratios, starts)
+        if (errors > tolerance).any():
+            raise ValueError(
+                "Balance ratios of {} activities deviate by up to {:.3g} from their static "
+                "ratio with dtype {}, above the tolerance of {:.3g}".format(
+                    int((errors > tolerance).sum()), errors.max(), np.dtype(dtype), tolerance)
+            )
+    return samples
+
+
+def processed_land_exchange_table(array, land_in_ids, land_out_ids, output_ids=None):
+    """Return a land exchange table built from a processed Brightway array
+
+    Processed arrays already hold integer ids and stats_arrays uncertainty
+    fields, so land exchanges are simply selected with vectorized
+    membership tests. Rows keep their order in `array`.
+
+    Parameters:
+    ------------
+       array: numpy structured array
+           Processed array of a database, see `Database.filepath_processed`
+       land_in_ids, land_out_ids: sequences of int
+           Integer ids of land flows prior to and after transformation
+       output_ids: sequence of int, optional
+           Integer ids of activities to include. All activities if None.
+    """
+    is_in = np.isin(array['input'], np.asarray(land_in_ids, dtype=np.uint32))
+    is_out = np.isin(array['input'], np.asarray(land_out_ids, dtype=np.uint32))
+    mask = (array['type'] == TYPE_DICTIONARY['biosphere']) & (is_in | is_out)
+    if output_ids is not None:
+        mask &= np.isin(array['output'], np.asarray(output_ids, dtype=np.uint32))
+    rows = array[mask]
+    table = np.zeros(len(rows), dtype=LAND_EXCHANGE_DTYPE)
+    for field in table.dtype.names:
+        if field != 'land_type':
+            table[field] = rows[field]
+    table['land_type'] = np.where(is_in[mask], LAND_IN, LAND_OUT)
+    return table
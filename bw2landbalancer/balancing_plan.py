@@ -0,0 +1,169 @@
+import hashlib
+import numpy as np
+from bw2data.utils import TYPE_DICTIONARY
+from .sample_store import ID_INDICES_DTYPE
+from .array_balancer import (
+    LAND_IN, LAND_OUT, segment_starts, identify_strategies, get_static_ratios
+)
+
+
+class BalancingPlan():
+    """Everything needed to generate balanced land samples for a database
+
+    A plan holds the land exchange table of a database (see
+    `array_balancer.land_exchange_table`), the strategy and static ratio of
+    each activity and the keys associated with the integer ids of the table.
+    Generating samples from a plan therefore requires neither classification
+    of exchanges nor database access. Plans only need to be recreated when
+    the inventory changes, and can be saved and loaded with `save` and `load`.
+
+    Parameters:
+    ------------
+       table: numpy structured array
+           Land exchange table, with exchanges of a same activity contiguous
+       keys_from_ids: dict
+           Keys of land flows and activities, with table ids as keys
+       database_name: string
+           Name of the LCI database the plan was created for
+       biosphere: string
+           Name of the biosphere database the plan was created for
+
+    Attributes:
+    -----------
+       starts: numpy array of int
+           Index of the first table row of each activity
+       strategies: numpy array of str
+           Strategy of each activity, see `array_balancer.identify_strategies`
+       static_ratios: numpy array of float
+           Ratio to conserve for each activity, nan if not balanced
+       static_balances: numpy array of float
+           Static balance of each activity, nan if not balanced
+       in_mask, out_mask, uncertain_mask: numpy arrays of bool
+           Identify land exchanges prior to and after transformation, and
+           land exchanges with uncertainty
+    """
+    def __init__(self, table, keys_from_ids, database_name, biosphere):
+        self.table = table
+        self.keys_from_ids = keys_from_ids
+        self.database_name = database_name
+        self.biosphere = biosphere
+        self.starts = segment_starts(table['output'])
+        self.in_mask = table['land_type'] == LAND_IN
+        self.out_mask = table['land_type'] == LAND_OUT
+        self.uncertain_mask = table['uncertainty_type'] != 0
+        self.strategies = identify_strategies(
+            table['amount'], self.in_mask, self.out_mask, self.uncertain_mask, self.starts
+        )
+        self.static_ratios, self.static_balances = get_static_ratios(
+            table['amount'], self.in_mask, self.out_mask, self.strategies, self.starts
+        )
+
+    def __len__(self):
+        return len(self.starts)
+
+    @property
+    def counts(self):
+        """Number of land exchanges of each activity"""
+        return np.diff(np.r_[self.starts, len(self.table)])
+
+    def row_counts(self):
+        """Return number of sample rows of each activity
+
+        All land exchanges of activities with a "default" or "inverse"
+        strategy are sampled, only the variable exchange of "set_static"
+        activities, and none of "skip" activities.
+        """
+        balanced = np.isin(self.strategies, ['default', 'inverse'])
+        return np.where(balanced, self.counts, (self.strategies == 'set_static').astype(int))
+
+    @property
+    def act_keys(self):
+        """Keys of activities in plan, in table order"""
+        return [self.keys_from_ids[id_] for id_ in self.table['output'][self.starts]]
+
+    def row_strategies(self):
+        """Return strategy of the activity of each table row"""
+        return np.repeat(self.strategies, self.counts)
+
+    def indices(self, mask=None):
+        """Return matrix indices of table rows, optionally only those in `mask`"""
+        table = self.table if mask is None else self.table[mask]
+        return [
+            (self.keys_from_ids[row['input']], self.keys_from_ids[row['output']], 'biosphere')
+            for row in table
+        ]
+
+    def id_indices(self, mask=None):
+        """Return integer-coded matrix indices of table rows, see `sample_store.encode_indices`
+
+        Table ids are mapped ids, so that no key needs to be looked up.
+        """
+        table = self.table if mask is None else self.table[mask]
+        indices = np.zeros(len(table), dtype=ID_INDICES_DTYPE)
+        indices['input'] = table['input']
+        indices['output'] = table['output']
+        indices['type'] = TYPE_DICTIONARY['biosphere']
+        return indices
+
+    def activity_hashes(self):
+        """Return content hash of the land exchanges of each activity
+
+        Hashes cover all table fields (flows, amounts, uncertainty) and
+        therefore change whenever land exchanges of the activity change.
+        """
+        return {
+            key: hashlib.sha1(self.table[start:start + count].tobytes()).hexdigest()
+            for key, start, count in zip(self.act_keys, self.starts, self.counts)
+        }
+
+    def changed_activities(self, previous_plan):
+        """Return keys of activities changed since `previous_plan`
+
+        Returns a list of keys of activities that are new or whose land
+        exchanges changed, and a list of keys of activities that are no
+        longer in the plan.
+        """
+        hashes = self.activity_hashes()
+        previous_hashes = previous_plan.activity_hashes()
+        changed = [key for key, hash_ in hashes.items() if previous_hashes.get(key) != hash_]
+        removed = [key for key in previous_hashes if key not in hashes]
+        return changed, removed
+
+    def subset(self, act_keys):
+        """Return plan restricted to activities in `act_keys`"""
+        act_keys = set(act_keys)
+        ids = [id_ for id_, key in self.keys_from_ids.items() if key in act_keys]
+        mask = np.isin(self.table['output'], np.asarray(ids, dtype=np.uint32))
+        return BalancingPlan(
+            self.table[mask], self.keys_from_ids, self.database_name, self.biosphere
+        )
+
+    def save(self, filepath):
+        """Save plan to a numpy `.npz` file
+
+        Keys are stored as arrays of strings, so that the file can be loaded
+        without pickle.
+        """
+        ids = np.array(sorted(self.keys_from_ids), dtype=np.uint32)
+        np.savez(
+            filepath,
+            table=self.table,
+            key_ids=ids,
+            key_databases=np.array([self.keys_from_ids[id_][0] for id_ in ids], dtype=str),
+            key_codes=np.array([self.keys_from_ids[id_][1] for id_ in ids], dtype=str),
+            database_name=np.array(self.database_name),
+            biosphere=np.array(self.biosphere),
+        )
+
+    @classmethod
+    def load(cls, filepath):
+        """Load plan saved with `save`"""
+        with np.load(filepath, allow_pickle=False) as data:
+            keys_from_ids = {
+                int(id_): (str(database), str(code)) for id_, database, code in zip(
+                    data['key_ids'], data['key_databases'], data['key_codes']
+                )
+            }
+            return cls(
+                data['table'], keys_from_ids, str(data['database_name']), str(data['biosphere'])
+            )
@@ -0,0 +1,107 @@
+import json
+import os
+from pathlib import Path
+import numpy as np
+from .sample_store import ID_INDICES_DTYPE
+
+
+class CheckpointDirectory():
+    """Directory holding the samples of activities completed during a run
+
+    Samples are written in checkpoint files, each holding the samples and
+    integer-coded indices of a chunk of activities, together with the keys
+    of the activities of the chunk (including those without samples, e.g.
+    with a "skip" strategy). Files are written through temporary files, so
+    that an interrupted run never leaves a partial checkpoint.
+
+    A `run.json` file describes the run (database, number of iterations,
+    seed, ...). Checkpoints can only be resumed by the same run. If the
+    seed of `run` is None, the seed of the checkpointed run is used, so
+    that resumed samples are the same as if the run was not interrupted.
+
+    Parameters:
+    -----------
+       dirpath: str
+           Directory of checkpoints, created if needed
+       run: dict
+           JSON-serializable description of the run, with a `seed` key
+    """
+    def __init__(self, dirpath, run):
+        self.dirpath = Path(dirpath)
+        self.dirpath.mkdir(parents=True, exist_ok=True)
+        run_fp = self.dirpath / "run.json"
+        self.resumed = run_fp.exists()
+        if self.resumed:
+            with open(run_fp, encoding='utf-8') as f:
+                checkpointed_run = json.load(f)
+            if run['seed'] is None:
+                run = dict(run, seed=checkpointed_run['seed'])
+            if checkpointed_run != run:
+                raise ValueError("Checkpoints in {} are of a different run: {}".format(
+                    dirpath, checkpointed_run))
+        else:
+            if run['seed'] is None:
+                run = dict(run, seed=np.random.SeedSequence().entropy)
+            _write_json(run_fp, run)
+        self.run = run
+
+    @property
+    def seed(self):
+        return self.run['seed']
+
+    def _filepaths(self):
+        # Temporary files left by an interruption are named checkpoint.<number>.tmp.npz
+        return sorted(
+            filepath for filepath in self.dirpath.glob("checkpoint.*.npz")
+            if filepath.name.count('.') == 2
+        )
+
+    def completed_activities(self):
+        """Return set of keys of activities whose samples are checkpointed"""
+        completed = set()
+        for filepath in self._filepaths():
+            with np.load(filepath, allow_pickle=False) as data:
+                completed.update(zip(data['act_databases'].tolist(), data['act_codes'].tolist()))
+        return completed
+
+    def load(self):
+        """Yield samples and integer-coded indices of each checkpoint, in order"""
+        for filepath in self._filepaths():
+            with np.load(filepath, allow_pickle=False) as data:
+                if len(data['id_indices']):
+                    yield data['samples'], data['id_indices']
+
+    def write(self, act_keys, samples, id_indices):
+        """Write a checkpoint with the samples of activities `act_keys`
+
+        Parameters:
+        -----------
+           act_keys: list
+               Keys of activities of the chunk
+           samples: numpy array
+               (rows, iterations) array of samples, or None if no samples
+           id_indices: numpy structured array
+               Integer-coded matrix indices of samples
+        """
+        if samples is None:
+            samples = np.zeros((0, self.run['iterations']))
+        filepaths = self._filepaths()
+        number = int(filepaths[-1].name.split('.')[1]) + 1 if filepaths else 0
+        filepath = self.dirpath / "checkpoint.{:06d}.npz".format(number)
+        temp_fp = self.dirpath / "checkpoint.{:06d}.tmp.npz".format(number)
+        np.savez(
+            temp_fp,
+            samples=samples,
+            id_indices=np.asarray(id_indices, dtype=ID_INDICES_DTYPE),
+            act_databases=np.array([key[0] for key in act_keys], dtype=str),
+            act_codes=np.array([key[1] for key in act_keys], dtype=str),
+        )
+        os.replace(temp_fp, filepath)
+
+
+def _write_json(filepath, data):
+    """Write JSON file through a temporary file"""
+    temp_fp = "{}.tmp".format(filepath)
+    with open(temp_fp, "w", encoding='utf-8') as f:
+        json.dump(data, f, indent=2, ensure_ascii=False)
+    os.replace(temp_fp, filepath)
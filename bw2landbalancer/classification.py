@@ -0,0 +1,177 @@
+import hashlib
+import json
+import os
+import re
+import tempfile
+import warnings
+from bw2data import Database, databases, projects
+from .array_balancer import LAND_IN, LAND_OUT
+
+CACHE_DIRECTORY = 'land_balancer'
+
+
+def compile_patterns(patterns):
+    """Return compiled regular expressions together matching any of `patterns`
+
+    Strings are matched as substrings of flow names. Compiled regular
+    expressions are used as is, which allows more specific rules.
+    Strings and compiled regular expressions without flags are joined into
+    a single regular expression. Compiled regular expressions with flags
+    (e.g. `re.IGNORECASE`, or inline global flags like `(?i)`) are kept
+    separate, as their flags would not apply to the joined expression.
+
+    Parameters:
+    ------------
+       patterns: list of strings or compiled regular expressions
+           Patterns identifying land flows
+    """
+    joined = []
+    flagged = []
+    for pattern in patterns or []:
+        if not isinstance(pattern, re.Pattern):
+            joined.append(re.escape(pattern))
+        elif pattern.flags & ~re.UNICODE:
+            flagged.append(pattern)
+        else:
+            joined.append(pattern.pattern)
+    if joined:
+        flagged.insert(0, re.compile("|".join("(?:{})".format(pattern) for pattern in joined)))
+    return flagged
+
+
+def _matches_any(regexes, name):
+    """Return True if any of `regexes` (see `compile_patterns`) matches `name`"""
+    return any(regex.search(name) for regex in regexes)
+
+
+def in_categories(flow_categories, categories):
+    """Return True if `flow_categories` start with one of `categories`
+
+    Parameters:
+    ------------
+       flow_categories: tuple
+           Categories of a flow, e.g. ('natural resource', 'land')
+       categories: list of tuples
+           Categories to accept. A category like ('natural resource',)
+           accepts all of its subcategories. Anything is accepted if None.
+    """
+    if categories is None:
+        return True
+    flow_categories = tuple(flow_categories or ())
+    return any(flow_categories[:len(category)] == tuple(category) for category in categories)
+
+
+def classify_land_flows(flows, land_from_patterns, land_to_patterns, categories=None):
+    """Return land type (`LAND_IN` or `LAND_OUT`) of land flows, in a single pass
+
+    Flows matching both types of patterns are considered land prior to
+    transformation (`LAND_IN`). Flows that do not match are not included.
+
+    Parameters:
+    ------------
+       flows: iterable
+           (key, name, categories) of elementary flows
+       land_from_patterns: list of strings or compiled regular expressions
+           Patterns identifying land states prior to transformation
+       land_to_patterns: list of strings or compiled regular expressions
+           Patterns identifying land states after transformation
+       categories: list of tuples, optional
+           If given, only flows in these categories are considered
+    """
+    land_from_regexes = compile_patterns(land_from_patterns)
+    land_to_regexes = compile_patterns(land_to_patterns)
+    land_types = {}
+    for key, name, flow_categories in flows:
+        if not in_categories(flow_categories, categories):
+            continue
+        if _matches_any(land_from_regexes, name):
+            land_types[key] = LAND_IN
+        elif _matches_any(land_to_regexes, name):
+            land_types[key] = LAND_OUT
+    return land_types
+
+
+def _pattern_description(patterns):
+    """Return JSON-serializable description of patterns, for cache keys"""
+    return [
+        [pattern.pattern, pattern.flags] if isinstance(pattern, re.Pattern) else pattern
+        for pattern in patterns or []
+    ]
+
+
+def classify_biosphere(biosphere, land_from_patterns, land_to_patterns, categories=None,
+                       use_cache=True):
+    """Return land type of land flows of a biosphere database, see `classify_land_flows`
+
+    Classifications are cached in the project directory, keyed on the name of
+    the biosphere database, the last time it was modified and the patterns and
+    categories used. A cached classification is therefore invalidated when the
+    biosphere database changes.
+
+    Parameters:
+    ------------
+       biosphere: string
+           Name of the biosphere database
+       land_from_patterns, land_to_patterns: lists of strings or compiled regular expressions
+           Patterns identifying land states prior to and after transformation
+       categories: list of tuples, optional
+           If given, only flows in these categories are considered
+       use_cache: bool, default=True
+           If False, the biosphere database is always read, and the
+           classification is not cached
+    """
+    cache_key = {
+        'biosphere': biosphere,
+        'modified': databases[biosphere].get('modified'),
+        'land_from_patterns': _pattern_description(land_from_patterns),
+        'land_to_patterns': _pattern_description(land_to_patterns),
+        'categories': [list(category) for category in categories] if categories is not None else None,
+    }
+    # Without a modification time, a cache could not be invalidated
+    directory = use_cache and cache_key['modified'] is not None and _cache_directory()
+    if directory:
+        cache_fp = os.path.join(
+            directory,
+            "classification.{}.json".format(
+                hashlib.md5(json.dumps(cache_key, sort_keys=True).encode('utf-8')).hexdigest()
+            )
+        )
+        try:
+            with open(cache_fp, encoding='utf-8') as f:
+                cached = json.load(f)
+            if cached['key'] == cache_key:
+                return {(database, code): land_type for database, code, land_type in cached['land_types']}
+        except (OSError, ValueError, KeyError):
+            pass
+
+    land_types = classify_land_flows(
+        ((ef.key, ef['name'], ef.get('categories')) for ef in Database(biosphere)),
+        land_from_patterns, land_to_patterns, categories
+    )
+    if directory:
+        # Write to a temporary file first, so concurrent readers never see partial files
+        try:
+            fd, temp_fp = tempfile.mkstemp(dir=directory, suffix='.tmp')
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump({
+                    'key': cache_key,
+                    'land_types': [[key[0], key[1], land_type] for key, land_type in land_types.items()],
+                }, f, ensure_ascii=False)
+            os.replace(temp_fp, cache_fp)
+        except OSError:
+            warnings.warn("Could not cache land flow classification in {}".format(directory))
+    return land_types
+
+
+def _cache_directory():
+    """Return the cache directory of the current project, or None if it can't be created
+
+    Unlike `projects.request_directory`, does not fail if another process
+    creates the directory at the same time.
+    """
+    directory = os.path.join(projects.dir, CACHE_DIRECTORY)
+    try:
+        os.makedirs(directory, exist_ok=True)
+    except OSError:
+        return None
+    return directory
@@ -1,9 +1,34 @@
 from brightway2 import *
 import numpy as np
 import warnings
-import pyprind
+import copy
+import json
+import re
+from pathlib import Path
+import multiprocessing
+from bw2data.backends.peewee import Activity, ActivityDataset, Exchange, ExchangeDataset, sqlite3_lci_db
 from .activity_land_balancer import ActivityLandBalancer
-from presamples import create_presamples_package, split_inventory_presamples
+from .classification import classify_biosphere
+from .instrumentation import Instrumentation, ignore_event
+from .utils import prefetch
+from .balancing_plan import BalancingPlan
+from .checkpoint import CheckpointDirectory
+from .sample_store import (
+    SampleStore, StreamingSampleStore, BlockPresamplesWriter, PreallocatedSampleStore,
+    splice_presamples_package, create_shared_samples, remove_shared_samples
+)
+from .array_balancer import (
+    LAND_IN, LAND_OUT, land_exchange_table, segment_starts, draw_segment_samples,
+    rebalance_segments, processed_land_exchange_table, activity_random_state, downcast_samples
+)
+
+# Largest number of variables of an SQLite statement, for SQLite versions
+# before 3.32
+SQLITE_MAX_VARIABLES = 999
+
+# Formulas of land exchanges written by `ActivityLandBalancer`
+BALANCING_FORMULA = re.compile(r"^(land_param_\d+( \* scaling)?|cst)$")
+
 
 class DatabaseLandBalancer():
     """Used to create balanced land samples to override unbalanced sample
@@ -33,41 +58,110 @@ class DatabaseLandBalancer():
        biosphere: string, default='biosphere3'
            Name of the biosphere database in the brighway2 database
        group: string, default='land'
-           Name of the parameter group name. Used in the generation of samples.
+           Name of the parameter group used in the generation of samples,
+           created in a scratch parameter workspace (see `parameter_workspace`).
        land_from_patterns: list of strings, default ['Transformation, from']
-           List of string patterns identifying land states prior to transformation
+           List of string patterns identifying land states prior to transformation.
+           Compiled regular expressions can also be passed.
        land_to_patterns: list of strings, default ['Transformation, to']
-           List of string patterns identifying land states after transformation
+           List of string patterns identifying land states after transformation.
+           Compiled regular expressions can also be passed.
+       land_categories: list of tuples, optional
+           If given, only elementary flows in these categories (or their
+           subcategories) are considered, e.g. [('natural resource', 'land')]
+       cache_classification: bool, default=True
+           If True, the classification of land flows is cached in the
+           project directory and reused until the biosphere database is
+           modified, see `classification.classify_biosphere`
+       engine: string, default='presamples'
+           Engine used to generate balanced samples. "presamples" evaluates
+           balancing formulas with presamples; "numpy" rescales samples with
+           array arithmetic and does not modify the database.
+       read_only: bool, default=False
+           If True, exchange data is read once into memory and the database
+           is never written to, also in worker processes: all writes of
+           ActivityLandBalancer raise a ValueError. Requires the "numpy"
+           engine.
+       data_source: string, default='database'
+           Source of land exchange data in batch mode. "database" reads
+           exchanges from the SQLite database; "processed" selects them from
+           the processed array of the database, without opening SQLite.
+           Processed arrays store uncertainty parameters in single precision
+           and are only updated when the database is processed. Requires the
+           "numpy" engine.
+       dtype: numpy dtype, default=numpy.float64
+           Floating point type of stored samples and of presamples packages.
+           Samples are drawn and rebalanced in double precision, and are
+           cast to `dtype` as they are stored. With float32, samples use half
+           the memory and disk space.
+       ratio_tolerance: float, default=1e-6
+           Largest relative deviation from the static ratio accepted after
+           samples are cast to `dtype`. A ValueError is raised if balance
+           ratios of any activity deviate by more than this.
+       callback: callable, optional
+           Function called with each event of the run (messages, progress
+           and end of timed stages), see `instrumentation.Instrumentation`.
+           If None, messages are printed and progress bars are shown.
+       prefetch: int, default=16
+           Number of activities read together from the database by
+           background threads, up to two batches ahead of the activity being
+           balanced, so that reads overlap with sample generation. 0 reads
+           each activity when it is balanced. Not used in batch mode, which
+           reads all exchanges at once.
 
     Attributes:
     -----------
-       all_land_keys: list
-           List of all keys of land elementary flows
-       land_in_keys: list
-           List of all keys of elementary flows associated with land states prior
+       all_land_keys: frozenset
+           Keys of all land elementary flows
+       land_in_keys: frozenset
+           Keys of elementary flows associated with land states prior
            to transformation
-       land_out_keys: list
-           List of all keys of elementary flows associated with land states after
-            transformation
+       land_out_keys: frozenset
+           Keys of elementary flows associated with land states after
+           transformation
+       land_types: dict
+           Land type (`array_balancer.LAND_IN` or `LAND_OUT`) of each land
+           elementary flow key. Flows matching both types of patterns are
+           considered land states prior to transformation.
        database_name: string
            Name of the LCI database in the brightway2 project
        biosphere: string, default='biosphere3'
            Name of the biosphere database in the brighway2 database
        group: string, default='land'
-           Name of the parameter group name. Used in the generation of samples.
-       matrix_indices: list
-           List of numpy structured arrays containing the matrix indices associated
-           with samples
-       matrix_samples: list
-           List of numpy arrays with samples
+           Name of the parameter group used in the generation of samples,
+           created in a scratch parameter workspace (see `parameter_workspace`).
+       engine: string, default='presamples'
+           Engine used to generate balanced samples.
+       read_only: bool, default=False
+           If True, the database is never written to.
+       data_source: string, default='database'
+           Source of land exchange data in batch mode.
+       dtype: numpy dtype, default=numpy.float64
+           Floating point type of stored samples.
+       ratio_tolerance: float, default=1e-6
+           Largest relative deviation from static ratios after casting to `dtype`.
+       prefetch: int, default=16
+           Number of activities per batch read ahead of the activity being balanced.
+       timing_report: instrumentation.TimingReport
+           Cumulative time and number of calls of each stage of the
+           pipeline, overall and per strategy, for all runs so far
+       matrix_indices: numpy structured array
+           Matrix indices associated with samples, with fields `input`,
+           `output` and `type`. Indices are stored integer-coded, and
+           converted to keys when this attribute is accessed.
+       matrix_samples: numpy array
+           Array of samples, one row per matrix index. None if no samples
+           were generated.
     """
     def __init__(self, database_name, biosphere='biosphere3', group="land",
                  land_from_patterns=['Transformation, from'],
-                 land_to_patterns=['Transformation, to'],
-                 ):
+                 land_to_patterns=['Transformation, to'], land_categories=None,
+                 cache_classification=True, engine='presamples', read_only=False, data_source='database',
+                 dtype=np.float64, ratio_tolerance=1e-6, callback=None, prefetch=16):
 
+        self.instrumentation = Instrumentation(callback)
         # Check that the database exists in the current project
-        print("Validating data")
+        self.instrumentation.message("Validating data")
         if database_name not in databases:
             raise ValueError("Database {} not imported".format(database_name))
         self.database_name = database_name
@@ -75,24 +169,40 @@ class DatabaseLandBalancer():
             raise ValueError("Database {} not imported".format(biosphere))
         self.biosphere = biosphere
         self.group = group
-        self.matrix_indices = []
-        self.matrix_samples = None
-
-        print("Getting information on land transformation exchanges")
-        self.land_in_keys = []
-        for ef in Database(self.biosphere):
-            for land_from_pattern in land_from_patterns:
-                if land_from_pattern in ef['name']:
-                    self.land_in_keys.append(ef.key)
-        self.land_out_keys = []
-        for ef in Database(self.biosphere):
-            for land_to_pattern in land_to_patterns:
-                if land_to_pattern in ef['name']:
-                    self.land_out_keys.append(ef.key)
-
-        self.all_land_keys = self.land_in_keys + self.land_out_keys
-
-    def add_samples_for_act(self, act_key, iterations):
+        if engine not in ('presamples', 'numpy'):
+            raise ValueError("Engine {} not understood, use 'presamples' or 'numpy'".format(engine))
+        self.engine = engine
+        if read_only and engine != 'numpy':
+            raise ValueError("Read-only balancing requires the 'numpy' engine")
+        self.read_only = read_only
+        if data_source not in ('database', 'processed'):
+            raise ValueError("Data source {} not understood, use 'database' or 'processed'".format(data_source))
+        if data_source == 'processed' and engine != 'numpy':
+            raise ValueError("The 'processed' data source requires the 'numpy' engine")
+        self.data_source = data_source
+        if not np.issubdtype(dtype, np.floating):
+            raise ValueError("dtype {} is not a floating point type".format(dtype))
+        self.dtype = np.dtype(dtype)
+        self.ratio_tolerance = ratio_tolerance
+        self.prefetch = prefetch
+        self._store = SampleStore()
+
+        self.instrumentation.message("Getting information on land transformation exchanges")
+        with self.instrumentation.stage('classify'):
+            self.land_types = classify_biosphere(
+                self.biosphere, land_from_patterns, land_to_patterns, land_categories,
+                use_cache=cache_classification
+            )
+        self.land_in_keys = frozenset(
+            key for key, land_type in self.land_types.items() if land_type == LAND_IN
+        )
+        self.land_out_keys = frozenset(
+            key for key, land_type in self.land_types.items() if land_type == LAND_OUT
+        )
+        self.all_land_keys = frozenset(self.land_types)
+
+    def add_samples_for_act(self, act_key, iterations, random_state=None, land_exchanges=None,
+                            seed=None, activity=None, exchanges=None):
         """Add samples and indices for given activity
 
         Actual samples generated by a ActivityLandBalancer instance.
@@ -106,39 +216,828 @@ class DatabaseLandBalancer():
                Key of target activity in database
            iterations: int
                Number of iterations in generated samples
+           random_state: numpy RandomState, optional
+               Random number generator used by the "numpy" engine
+           land_exchanges: list, optional
+               Land exchange dictionaries of the activity, see
+               `load_land_exchanges`. Read from the database if None.
+           seed: int, optional
+               Master seed. If given and `random_state` is None, samples are
+               drawn from the random number stream of the activity derived
+               from this seed, see `array_balancer.activity_random_state`.
+           activity: Activity, optional
+               The activity, if already read from the database
+           exchanges: list, optional
+               All exchanges of the activity, if already read from the
+               database. Only used by the "presamples" engine.
         """
-        ab = ActivityLandBalancer(act_key, self)
-        for data in ab.generate_samples(iterations):
+        if random_state is None and seed is not None:
+            random_state = activity_random_state(seed, act_key)
+        ab = ActivityLandBalancer(act_key, self, land_exchanges, activity, exchanges)
+        for data in ab.generate_samples(iterations, random_state):
             if len(data[1][0])==2:
-                for row in data[1]:
-                    self.matrix_indices.append((row[0], row[1], 'biosphere'))
+                indices = [(row[0], row[1], 'biosphere') for row in data[1]]
             else:
-                self.matrix_indices.extend(data[1])
-            if self.matrix_samples is None:
-                self.matrix_samples = data[0]
-            else:
-                self.matrix_samples = np.concatenate([self.matrix_samples, data[0]], axis=0)
+                indices = data[1]
+            balanced = ab.strategy in ('default', 'inverse')
+            samples = self._downcast(
+                ab.strategy,
+                data[0],
+                np.array([index[0] in self.land_in_keys for index in indices]),
+                np.array([index[0] in self.land_out_keys for index in indices]),
+                np.array([ab.strategy]),
+                np.array([ab.static_ratio if balanced else np.nan], dtype=float),
+                np.array([0]),
+            )
+            with self.instrumentation.stage('store', ab.strategy):
+                self._add_matrix_data(samples, indices)
 
-    def add_samples_for_all_acts(self, iterations):
+    def add_samples_for_all_acts(self, iterations, batch=False, processes=None, seed=None,
+                                 checkpoint_dir=None, checkpoint_size=100, samples_dir=None):
         """Add samples and indices for all activities in database
 
         Iterates through all activities in database and calls activity-
         level method add_samples_for_act
 
+        With `batch=True`, all activities are rather classified first. Land
+        exchanges of all activities with a "default" or "inverse" strategy
+        are then sampled as a single array and rebalanced with segment
+        reductions, and the static values of all "set_static" activities are
+        added at once. Batch mode requires the "numpy" engine, and is the
+        only mode available with the "processed" data source.
+
+        Each activity gets its own random number stream, derived from
+        `seed` and the activity key. With the same seed, samples are
+        therefore identical whatever the mode (batch or not) and the number
+        of processes.
+
+        With `processes` larger than 1, activities are partitioned in as many
+        chunks, which are processed in a pool of worker processes. Workers
+        write samples directly into a temporary memory-mapped array, at rows
+        assigned up front, in chunk order, and `matrix_samples` is that
+        array, without copy. Its file is created in `samples_dir`, and
+        removed once samples are collected. With the "presamples" engine,
+        the parameters of each activity live in a private in-memory
+        workspace, so that workers, and other balancers of the same project,
+        never share parameter groups (see `parameter_workspace`).
+
+        With `checkpoint_dir`, activities are processed in chunks of
+        `checkpoint_size` activities, and the samples of each chunk are
+        written to the directory as soon as the chunk is completed, see
+        `checkpoint.CheckpointDirectory`. If the run is interrupted, calling
+        this method again with the same arguments resumes it: checkpointed
+        samples are loaded, and only the remaining activities are processed.
+        With the "presamples" engine, activities left half-processed by the
+        interruption are first repaired, see `repair_activities`. If no seed
+        is given, the seed of the interrupted run is reused.
+
+        Parameters:
+        -----------
+           iterations: int
+               Number of iterations in generated samples
+           batch: bool, default=False
+               If True, generate samples for all activities at once
+           processes: int, optional
+               Number of worker processes. Samples are generated in the
+               current process if None or 1.
+           seed: int, optional
+               Master seed used to derive random number streams. Only used by
+               the "numpy" engine, as presamples does not expose its generator.
+           checkpoint_dir: str, optional
+               Directory where samples of completed activities are checkpointed
+           checkpoint_size: int, default=100
+               Number of activities per checkpoint
+           samples_dir: str, optional
+               Directory of the file of samples shared with worker processes.
+               `checkpoint_dir` if given, otherwise a subdirectory of the
+               project directory, see `sample_store.create_shared_samples`.
+
+        """
+        if batch and self.engine != 'numpy':
+            raise ValueError("Batch mode requires the 'numpy' engine")
+        if not batch and self.data_source == 'processed':
+            raise ValueError("The 'processed' data source requires batch mode")
+        act_keys = self._get_act_keys()
+        if checkpoint_dir is not None:
+            self._add_samples_with_checkpoints(
+                act_keys, iterations, batch, processes, seed, checkpoint_dir, checkpoint_size,
+                checkpoint_dir if samples_dir is None else samples_dir
+            )
+            return
+        if seed is None:
+            # All activities still need to derive their streams from the same seed
+            seed = np.random.SeedSequence().entropy
+        if not processes or processes == 1:
+            self._add_samples_for_chunk(act_keys, iterations, batch, seed)
+            return
+
+        chunks = [
+            [act_keys[i] for i in chunk]
+            for chunk in np.array_split(np.arange(len(act_keys)), processes) if len(chunk)
+        ]
+        if not chunks:
+            return
+        samples, results = self._generate_chunks_in_pool(
+            chunks, iterations, batch, seed, processes, samples_dir)
+        indices = [chunk_indices for _, chunk_indices, _ in results]
+        # Rows of all chunks are stored as a single block, without copy
+        self._add_matrix_data(samples, np.concatenate(indices))
+
+    def _add_samples_with_checkpoints(self, act_keys, iterations, batch, processes, seed,
+                                      checkpoint_dir, checkpoint_size, samples_dir):
+        """Add samples for activities in chunks, checkpointing each chunk"""
+        checkpoint = CheckpointDirectory(checkpoint_dir, {
+            'database': self.database_name,
+            'biosphere': self.biosphere,
+            'iterations': iterations,
+            'engine': self.engine,
+            'dtype': str(self.dtype),
+            'seed': seed,
+        })
+        for samples, indices in checkpoint.load():
+            self._add_matrix_data(samples, indices)
+        completed = checkpoint.completed_activities()
+        act_keys = [key for key in act_keys if key not in completed]
+        if checkpoint.resumed and self.engine == 'presamples':
+            # Only activities of this run, others could be balanced concurrently
+            self.repair_activities(act_keys)
+        if completed:
+            self.instrumentation.message("Resuming run, {} activities already completed".format(len(completed)))
+        chunks = [act_keys[i:i + checkpoint_size] for i in range(0, len(act_keys), checkpoint_size)]
+        if processes and processes > 1 and chunks:
+            samples, results = self._generate_chunks_in_pool(
+                chunks, iterations, batch, checkpoint.seed, processes, samples_dir)
+            indices = []
+            for chunk, chunk_indices, rows in results:
+                checkpoint.write(chunk, samples[rows], chunk_indices)
+                indices.append(chunk_indices)
+            self._add_matrix_data(samples, np.concatenate(indices))
+            return
+        # Land exchanges are read once for the run, each chunk gets its slice
+        land_exchanges, plan = self._read_chunk_inputs(act_keys, batch)
+        for chunk in self.instrumentation.progress(chunks):
+            chunk, indices, samples = self._generate_chunk(
+                chunk, iterations, batch, checkpoint.seed,
+                *self._chunk_inputs(chunk, batch, land_exchanges, plan)
+            )
+            checkpoint.write(chunk, samples, indices)
+            if samples is not None:
+                self._add_matrix_data(samples, indices)
+
+    def _generate_chunk(self, act_keys, iterations, batch, seed, land_exchanges=None, plan=None):
+        """Return activity keys, integer-coded indices and samples of a chunk of activities"""
+        worker = copy.copy(self)
+        worker._store = SampleStore()
+        worker._add_samples_for_chunk(
+            act_keys, iterations, batch, seed, progress=False, land_exchanges=land_exchanges, plan=plan
+        )
+        return act_keys, worker._store.id_indices, worker.matrix_samples
+
+    def _read_chunk_inputs(self, act_keys, batch, plan=False):
+        """Return land exchanges and balancing plan of activities, read once for all their chunks
+
+        Land exchanges are read with the "numpy" engine or if `plan` is
+        True, and the plan is built from them in batch mode or if `plan` is
+        True. Either is None otherwise. See `_chunk_inputs` for the inputs
+        of each chunk.
+        """
+        land_exchanges = None
+        if self.data_source == 'database' and (self.engine == 'numpy' or plan):
+            with self.instrumentation.stage('load_exchanges'):
+                land_exchanges = self.load_land_exchanges(act_keys)
+        if batch or plan:
+            with self.instrumentation.stage('plan'):
+                plan = self.create_balancing_plan(act_keys, land_exchanges)
+        else:
+            plan = None
+        return land_exchanges, plan
+
+    def _chunk_inputs(self, act_keys, batch, land_exchanges, plan):
+        """Return land exchanges and plan of a chunk, sliced from those of `_read_chunk_inputs`
+
+        Only the input used to sample the chunk is returned, the other is None.
+        """
+        if batch:
+            return None, plan.subset(act_keys)
+        if self.engine == 'numpy':
+            return {key: land_exchanges[key] for key in act_keys if key in land_exchanges}, None
+        return None, None
+
+    def _generate_chunks_in_pool(self, chunks, iterations, batch, seed, processes, dirpath=None):
+        """Generate samples of chunks of activities in a pool of worker processes
+
+        Workers write samples directly into a memory-mapped array, at rows
+        assigned up front from the number of samples of each activity (see
+        `BalancingPlan.row_counts`), so that samples are neither pickled
+        back to this process nor copied. The array is created in `dirpath`,
+        see `sample_store.create_shared_samples`.
+
+        Land exchanges of all chunks are read once, and each worker gets
+        the slice of its chunk, see `_chunk_inputs`.
+
+        Returns the (rows, iterations) array of samples of all chunks, and a
+        generator yielding the activity keys, integer-coded indices and
+        slice of rows of each chunk, in chunk order, as chunks are completed.
+        Rows of a chunk are only filled once the chunk is yielded.
+        """
+        land_exchanges, plan = self._read_chunk_inputs(
+            [key for chunk in chunks for key in chunk], batch, plan=True)
+        row_counts = dict(zip(plan.act_keys, plan.row_counts().tolist()))
+        stops = np.cumsum([sum(row_counts.get(key, 0) for key in chunk) for chunk in chunks])
+        starts = np.r_[0, stops[:-1]]
+        samples, filepath = create_shared_samples((int(stops[-1]), iterations), self.dtype, dirpath)
+        args = []
+        for chunk, start, stop in zip(chunks, starts.tolist(), stops.tolist()):
+            worker = copy.copy(self)
+            worker._store = None
+            # Timings are sent back with the indices, events are not
+            worker.instrumentation = Instrumentation(ignore_event)
+            args.append((
+                worker, projects.current, chunk, iterations, batch, seed,
+                *self._chunk_inputs(chunk, batch, land_exchanges, plan), filepath, start, stop
+            ))
+        return samples, self._collect_chunks(samples, filepath, args, processes)
+
+    def _collect_chunks(self, samples, filepath, args, processes):
+        """Run `_generate_chunk_samples` for `args` in a pool, see `_generate_chunks_in_pool`"""
+        try:
+            with multiprocessing.Pool(processes) as pool:
+                results = pool.imap(_generate_chunk_samples, args)
+                for chunk_args, (indices, report) in self.instrumentation.progress(
+                        zip(args, results), total=len(args)):
+                    self.instrumentation.report.merge(report)
+                    start, stop = chunk_args[-2:]
+                    yield chunk_args[2], indices, slice(start, stop)
+        finally:
+            remove_shared_samples(samples, filepath)
+
+    def repair_activities(self, act_keys=None):
+        """Restore activities left half-processed by an interrupted run
+
+        The "presamples" engine temporarily moves formulas of exchanges to
+        `temp_formula` and activity parameters to `parameters_temp`, writes
+        balancing formulas and original amounts on land exchanges. An
+        interrupted run can leave activities in any of these states.
+        Repaired activities are left as if balancing had completed:
+        formulas, parameters and exchange amounts are restored, and
+        balancing formulas are moved to `land_formula`. Parameters are
+        balanced in a private workspace (see `parameter_workspace`), so
+        parameter groups of the project are never touched.
+
+        Parameters:
+        -----------
+           act_keys: list, optional
+               Keys of activities to check. All activities if None.
+
+        Returns the keys of repaired activities.
+        """
+        if self.read_only:
+            raise ValueError("Read-only balancers cannot repair the database")
+        candidates = set()
+        for data, in ActivityDataset.select(ActivityDataset.data).where(
+                ActivityDataset.database == self.database_name).tuples():
+            if 'parameters_temp' in data:
+                candidates.add((data['database'], data['code']))
+        for data, in ExchangeDataset.select(ExchangeDataset.data).where(
+                ExchangeDataset.output_database == self.database_name).tuples():
+            if 'temp_formula' in data or self._has_balancing_formula(data):
+                candidates.add(data['output'])
+        if act_keys is not None:
+            candidates.intersection_update(act_keys)
+
+        for act_key in sorted(candidates):
+            act = get_activity(act_key)
+            with sqlite3_lci_db.db.atomic('IMMEDIATE'):
+                for exc in list(act.exchanges()):
+                    changed = False
+                    if 'original_amount' in exc:
+                        exc['amount'] = exc['original_amount']
+                        del exc['original_amount']
+                        changed = True
+                    if self._has_balancing_formula(exc):
+                        exc['land_formula'] = exc['formula']
+                        del exc['formula']
+                        changed = True
+                    if 'temp_formula' in exc:
+                        exc['formula'] = exc['temp_formula']
+                        del exc['temp_formula']
+                        changed = True
+                    if changed:
+                        exc.save()
+                if 'parameters_temp' in act:
+                    act['parameters'] = act['parameters_temp']
+                    del act['parameters_temp']
+                    act.save()
+        if candidates:
+            self.instrumentation.message("Repaired {} half-processed activities".format(len(candidates)))
+        return sorted(candidates)
+
+    def _has_balancing_formula(self, exc):
+        """Return True if `exc` is a land exchange with a formula written for balancing"""
+        return (
+            exc['input'] in self.all_land_keys
+            and BALANCING_FORMULA.match(str(exc.get('formula', ''))) is not None
+        )
+
+    def _add_samples_for_chunk(self, act_keys, iterations, batch, seed, progress=True,
+                               land_exchanges=None, plan=None):
+        """Add samples and indices for a list of activities
+
+        Random numbers of each activity are drawn from a stream derived from `seed`.
+        Activities are read ahead by background threads, see `_prefetch_activities`.
+        Land exchanges (or, in batch mode, the plan) of the activities are
+        read from the database if not given.
+        """
+        if batch:
+            if plan is None:
+                self._add_samples_batch(iterations, act_keys, seed)
+            else:
+                self._add_samples_from_plan(plan, iterations, seed)
+            return
+        if self.engine == 'numpy' and land_exchanges is None:
+            with self.instrumentation.stage('load_exchanges'):
+                land_exchanges = self.load_land_exchanges(act_keys)
+        elif land_exchanges is None:
+            land_exchanges = {}
+        activities = self._prefetch_activities(act_keys)
+        if progress:
+            activities = self.instrumentation.progress(activities, total=len(act_keys))
+        for act_key, (activity, exchanges) in activities:
+            self.add_samples_for_act(
+                act_key, iterations, land_exchanges=land_exchanges.get(act_key, []), seed=seed,
+                activity=activity, exchanges=exchanges
+            )
+
+    def _prefetch_activities(self, act_keys):
+        """Yield activity keys with their activity and exchanges, read ahead in batches
+
+        Batches of `prefetch` activities are read by background threads, at
+        most two batches ahead of the activity being consumed, see
+        `utils.prefetch`. Exchanges are only read for the "presamples"
+        engine, and are None otherwise.
+        """
+        if not self.prefetch:
+            for act_key in act_keys:
+                yield act_key, (get_activity(act_key), None)
+            return
+        batches = [act_keys[i:i + self.prefetch] for i in range(0, len(act_keys), self.prefetch)]
+        for _, activities in prefetch(self._read_activities, batches, size=2):
+            yield from activities
+
+    def _read_activities(self, act_keys):
+        """Return activities and, with the "presamples" engine, their exchanges
+
+        Reads activities and exchanges of all activities with one query each.
+        Called from prefetching threads, which read the database with their
+        own connections. Land exchanges of the "numpy" engine are rather
+        read for all activities at once, see `load_land_exchanges`.
+        """
+        documents = {}
+        exchanges = {}
+        for database in {key[0] for key in act_keys}:
+            codes = [code for db, code in act_keys if db == database]
+            for document in ActivityDataset.select().where(
+                    ActivityDataset.database == database, ActivityDataset.code << codes):
+                documents[(database, document.code)] = document
+            if self.engine == 'presamples':
+                for document in ExchangeDataset.select().where(
+                        ExchangeDataset.output_database == database,
+                        ExchangeDataset.output_code << codes).order_by(ExchangeDataset.id):
+                    exchanges.setdefault((database, document.output_code), []).append(Exchange(document))
+        return [
+            (act_key, (
+                # Raises the usual error for missing activities
+                Activity(documents[act_key]) if act_key in documents else get_activity(act_key),
+                exchanges.get(act_key, []) if self.engine == 'presamples' else None
+            ))
+            for act_key in act_keys
+        ]
+
+    def _add_samples_batch(self, iterations, act_keys=None, seed=None):
+        """Add samples and indices for all activities with stacked arrays"""
+        with self.instrumentation.stage('plan'):
+            plan = self.create_balancing_plan(act_keys)
+        self._add_samples_from_plan(plan, iterations, seed)
+
+    def create_balancing_plan(self, act_keys=None, land_exchanges=None):
+        """Return the balancing plan of activities in database
+
+        The plan holds the land exchanges, strategy and static ratio of all
+        activities, see `BalancingPlan`. It can be saved, loaded and reused
+        with `add_samples_from_plan` until the inventory changes.
+
+        Parameters:
+        -----------
+           act_keys: list, optional
+               Keys of activities to include. All activities if None.
+           land_exchanges: dict, optional
+               Land exchanges of the activities, see `load_land_exchanges`.
+               Read from the database if None.
+        """
+        table = self._get_land_exchange_table(act_keys, land_exchanges)
+        return BalancingPlan(table, self._keys_from_ids, self.database_name, self.biosphere)
+
+    def add_samples_from_plan(self, plan, iterations, seed=None):
+        """Add samples and indices for all activities of a balancing plan
+
+        Samples are generated as in batch mode, but neither land exchanges nor
+        strategies are read from the database. With the same seed, samples
+        are the same as those of `add_samples_for_all_acts`.
+
+        Parameters:
+        -----------
+           plan: BalancingPlan
+               Plan created with `create_balancing_plan`, or loaded with
+               `BalancingPlan.load`
+           iterations: int
+               Number of iterations in generated samples
+           seed: int, optional
+               Master seed used to derive random number streams of activities
+        """
+        if self.engine != 'numpy':
+            raise ValueError("Sampling from a plan requires the 'numpy' engine")
+        if plan.database_name != self.database_name:
+            raise ValueError("Plan was created for database {}, not {}".format(
+                plan.database_name, self.database_name))
+        self._add_samples_from_plan(plan, iterations, seed)
+
+    def update_presamples(self, dirpath, previous_plan, plan=None, seed=None):
+        """Regenerate samples of activities that changed since a previous run
+
+        Activities whose land exchanges changed since `previous_plan` was
+        created are identified with content hashes, see
+        `BalancingPlan.changed_activities`. Samples of changed and removed
+        activities are removed from the presamples package, and new samples
+        are generated for changed activities only and added to the package.
+        The number of iterations is that of the package.
+
+        Save the current plan (the one returned by `create_balancing_plan`,
+        or `plan` if given) to update the package again in later runs.
+
+        Parameters:
+        -----------
+           dirpath: str
+               Directory of the presamples package created in the previous run
+           previous_plan: BalancingPlan
+               Plan of the previous run
+           plan: BalancingPlan, optional
+               Current plan. Created from the database if None.
+           seed: int, optional
+               Master seed used to derive random number streams of activities.
+               With the seed of the previous run, regenerated samples are the
+               same as if all samples were generated again.
+
+        Returns the id and directory path of the presamples package, and the
+        keys of activities whose samples were regenerated.
+        """
+        if self.engine != 'numpy':
+            raise ValueError("Updating presamples requires the 'numpy' engine")
+        if plan is None:
+            plan = self.create_balancing_plan()
+        for plan_ in (previous_plan, plan):
+            if plan_.database_name != self.database_name:
+                raise ValueError("Plan was created for database {}, not {}".format(
+                    plan_.database_name, self.database_name))
+        changed, removed = plan.changed_activities(previous_plan)
+        obsolete_keys = set(changed).union(removed)
+        obsolete_ids = {
+            id_ for keys_from_ids in (previous_plan.keys_from_ids, plan.keys_from_ids)
+            for id_, key in keys_from_ids.items() if key in obsolete_keys
+        }
+        with open(Path(dirpath) / "datapackage.json", encoding='utf-8') as f:
+            iterations = json.load(f)['ncols']
+
+        worker = copy.copy(self)
+        worker._store = SampleStore()
+        if changed:
+            worker._add_samples_from_plan(plan.subset(changed), iterations, seed)
+        with self.instrumentation.stage('write_presamples'):
+            id_, dirpath = splice_presamples_package(
+                dirpath, obsolete_ids, worker.matrix_samples, worker._store.id_indices
+            )
+        self.instrumentation.message(
+            "Samples of {} activities updated in presamples with id_ {}".format(len(obsolete_keys), id_))
+        return id_, dirpath, changed
+
+    def create_presamples_in_blocks(self, iterations, block_size=5000, plan=None, seed=None,
+                                    name=None, id_=None, overwrite=False, dirpath=None,
+                                    presamples_seed='sequential'):
+        """Generate samples in blocks of iterations, written directly to a presamples package
+
+        Samples of all activities are generated for `block_size` iterations
+        at a time, as in batch mode, and each block is written to its columns
+        in the samples file of the package before the next block is
+        generated, see `sample_store.BlockPresamplesWriter`. Peak memory
+        use therefore depends on the block size, not on the number of
+        iterations.
+
+        The random number stream of each activity is advanced to the first
+        iteration of each block, so that samples do not depend on the block
+        size. This holds for all uncertainty types with an inverse
+        distribution function (see `array_balancer.uniforms_to_samples`);
+        samples of other types depend on the block size.
+
         Parameters:
         -----------
            iterations: int
                Number of iterations in generated samples
+           block_size: int, default=5000
+               Number of iterations generated at a time
+           plan: BalancingPlan, optional
+               Plan of the activities to sample. Created from the database if None.
+           seed: int, optional
+               Master seed used to derive random number streams of activities
+           name: str, optional
+               A human-readable name for these samples.
+           \\id_: str, optional
+               Unique id for this collection of presamples. Optional, generated automatically if not set.
+           overwrite: bool, default=False
+               If True, replace an existing presamples package with the same ``\\id_`` if it exists.
+           dirpath: str, optional
+               An optional directory path where presamples can be created. If None, a subdirectory in the ``project`` folder.
+           presamples_seed: {None, int, "sequential"}, optional, default="sequential"
+               Seed used by indexer to return array columns in random order. Can be an integer, "sequential" or None.
+        """
+        if self.engine != 'numpy':
+            raise ValueError("Block generation requires the 'numpy' engine")
+        if plan is None:
+            with self.instrumentation.stage('plan'):
+                plan = self.create_balancing_plan()
+        elif plan.database_name != self.database_name:
+            raise ValueError("Plan was created for database {}, not {}".format(
+                plan.database_name, self.database_name))
+        if seed is None:
+            seed = np.random.SeedSequence().entropy
+        blocks = [indices for _, indices in self._plan_samples(plan, 0, seed, indices_only=True)]
+        if not blocks:
+            warnings.warn("No presamples created because there were no matrix data.")
+            return
+        writer = BlockPresamplesWriter(
+            np.concatenate(blocks), iterations, name=name, id_=id_, overwrite=overwrite,
+            dirpath=dirpath, seed=presamples_seed, dtype=self.dtype
+        )
+        for first_iteration in self.instrumentation.progress(range(0, iterations, block_size)):
+            block_iterations = min(block_size, iterations - first_iteration)
+            samples = np.concatenate([
+                block_samples for block_samples, _ in self._plan_samples(
+                    plan, block_iterations, seed, first_iteration)
+            ], axis=0)
+            with self.instrumentation.stage('write_presamples'):
+                writer.write(first_iteration, samples)
+        with self.instrumentation.stage('write_presamples'):
+            id_, dirpath = writer.finalize()
+        self.instrumentation.message("Presamples with id_ {} written at {}".format(id_, dirpath))
+        return id_, dirpath
 
+    def _add_samples_from_plan(self, plan, iterations, seed=None):
+        """Add samples and indices for all activities of plan with stacked arrays"""
+        if seed is None:
+            seed = np.random.SeedSequence().entropy
+        for samples, indices in self._plan_samples(plan, iterations, seed):
+            with self.instrumentation.stage('store'):
+                self._add_matrix_data(samples, indices)
+
+    def _plan_samples(self, plan, iterations, seed, first_iteration=0, indices_only=False):
+        """Generate samples and indices of activities of plan, balanced ones first
+
+        Samples are those of iterations `first_iteration` to
+        `first_iteration + iterations`. If `indices_only`, samples are None.
         """
-        act_keys = [act.key for act in Database(self.database_name)]
-        for act_key in pyprind.prog_bar(act_keys):
-            self.add_samples_for_act(get_activity(act_key), iterations)
+        if not len(plan):
+            return
+        row_strategies = plan.row_strategies()
+
+        balanced_acts = np.isin(plan.strategies, ['default', 'inverse'])
+        balanced = np.isin(row_strategies, ['default', 'inverse'])
+        if balanced.any():
+            if indices_only:
+                yield None, plan.id_indices(balanced)
+            else:
+                starts = segment_starts(plan.table['output'][balanced])
+                counts = plan.counts[balanced_acts]
+                balanced_act_keys = [key for key, is_balanced in zip(plan.act_keys, balanced_acts) if is_balanced]
+                with self.instrumentation.stage('draw'):
+                    samples = draw_segment_samples(
+                        plan.table[balanced], iterations, starts,
+                        (activity_random_state(seed, act_key, first_iteration * count)
+                         for act_key, count in zip(balanced_act_keys, counts))
+                    )
+                with self.instrumentation.stage('rebalance'):
+                    rebalance_segments(
+                        samples, plan.in_mask[balanced], plan.out_mask[balanced],
+                        plan.uncertain_mask[balanced], plan.strategies[balanced_acts],
+                        plan.static_ratios[balanced_acts], starts
+                    )
+                samples = self._downcast(
+                    None, samples, plan.in_mask[balanced], plan.out_mask[balanced],
+                    plan.strategies[balanced_acts], plan.static_ratios[balanced_acts], starts
+                )
+                yield samples, plan.id_indices(balanced)
+
+        # Only the variable exchange is overridden, with its static value
+        static = (row_strategies == 'set_static') & plan.uncertain_mask
+        if static.any():
+            samples = None if indices_only else np.repeat(
+                plan.table['amount'][static].astype(self.dtype).reshape(-1, 1), iterations, axis=1)
+            yield samples, plan.id_indices(static)
+
+    def _get_land_exchange_table(self, act_keys=None, land_exchanges=None):
+        """Return land exchange table of activities in database
+
+        See `array_balancer.land_exchange_table`. Also stores the keys
+        associated with table ids in `_keys_from_ids`.
+
+        Parameters:
+        -----------
+           act_keys: list, optional
+               Keys of activities to include. All activities if None.
+           land_exchanges: dict, optional
+               Land exchanges of the activities, see `load_land_exchanges`.
+               Read from the database if None.
+        """
+        if self.data_source == 'processed':
+            return self._get_processed_land_exchange_table(act_keys)
+        if act_keys is None:
+            act_keys = self._get_act_keys()
+        if land_exchanges is None:
+            land_exchanges = self.load_land_exchanges(act_keys)
+        exchanges = [exc for act_key in act_keys for exc in land_exchanges.get(act_key, [])]
+        self._keys_from_ids = {
+            mapping[key]: key
+            for key in set(exc['input'] for exc in exchanges).union(
+                exc['output'] for exc in exchanges)
+        }
+        return land_exchange_table(
+            exchanges,
+            [mapping[exc['input']] for exc in exchanges],
+            [mapping[exc['output']] for exc in exchanges],
+            [self.land_types[exc['input']] for exc in exchanges],
+        )
+
+    def _get_processed_land_exchange_table(self, act_keys=None):
+        """Return land exchange table built from the processed array of the database
+
+        Rows are ordered by activity key, as when reading from the database.
+        Also stores the keys associated with table ids in `_keys_from_ids`.
+        """
+        array = self._load_processed_array()
+        land_keys_from_ids = {mapping[key]: key for key in self.all_land_keys}
+        activity_keys_from_ids = self._get_activity_keys_from_ids()
+        table = processed_land_exchange_table(
+            array,
+            [mapping[key] for key in self.land_in_keys],
+            [mapping[key] for key in self.land_out_keys],
+            None if act_keys is None else [mapping[key] for key in act_keys],
+        )
+        output_ids = np.unique(table['output'])
+        key_order = sorted(range(len(output_ids)), key=lambda i: activity_keys_from_ids[output_ids[i]])
+        ranks = np.empty(len(output_ids), dtype=np.intp)
+        ranks[key_order] = np.arange(len(output_ids))
+        table = table[np.argsort(ranks[np.searchsorted(output_ids, table['output'])], kind='stable')]
+        self._keys_from_ids = land_keys_from_ids
+        self._keys_from_ids.update((id_, activity_keys_from_ids[id_]) for id_ in output_ids)
+        return table
+
+    def _load_processed_array(self):
+        """Return processed array of the database, memory-mapped"""
+        if databases[self.database_name].get('dirty'):
+            warnings.warn("Database {} was modified since it was processed, "
+                          "processed data may be out of date".format(self.database_name))
+        return np.load(Database(self.database_name).filepath_processed(), mmap_mode='r')
+
+    def _get_activity_keys_from_ids(self):
+        """Return dictionary of activity keys of database, with mapped ids as keys"""
+        return {id_: key for key, id_ in mapping.items() if key[0] == self.database_name}
+
+    def _get_act_keys(self):
+        """Return sorted keys of activities in database
+
+        Databases are iterated in random order, hence the sort.
+        """
+        if self.data_source == 'processed':
+            activity_keys_from_ids = self._get_activity_keys_from_ids()
+            return sorted(
+                activity_keys_from_ids[id_]
+                for id_ in np.unique(self._load_processed_array()['output'])
+            )
+        return sorted(act.key for act in Database(self.database_name))
+
+    def load_land_exchanges(self, act_keys=None):
+        """Return land exchanges of activities in database, read with as few queries as possible
+
+        Returns a dictionary with activity keys as keys and lists of land
+        exchange dictionaries as values. Activities without land exchanges
+        are not included. Exchanges of an activity are in database order.
+
+        All land exchanges of the database are read with a single query. If
+        `act_keys` is given, only exchanges of these activities are read,
+        with one query per batch of activities, to stay below the SQLite
+        limit on the number of variables of a statement.
+
+        Parameters:
+        -----------
+           act_keys: list, optional
+               Keys of activities to include. All activities if None.
+        """
+        land_keys = self.all_land_keys
+        land_codes = sorted(code for _, code in land_keys)
+        conditions = [
+            ExchangeDataset.output_database == self.database_name,
+            ExchangeDataset.input_database == self.biosphere,
+            ExchangeDataset.input_code << land_codes,
+        ]
+        if act_keys is None:
+            queries = [ExchangeDataset.select(ExchangeDataset.data).where(*conditions)]
+        else:
+            codes = sorted({code for database, code in act_keys if database == self.database_name})
+            batch_size = max(SQLITE_MAX_VARIABLES - len(land_codes) - len(conditions), 1)
+            queries = [
+                ExchangeDataset.select(ExchangeDataset.data).where(
+                    ExchangeDataset.output_code << codes[start:start + batch_size], *conditions
+                )
+                for start in range(0, len(codes), batch_size)
+            ]
+        land_exchanges = {}
+        for query in queries:
+            for data, in query.order_by(ExchangeDataset.id).tuples():
+                if data['input'] not in land_keys:
+                    continue
+                land_exchanges.setdefault(data['output'], []).append(data)
+        return land_exchanges
+
+    @property
+    def timing_report(self):
+        return self.instrumentation.report
+
+    @property
+    def matrix_samples(self):
+        return self._store.samples
+
+    @property
+    def matrix_indices(self):
+        return self._store.indices
+
+    def _add_matrix_data(self, samples, indices):
+        """Store samples and associated matrix indices
+
+        Samples are appended to a `SampleStore`, so that previously stored
+        samples are not copied every time samples are added. They are
+        stored with the floating point type `dtype`.
+        """
+        self._store.append(samples.astype(self.dtype, copy=False), indices)
+
+    def _downcast(self, strategy, samples, in_mask, out_mask, strategies, static_ratios, starts):
+        """Return samples cast to `dtype`, see `array_balancer.downcast_samples`
+
+        `strategy` is that of the activity, if samples are of a single activity.
+        """
+        if samples.dtype == self.dtype:
+            return samples
+        with self.instrumentation.stage('downcast', strategy):
+            return downcast_samples(
+                samples, self.dtype, in_mask, out_mask, strategies, static_ratios, starts,
+                self.ratio_tolerance
+            )
+
+    def stream_presamples(self, name=None, id_=None, overwrite=False, dirpath=None,
+                          seed='sequential', buffer_size=2**27):
+        """Write samples to a presamples package as they are generated
+
+        Must be called before samples are generated. Samples are then
+        buffered and written to disk in chunks instead of being accumulated
+        in memory, see `StreamingSampleStore`. Call `create_presamples` once
+        all samples are generated to finalize the package.
+
+        Parameters
+        -----------
+           name: str, optional
+               A human-readable name for these samples.
+           \\id_: str, optional
+               Unique id for this collection of presamples. Optional, generated automatically if not set.
+           overwrite: bool, default=False
+               If True, replace an existing presamples package with the same ``\\id_`` if it exists.
+           dirpath: str, optional
+               An optional directory path where presamples can be created. If None, a subdirectory in the ``project`` folder.
+           seed: {None, int, "sequential"}, optional, default="sequential"
+               Seed used by indexer to return array columns in random order. Can be an integer, "sequential" or None.
+           buffer_size: int, default=2**27
+               Approximate size, in bytes, of samples held in memory before being written
+        """
+        if len(self._store):
+            raise ValueError("Samples were already generated, call `stream_presamples` first")
+        self._store = StreamingSampleStore(
+            name=name, id_=id_, overwrite=overwrite, dirpath=dirpath,
+            seed=seed, buffer_size=buffer_size
+        )
 
     def create_presamples(self, name=None, id_=None, overwrite=False, dirpath=None,
                             seed='sequential'):
         """Create a presamples package from generated samples
 
+        If samples were streamed to disk (see `stream_presamples`), the
+        streamed package is finalized instead, and the arguments passed
+        to `stream_presamples` are used.
+
         Parameters
         -----------
            name: str, optional
@@ -152,14 +1051,54 @@ class DatabaseLandBalancer():
            seed: {None, int, "sequential"}, optional, default="sequential"
                Seed used by indexer to return array columns in random order. Can be an integer, "sequential" or None.
         """
-        if not all([self.matrix_samples is not None, self.matrix_indices]):
+        if not len(self._store):
             warnings.warn("No presamples created because there were no matrix data. "
                       "Make sure to run `add_samples_for_all_acts` or "
                       "`add_samples_for_act` for a set of acts first.")
             return
 
-        id_, dirpath = create_presamples_package(
-            matrix_data=split_inventory_presamples(self.matrix_samples, self.matrix_indices),
-            name=name, id_=id_, overwrite=overwrite, dirpath=dirpath, seed=seed)
-        print("Presamples with id_ {} written at {}".format(id_, dirpath))
+        if isinstance(self._store, StreamingSampleStore):
+            with self.instrumentation.stage('write_presamples'):
+                id_, dirpath = self._store.finalize()
+            self.instrumentation.message("Presamples with id_ {} written at {}".format(id_, dirpath))
+            return id_, dirpath
+
+        # Integer-coded indices are formatted with array operations, rather
+        # than row by row by `create_presamples_package`
+        with self.instrumentation.stage('write_presamples'):
+            store = StreamingSampleStore(
+                name=name, id_=id_, overwrite=overwrite, dirpath=dirpath, seed=seed
+            )
+            store.append(self.matrix_samples, self._store.id_indices)
+            id_, dirpath = store.finalize()
+        self.instrumentation.message("Presamples with id_ {} written at {}".format(id_, dirpath))
         return id_, dirpath
+
+
+def _generate_chunk_samples(args):
+    """Generate samples for a chunk of activities in a worker process
+
+    Samples are written to rows `start:stop` of the memory-mapped array of
+    samples in `filepath`, see `sample_store.create_shared_samples`.
+    Returns the integer-coded matrix indices of the chunk, which are much
+    cheaper to send back than indices with keys, and the timing report of
+    the worker. Land exchanges or plan of the chunk are those sent by the
+    parent process, see `DatabaseLandBalancer._chunk_inputs`.
+    """
+    (balancer, project, act_keys, iterations, batch, seed, land_exchanges, plan,
+     filepath, start, stop) = args
+    # Make sure the worker works in the right project, with its own connections
+    projects.set_current(project, writable=not balancer.read_only, update=False)
+    if balancer.read_only:
+        # Not done by `set_current` if projects are not lockable. Only
+        # guards project metadata: writes to the inventory are rather
+        # rejected by `ActivityLandBalancer._check_writable`
+        projects.read_only = True
+    balancer._store = PreallocatedSampleStore(np.load(filepath, mmap_mode='r+')[start:stop])
+    balancer._add_samples_for_chunk(
+        act_keys, iterations, batch, seed, progress=False, land_exchanges=land_exchanges, plan=plan
+    )
+    if len(balancer._store) != stop - start:
+        raise ValueError("Expected {} rows of samples for activities {}, got {}".format(
+            stop - start, act_keys, len(balancer._store)))
+    return balancer._store.id_indices, balancer.timing_report
@@ -0,0 +1,140 @@
+import contextlib
+import time
+import pyprind
+
+
+class TimingReport():
+    """Cumulative time and number of calls of each stage of a balancing run
+
+    Stages are named steps of the balancing pipeline, e.g. "recalculate" or
+    "calculate_stochastic" for the "presamples" engine, or "draw" and
+    "rebalance" for the "numpy" engine. Stages run for an activity with a
+    known strategy are also recorded for that strategy.
+
+    Attributes:
+    -----------
+       stages: dict
+           Number of calls and cumulative time of each stage, as
+           {stage: {'calls': int, 'seconds': float}}
+       strategies: dict
+           Same as `stages`, for each strategy, as {strategy: {stage: {...}}}
+    """
+    def __init__(self):
+        self.stages = {}
+        self.strategies = {}
+
+    def add(self, stage, seconds, strategy=None, calls=1):
+        """Record `calls` calls of `stage` that took `seconds` in total"""
+        records = [self.stages]
+        if strategy is not None:
+            records.append(self.strategies.setdefault(strategy, {}))
+        for record in records:
+            timing = record.setdefault(stage, {'calls': 0, 'seconds': 0.0})
+            timing['calls'] += calls
+            timing['seconds'] += seconds
+
+    def merge(self, other):
+        """Add timings of another report, e.g. of a worker process"""
+        for stage, timing in other.stages.items():
+            self.add(stage, timing['seconds'], calls=timing['calls'])
+        for strategy, stages in other.strategies.items():
+            for stage, timing in stages.items():
+                record = self.strategies.setdefault(strategy, {}).setdefault(
+                    stage, {'calls': 0, 'seconds': 0.0})
+                record['calls'] += timing['calls']
+                record['seconds'] += timing['seconds']
+
+    def as_dict(self):
+        """Return report as a JSON-serializable dictionary"""
+        return {
+            'stages': {stage: dict(timing) for stage, timing in self.stages.items()},
+            'strategies': {
+                strategy: {stage: dict(timing) for stage, timing in stages.items()}
+                for strategy, stages in self.strategies.items()
+            },
+        }
+
+    def __str__(self):
+        rows = [("stage", "calls", "seconds")]
+        for stage, timing in sorted(self.stages.items(), key=lambda item: -item[1]['seconds']):
+            rows.append((stage, str(timing['calls']), "{:.3f}".format(timing['seconds'])))
+        widths = [max(len(row[i]) for row in rows) for i in range(3)]
+        return "\n".join(
+            "{}  {}  {}".format(row[0].ljust(widths[0]), row[1].rjust(widths[1]), row[2].rjust(widths[2]))
+            for row in rows
+        )
+
+
+class ConsoleReporter():
+    """Default event callback: prints messages and shows progress bars"""
+    def __init__(self):
+        self._bar = None
+
+    def __call__(self, event):
+        if event['event'] == 'message':
+            print(event['message'])
+        elif event['event'] == 'progress':
+            if event['done'] == 0:
+                self._bar = pyprind.ProgBar(event['total']) if event['total'] else None
+            elif self._bar is not None:
+                self._bar.update()
+
+
+def ignore_event(event):
+    """Event callback that does nothing"""
+
+
+class Instrumentation():
+    """Times stages of a balancing run and sends events to a callback
+
+    Events are dictionaries, with an `event` key giving their kind:
+
+    - "stage": a stage ended, with keys `stage`, `seconds` and `strategy`
+      (None if not known)
+    - "message": information on the run, with key `message`
+    - "progress": with keys `done` and `total`, sent with `done=0` before
+      the first item and after each item
+
+    Parameters:
+    -----------
+       callback: callable, optional
+           Function called with each event. If None, messages are printed
+           and progress is shown with a progress bar, see `ConsoleReporter`.
+
+    Attributes:
+    -----------
+       report: TimingReport
+           Cumulative timings of all stages run so far
+    """
+    def __init__(self, callback=None):
+        self.callback = ConsoleReporter() if callback is None else callback
+        self.report = TimingReport()
+
+    def emit(self, event, **data):
+        """Send an event to the callback"""
+        data['event'] = event
+        self.callback(data)
+
+    def message(self, message):
+        """Send a "message" event"""
+        self.emit('message', message=message)
+
+    @contextlib.contextmanager
+    def stage(self, name, strategy=None):
+        """Context manager timing a stage, recorded even if an exception is raised"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            self.report.add(name, seconds, strategy)
+            self.emit('stage', stage=name, seconds=seconds, strategy=strategy)
+
+    def progress(self, iterable, total=None):
+        """Yield items of `iterable`, sending "progress" events"""
+        if total is None:
+            total = len(iterable)
+        self.emit('progress', done=0, total=total)
+        for done, item in enumerate(iterable, 1):
+            yield item
+            self.emit('progress', done=done, total=total)
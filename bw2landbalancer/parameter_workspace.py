@@ -0,0 +1,40 @@
+import contextlib
+from peewee import SqliteDatabase
+from bw2data.parameters import (
+    ActivityParameter, DatabaseParameter, Group, GroupDependency, ParameterizedExchange,
+    ProjectParameter
+)
+
+# Models stored in the project's parameters.db
+PARAMETER_MODELS = [
+    DatabaseParameter, ProjectParameter, ActivityParameter,
+    ParameterizedExchange, Group, GroupDependency
+]
+
+
+@contextlib.contextmanager
+def parameter_workspace():
+    """Context manager binding Brightway parameter tables to a scratch in-memory database
+
+    Within the context, Brightway parameter functions (e.g.
+    `parameters.new_activity_parameters`, `ActivityParameter.recalculate`)
+    and presamples' `ParameterizedBrightwayModel` read and write empty
+    in-memory parameter tables, with the same triggers as the project's
+    `parameters.db`. Project and database parameters are not visible, so
+    recalculations only cover parameters added within the context, and
+    the project's parameters are never modified. The workspace is
+    discarded on exit.
+
+    Exchanges and activities are not parameter tables: they are still read
+    from and written to the project's inventory database.
+
+    Models are rebound for the whole process, and in-memory databases are
+    per thread: the workspace must not be shared between threads.
+    """
+    db = SqliteDatabase(':memory:')
+    with db.bind_ctx(PARAMETER_MODELS):
+        try:
+            db.create_tables(PARAMETER_MODELS)
+            yield db
+        finally:
+            db.close()
@@ -0,0 +1,688 @@
+import json
+import os
+import tempfile
+import uuid
+import weakref
+from pathlib import Path
+import numpy as np
+from bw2data import mapping, projects
+from bw2data.utils import TYPE_DICTIONARY
+from presamples.packaging import (
+    get_presample_directory, format_matrix_data, collapse_matrix_indices,
+    MAX_SIGNED_32BIT_INT
+)
+from presamples.utils import md5
+
+INDICES_DTYPE = [('input', object), ('output', object), ('type', 'U20')]
+ID_INDICES_DTYPE = [('input', np.uint32), ('output', np.uint32), ('type', np.uint8)]
+
+# Subdirectory of the project directory where shared samples are created by default
+SHARED_SAMPLES_DIRECTORY = 'land_balancer_samples'
+
+# Approximate size, in bytes, of the blocks of rows in which samples files are written
+WRITE_BLOCK_SIZE = 2**27
+
+
+def encode_indices(indices):
+    """Return integer-coded matrix indices
+
+    Keys are replaced by their mapped ids, and types by their code in
+    `TYPE_DICTIONARY`. Integer-coded indices are returned as is.
+
+    Parameters:
+    -----------
+       indices: list or numpy structured array
+           Matrix indices, as (input key, output key, type), one per row
+    """
+    if isinstance(indices, np.ndarray) and indices.dtype == np.dtype(ID_INDICES_DTYPE):
+        return indices
+    return np.array([
+        (mapping[input_key], mapping[output_key], TYPE_DICTIONARY.get(kind, kind))
+        for input_key, output_key, kind in indices
+    ], dtype=ID_INDICES_DTYPE).reshape(-1)
+
+
+def decode_indices(id_indices, keys_from_ids=None):
+    """Return matrix indices with keys, from integer-coded matrix indices
+
+    Parameters:
+    -----------
+       id_indices: numpy structured array
+           Integer-coded matrix indices, see `encode_indices`
+       keys_from_ids: dict, optional
+           Keys of mapped ids. Built from `mapping` if None.
+    """
+    if keys_from_ids is None:
+        keys_from_ids = {id_: key for key, id_ in mapping.items()}
+    types = {value: label for label, value in TYPE_DICTIONARY.items()}
+    return np.array([
+        (keys_from_ids[input_id], keys_from_ids[output_id], types[kind])
+        for input_id, output_id, kind in id_indices.tolist()
+    ], dtype=INDICES_DTYPE).reshape(-1)
+
+
+def format_id_indices(samples, id_indices):
+    """Split samples by matrix and format integer-coded indices for presamples
+
+    Vectorized equivalent of presamples' `split_inventory_presamples` and
+    `format_matrix_data`, which format indices one row at a time. Returns a
+    list of (samples, formatted indices, metadata, kind), one per matrix.
+    If all rows are of the same matrix, samples are returned as is, without
+    copy, e.g. still memory-mapped.
+
+    Parameters:
+    -----------
+       samples: numpy array
+           (rows, iterations) array of samples
+       id_indices: numpy structured array
+           Integer-coded matrix indices, see `encode_indices`
+    """
+    biosphere = id_indices['type'] == TYPE_DICTIONARY['biosphere']
+    matrix_data = []
+    for kind, mask in (('biosphere', biosphere), ('technosphere', ~biosphere)):
+        if not mask.any():
+            continue
+        empty, metadata = format_matrix_data([], kind)
+        indices = np.zeros(int(mask.sum()), dtype=empty.dtype)
+        indices['input'] = id_indices['input'][mask]
+        indices['output'] = id_indices['output'][mask]
+        indices['row'] = indices['col'] = MAX_SIGNED_32BIT_INT
+        if 'type' in indices.dtype.names:
+            indices['type'] = id_indices['type'][mask]
+        matrix_data.append((samples if mask.all() else samples[mask], indices, metadata, kind))
+    return matrix_data
+
+
+def write_matrix_resources(samples, id_indices, dirpath, first_index, id_):
+    """Write samples as matrix resources of a presamples package, one per matrix
+
+    As in `create_presamples_package`, samples of repeated matrix cells are
+    summed. Returns the list of resource descriptions.
+    """
+    resources = []
+    for kind_samples, kind_indices, metadata, kind in format_id_indices(samples, id_indices):
+        kind_samples, kind_indices = collapse_matrix_indices(kind_samples, kind_indices, kind)
+        resources.append(_write_matrix_data(
+            kind_samples, kind_indices, metadata, kind, dirpath,
+            first_index + len(resources), id_
+        ))
+    return resources
+
+
+def save_samples(filepath, samples, block_size=None):
+    """Save samples to a `.npy` file, in blocks of rows
+
+    Same file as `numpy.save`, but rows are written `block_size` bytes
+    (`WRITE_BLOCK_SIZE` if None) at a time, so that samples that are not in
+    memory (e.g. memory-mapped) are never read, or copied, all at once.
+    """
+    if block_size is None:
+        block_size = WRITE_BLOCK_SIZE
+    header = {
+        'descr': np.lib.format.dtype_to_descr(samples.dtype),
+        'fortran_order': False,
+        'shape': samples.shape,
+    }
+    rows = max(1, block_size // max(samples[:1].nbytes, 1))
+    with open(filepath, 'wb') as f:
+        np.lib.format.write_array_header_1_0(f, header)
+        for start in range(0, len(samples), rows):
+            np.ascontiguousarray(samples[start:start + rows]).tofile(f)
+
+
+def _write_matrix_data(samples, indices, metadata, kind, dirpath, index, id_):
+    """Same as presamples' `write_matrix_data`, with samples written by `save_samples`"""
+    samples_fp = "{}.{}.samples.npy".format(id_, index)
+    indices_fp = "{}.{}.indices.npy".format(id_, index)
+    save_samples(dirpath / samples_fp, samples)
+    np.save(dirpath / indices_fp, indices, allow_pickle=False)
+    resource = {
+        'type': kind,
+        'samples': {
+            'filepath': samples_fp,
+            'md5': md5(dirpath / samples_fp),
+            'shape': samples.shape,
+            'dtype': str(samples.dtype),
+            "format": "npy",
+            "mediatype": "application/octet-stream",
+        },
+        'index': index,
+        'indices': {
+            'filepath': indices_fp,
+            'md5': md5(dirpath / indices_fp),
+            "format": "npy",
+            "mediatype": "application/octet-stream",
+        },
+        "profile": "data-resource",
+    }
+    resource.update(metadata)
+    return resource
+
+
+class SampleStore():
+    """Growable store of balanced samples and associated matrix indices
+
+    Samples and indices are appended in blocks (e.g. one per activity) and
+    are only consolidated into single arrays when accessed. Previously stored
+    samples are therefore not copied every time a block is added, and time
+    and memory use are linear in the number of stored rows.
+
+    Indices are stored integer-coded (see `encode_indices`), which is much
+    more compact than tuples of keys, and are only converted back to keys
+    when `indices` is accessed. Converted indices are kept until the next
+    block is added.
+
+    Attributes:
+    -----------
+       samples: numpy array
+           (rows, iterations) array of all samples, or None if empty
+       indices: numpy structured array
+           Matrix indices of samples, with fields `input` (key), `output`
+           (key) and `type` (e.g. 'biosphere')
+       id_indices: numpy structured array
+           Integer-coded matrix indices of samples, with fields `input`
+           (mapped id), `output` (mapped id) and `type` (code)
+    """
+    def __init__(self):
+        self._sample_blocks = []
+        self._index_blocks = []
+        self._indices = None
+
+    def __len__(self):
+        return sum(len(block) for block in self._index_blocks)
+
+    def append(self, samples, indices):
+        """Add a block of samples and associated matrix indices
+
+        Parameters:
+        -----------
+           samples: numpy array
+               (rows, iterations) array of samples
+           indices: list or numpy structured array
+               Matrix indices, as (input key, output key, type), one per
+               row, or integer-coded matrix indices
+        """
+        indices = encode_indices(indices)
+        if samples.shape[0] != len(indices):
+            raise ValueError("Got {} rows of samples but {} indices".format(
+                samples.shape[0], len(indices)))
+        if not len(indices):
+            return
+        if self._sample_blocks and samples.shape[1] != self._sample_blocks[0].shape[1]:
+            raise ValueError("Expected {} iterations, got {}".format(
+                self._sample_blocks[0].shape[1], samples.shape[1]))
+        self._sample_blocks.append(samples)
+        self._index_blocks.append(indices)
+        self._indices = None
+
+    @property
+    def samples(self):
+        if not self._sample_blocks:
+            return None
+        self._consolidate()
+        return self._sample_blocks[0]
+
+    @property
+    def indices(self):
+        if not self._index_blocks:
+            return np.zeros(0, dtype=INDICES_DTYPE)
+        if self._indices is None:
+            self._indices = decode_indices(self.id_indices)
+        return self._indices
+
+    @property
+    def id_indices(self):
+        if not self._index_blocks:
+            return np.zeros(0, dtype=ID_INDICES_DTYPE)
+        self._consolidate()
+        return self._index_blocks[0]
+
+    def _consolidate(self):
+        """Replace stored blocks by a single block"""
+        if len(self._sample_blocks) > 1:
+            self._sample_blocks = [np.concatenate(self._sample_blocks, axis=0)]
+            self._index_blocks = [np.concatenate(self._index_blocks)]
+
+
+class PreallocatedSampleStore():
+    """Store writing samples into consecutive rows of a preallocated array
+
+    Used by worker processes to write samples directly into their rows of
+    an array shared with the parent process, see `create_shared_samples`.
+    Appending more rows than preallocated raises a ValueError.
+
+    Parameters:
+    -----------
+       samples: numpy array
+           (rows, iterations) array where samples are written, e.g. a slice
+           of a memory-mapped array
+
+    Attributes:
+    -----------
+       samples: numpy array
+           Rows of the array written so far
+       indices: numpy structured array
+           Matrix indices of written samples, with keys
+       id_indices: numpy structured array
+           Integer-coded matrix indices of written samples
+    """
+    def __init__(self, samples):
+        self._samples = samples
+        self._rows = 0
+        self._index_blocks = []
+
+    def __len__(self):
+        return self._rows
+
+    def append(self, samples, indices):
+        """Write a block of samples to the next rows, see `SampleStore.append`"""
+        indices = encode_indices(indices)
+        if samples.shape[0] != len(indices):
+            raise ValueError("Got {} rows of samples but {} indices".format(
+                samples.shape[0], len(indices)))
+        if samples.shape[1] != self._samples.shape[1]:
+            raise ValueError("Expected {} iterations, got {}".format(
+                self._samples.shape[1], samples.shape[1]))
+        if self._rows + len(indices) > len(self._samples):
+            raise ValueError("Got more than the {} preallocated rows of samples".format(
+                len(self._samples)))
+        self._samples[self._rows:self._rows + len(indices)] = samples
+        self._rows += len(indices)
+        self._index_blocks.append(indices)
+
+    @property
+    def samples(self):
+        return self._samples[:self._rows]
+
+    @property
+    def indices(self):
+        return decode_indices(self.id_indices)
+
+    @property
+    def id_indices(self):
+        if not self._index_blocks:
+            return np.zeros(0, dtype=ID_INDICES_DTYPE)
+        return np.concatenate(self._index_blocks)
+
+
+def create_shared_samples(shape, dtype, dirpath=None):
+    """Return a memory-mapped array of samples in a temporary file, and the file path
+
+    Other processes can open the file with `numpy.load(filepath,
+    mmap_mode='r+')` and write samples into the array, which this process
+    then reads without copying them. Once they are done, call
+    `remove_shared_samples`.
+
+    The file holds all samples, and is therefore created on disk rather
+    than in the system temporary directory, which is often in memory.
+
+    Parameters:
+    -----------
+       shape: tuple
+           (rows, iterations) shape of the array
+       dtype: numpy dtype
+           Data type of samples
+       dirpath: str, optional
+           Directory of the file, created if needed. A subdirectory of the
+           project directory if None.
+    """
+    if dirpath is None:
+        dirpath = os.path.join(projects.dir, SHARED_SAMPLES_DIRECTORY)
+    # Other processes may create the directory at the same time
+    os.makedirs(dirpath, exist_ok=True)
+    fd, filepath = tempfile.mkstemp(prefix="bw2landbalancer_", suffix=".npy", dir=dirpath)
+    os.close(fd)
+    return np.lib.format.open_memmap(filepath, mode='w+', dtype=dtype, shape=shape), filepath
+
+
+def remove_shared_samples(samples, filepath):
+    """Remove the file of an array created by `create_shared_samples`
+
+    The array remains usable, as its memory mapping outlives the file name.
+    Where files can't be removed while mapped (Windows), removal is rather
+    attempted when the array is garbage collected.
+    """
+    try:
+        os.remove(filepath)
+    except OSError:
+        weakref.finalize(samples, _remove_file, filepath)
+
+
+def _remove_file(filepath):
+    try:
+        os.remove(filepath)
+    except OSError:
+        pass
+
+
+class StreamingSampleStore():
+    """Store that writes samples to a presamples package as they are added
+
+    Appended blocks are buffered in memory until they hold about
+    `buffer_size` bytes of samples, and are then written as a new matrix
+    resource of the presamples package. Only the buffer is ever held in
+    memory. `finalize` writes the last buffered samples and the
+    `datapackage.json` file, after which the package can be used like one
+    created with `create_presamples_package`.
+
+    As in `create_presamples_package`, samples of repeated matrix cells
+    within a resource are summed. Blocks are never split across resources,
+    so that samples of a given activity are always collapsed together.
+
+    Parameters:
+    -----------
+       name: str, optional
+           A human-readable name for these samples.
+       \\id_: str, optional
+           Unique id for this collection of presamples. Generated automatically if not set.
+       overwrite: bool, default=False
+           If True, replace an existing presamples package with the same ``\\id_`` if it exists.
+       dirpath: str, optional
+           An optional directory path where presamples can be created. If None, a subdirectory in the ``project`` folder.
+       seed: {None, int, "sequential"}, optional, default="sequential"
+           Seed used by indexer to return array columns in random order.
+       buffer_size: int, default=2**27
+           Approximate size, in bytes, of samples buffered before being written
+    """
+    def __init__(self, name=None, id_=None, overwrite=False, dirpath=None,
+                 seed='sequential', buffer_size=2**27):
+        if dirpath is not None:
+            if not os.path.isdir(dirpath):
+                raise ValueError("`dirpath` must be a directory")
+            dirpath = os.path.abspath(dirpath)
+        self.id_ = id_ or uuid.uuid4().hex
+        self.name = name or self.id_
+        self.overwrite = overwrite
+        self.parent_dirpath = dirpath
+        self.seed = seed
+        self.buffer_size = buffer_size
+        self.dirpath = None
+        self.finalized = False
+        self._buffer = SampleStore()
+        self._buffered_bytes = 0
+        self._resources = []
+        self._written_rows = 0
+
+    def __len__(self):
+        return self._written_rows + len(self._buffer)
+
+    def append(self, samples, indices):
+        """Add a block of samples and associated matrix indices, see `SampleStore.append`"""
+        if self.finalized:
+            raise ValueError("Presamples package {} was already finalized".format(self.id_))
+        self._buffer.append(samples, indices)
+        self._buffered_bytes += samples.nbytes
+        if self._buffered_bytes >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        """Write buffered samples as new resources of the presamples package"""
+        if not len(self._buffer):
+            return
+        if self.dirpath is None:
+            self.dirpath = get_presample_directory(self.id_, self.overwrite, self.parent_dirpath)
+        resources = write_matrix_resources(
+            self._buffer.samples, self._buffer.id_indices, self.dirpath,
+            len(self._resources), self.id_
+        )
+        self._resources.extend(resources)
+        self._written_rows += sum(resource['samples']['shape'][0] for resource in resources)
+        self._buffer = SampleStore()
+        self._buffered_bytes = 0
+
+    def finalize(self):
+        """Write remaining samples and the datapackage file
+
+        Returns the id and directory path of the presamples package.
+        """
+        self.flush()
+        if not self._resources:
+            raise ValueError("No samples were added")
+        datapackage = {
+            "name": str(self.name),
+            "id": self.id_,
+            "profile": "data-package",
+            "seed": self.seed,
+            "resources": self._resources,
+            "ncols": self._resources[0]['samples']['shape'][1],
+        }
+        with open(self.dirpath / "datapackage.json", "w", encoding='utf-8') as f:
+            json.dump(datapackage, f, indent=2, ensure_ascii=False)
+        self.finalized = True
+        return self.id_, self.dirpath
+
+    @property
+    def samples(self):
+        """Samples written so far, read back from the package
+
+        The samples are memory-mapped, but are copied to memory when
+        concatenated: use for inspection of small packages only.
+        """
+        self.flush()
+        if not self._resources:
+            return None
+        return np.concatenate([
+            np.load(self.dirpath / resource['samples']['filepath'], mmap_mode='r')
+            for resource in self._resources
+        ], axis=0)
+
+    @property
+    def indices(self):
+        """Matrix indices written so far, read back from the package"""
+        return decode_indices(self.id_indices)
+
+    @property
+    def id_indices(self):
+        """Integer-coded matrix indices written so far, read back from the package"""
+        self.flush()
+        blocks = []
+        for resource in self._resources:
+            written = np.load(self.dirpath / resource['indices']['filepath'])
+            block = np.zeros(len(written), dtype=ID_INDICES_DTYPE)
+            block['input'], block['output'] = written['input'], written['output']
+            if resource['type'] == 'biosphere':
+                block['type'] = TYPE_DICTIONARY['biosphere']
+            else:
+                block['type'] = written['type']
+            blocks.append(block)
+        return np.concatenate(blocks) if blocks else np.zeros(0, dtype=ID_INDICES_DTYPE)
+
+
+class BlockPresamplesWriter():
+    """Writes a presamples package from blocks of iterations
+
+    The samples file of the package is preallocated on disk for all rows and
+    iterations, and each block of iterations (columns) is written to it as
+    soon as it is generated. Only one block is ever held in memory, so that
+    memory use depends on the block size and not on the number of
+    iterations. Rows must therefore be known in advance, and be in the same
+    order in all blocks.
+
+    All rows are biosphere matrix data. As in `create_presamples_package`,
+    samples of repeated matrix cells are summed.
+
+    Parameters:
+    -----------
+       indices: list or numpy structured array
+           Matrix indices, as (input key, output key, type), one per row,
+           or integer-coded matrix indices
+       iterations: int
+           Total number of iterations
+       name: str, optional
+           A human-readable name for these samples.
+       \\id_: str, optional
+           Unique id for this collection of presamples. Generated automatically if not set.
+       overwrite: bool, default=False
+           If True, replace an existing presamples package with the same ``\\id_`` if it exists.
+       dirpath: str, optional
+           An optional directory path where presamples can be created. If None, a subdirectory in the ``project`` folder.
+       seed: {None, int, "sequential"}, optional, default="sequential"
+           Seed used by indexer to return array columns in random order.
+       dtype: numpy dtype, default=numpy.float64
+           Floating point type of the samples file
+    """
+    def __init__(self, indices, iterations, name=None, id_=None, overwrite=False,
+                 dirpath=None, seed='sequential', dtype=np.float64):
+        if dirpath is not None:
+            if not os.path.isdir(dirpath):
+                raise ValueError("`dirpath` must be a directory")
+            dirpath = os.path.abspath(dirpath)
+        indices = encode_indices(indices)
+        if not len(indices):
+            raise ValueError("No samples to write")
+        if (indices['type'] != TYPE_DICTIONARY['biosphere']).any():
+            raise ValueError("Only biosphere matrix data can be written in blocks")
+        self.id_ = id_ or uuid.uuid4().hex
+        self.name = name or self.id_
+        self.seed = seed
+        self.iterations = iterations
+        self.finalized = False
+        self.dirpath = get_presample_directory(self.id_, overwrite, dirpath)
+
+        _, self._indices, self._metadata, _ = format_id_indices(
+            np.zeros((len(indices), 0)), indices)[0]
+        # Rows of repeated matrix cells are summed into the first row of their
+        # cell, as in `collapse_matrix_indices`
+        unique, first_rows, self._inverse = np.unique(
+            self._indices[['input', 'output']], return_index=True, return_inverse=True
+        )
+        self._collapse = len(unique) < len(self._indices)
+        if self._collapse:
+            self._indices = self._indices[first_rows]
+        self._samples_fp = "{}.0.samples.npy".format(self.id_)
+        self._samples = np.lib.format.open_memmap(
+            self.dirpath / self._samples_fp, mode='w+',
+            shape=(len(self._indices), iterations), dtype=dtype
+        )
+
+    def write(self, first_iteration, samples):
+        """Write a block of samples, starting at iteration `first_iteration`
+
+        Parameters:
+        -----------
+           first_iteration: int
+               Index of the first iteration (column) of the block
+           samples: numpy array
+               (rows, block iterations) array of samples, rows in the order of `indices`
+        """
+        if self.finalized:
+            raise ValueError("Presamples package {} was already finalized".format(self.id_))
+        if first_iteration + samples.shape[1] > self.iterations:
+            raise ValueError("Block exceeds the {} iterations of the package".format(self.iterations))
+        if self._collapse:
+            collapsed = np.zeros((len(self._indices), samples.shape[1]), dtype=samples.dtype)
+            np.add.at(collapsed, self._inverse.ravel(), samples)
+            samples = collapsed
+        self._samples[:, first_iteration:first_iteration + samples.shape[1]] = samples
+
+    def finalize(self):
+        """Write the indices and datapackage files
+
+        Returns the id and directory path of the presamples package.
+        """
+        self._samples.flush()
+        shape, dtype = self._samples.shape, self._samples.dtype
+        del self._samples
+        indices_fp = "{}.0.indices.npy".format(self.id_)
+        np.save(self.dirpath / indices_fp, self._indices, allow_pickle=False)
+        resource = {
+            'type': 'biosphere',
+            'samples': {
+                'filepath': self._samples_fp,
+                'md5': md5(self.dirpath / self._samples_fp),
+                'shape': list(shape),
+                'dtype': str(dtype),
+                "format": "npy",
+                "mediatype": "application/octet-stream",
+            },
+            'index': 0,
+            'indices': {
+                'filepath': indices_fp,
+                'md5': md5(self.dirpath / indices_fp),
+                "format": "npy",
+                "mediatype": "application/octet-stream",
+            },
+            "profile": "data-resource",
+        }
+        resource.update(self._metadata)
+        datapackage = {
+            "name": str(self.name),
+            "id": self.id_,
+            "profile": "data-package",
+            "seed": self.seed,
+            "resources": [resource],
+            "ncols": self.iterations,
+        }
+        with open(self.dirpath / "datapackage.json", "w", encoding='utf-8') as f:
+            json.dump(datapackage, f, indent=2, ensure_ascii=False)
+        self.finalized = True
+        return self.id_, self.dirpath
+
+
+def splice_presamples_package(dirpath, output_ids, samples=None, indices=None):
+    """Replace samples of given activities in an existing presamples package
+
+    Rows of matrix resources with an output in `output_ids` are removed,
+    one resource at a time, and `samples` are added as new resources.
+    Resources that are left without rows are deleted.
+
+    Parameters:
+    -----------
+       dirpath: str
+           Directory of the presamples package
+       output_ids: sequence of int
+           Mapped ids of activities whose samples are removed
+       samples: numpy array, optional
+           (rows, iterations) array of samples to add
+       indices: list or numpy structured array, optional
+           Matrix indices of samples to add, as (input key, output key, type),
+           or integer-coded matrix indices
+    """
+    dirpath = Path(dirpath)
+    with open(dirpath / "datapackage.json", encoding='utf-8') as f:
+        datapackage = json.load(f)
+    if samples is not None and samples.shape[1] != datapackage['ncols']:
+        raise ValueError("Expected {} iterations, got {}".format(
+            datapackage['ncols'], samples.shape[1]))
+    output_ids = np.asarray(list(output_ids), dtype=np.uint32)
+    next_index = max((resource['index'] for resource in datapackage['resources']), default=-1) + 1
+
+    resources = []
+    for resource in datapackage['resources']:
+        if 'indices' not in resource:
+            # Parameter resources
+            resources.append(resource)
+            continue
+        samples_fp = dirpath / resource['samples']['filepath']
+        indices_fp = dirpath / resource['indices']['filepath']
+        resource_indices = np.load(indices_fp)
+        keep = ~np.isin(resource_indices['output'], output_ids)
+        if keep.all():
+            resources.append(resource)
+        elif keep.any():
+            _replace_array(samples_fp, np.load(samples_fp, mmap_mode='r')[keep])
+            _replace_array(indices_fp, resource_indices[keep])
+            resource['samples']['md5'] = md5(samples_fp)
+            resource['samples']['shape'] = [int(keep.sum()), datapackage['ncols']]
+            resource['indices']['md5'] = md5(indices_fp)
+            resources.append(resource)
+        else:
+            os.remove(samples_fp)
+            os.remove(indices_fp)
+
+    if samples is not None and len(samples):
+        resources.extend(write_matrix_resources(
+            samples, encode_indices(indices), dirpath, next_index, datapackage['id']
+        ))
+
+    datapackage['resources'] = resources
+    with open(dirpath / "datapackage.json", "w", encoding='utf-8') as f:
+        json.dump(datapackage, f, indent=2, ensure_ascii=False)
+    return datapackage['id'], dirpath
+
+
+def _replace_array(filepath, array):
+    """Save array to `filepath` through a temporary file"""
+    temp_fp = "{}.tmp.npy".format(filepath)
+    np.save(temp_fp, array, allow_pickle=False)
+    os.replace(temp_fp, filepath)
@@ -1,4 +1,5 @@
 import collections
+import concurrent.futures
 import itertools
 
 class ParameterNameGenerator(object):
@@ -9,4 +10,34 @@ class ParameterNameGenerator(object):
     def __getitem__(self, key):
         """Returns a k:v in d equal to key:the number of times that key has come up.
            Used for creating parameter names"""
-        return "{}_{}".format(key, next(self.d[key]))
\ No newline at end of file
+        return "{}_{}".format(key, next(self.d[key]))
+
+def prefetch(function, items, size=16, threads=2):
+    """Yield `(item, function(item))` for all items, in order, computing results ahead in threads
+
+    Results of at most `size` items following the one being consumed are
+    computed by a pool of `threads` threads, which bounds memory use. Meant
+    for I/O bound functions, e.g. database reads, overlapped with the
+    processing of results. With `size=0`, results are computed when
+    consumed, without threads.
+    """
+    if not size:
+        for item in items:
+            yield item, function(item)
+        return
+    items = iter(items)
+    pending = collections.deque()
+    with concurrent.futures.ThreadPoolExecutor(threads) as executor:
+        try:
+            for item in itertools.islice(items, size):
+                pending.append((item, executor.submit(function, item)))
+            while pending:
+                item, future = pending.popleft()
+                result = future.result()
+                for next_item in itertools.islice(items, 1):
+                    pending.append((next_item, executor.submit(function, next_item)))
+                yield item, result
+        finally:
+            # Do not compute results that will not be consumed
+            for _, future in pending:
+                future.cancel()
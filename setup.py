@@ -22,6 +22,8 @@ setup(
         'numpy',
         'pyprind',
         'presamples',
+        'scipy',
+        'stats_arrays',
     ],
     url="https://gitlab.com/pascal.lesage/bw2landbalance",
     long_description=readme,
@@ -1,8 +1,14 @@
 import pytest
+import re
+import json
 import numpy as np
 from bw2landbalancer.database_land_balancer import DatabaseLandBalancer
 from bw2landbalancer.activity_land_balancer import ActivityLandBalancer
-from brightway2 import get_activity
+from bw2landbalancer.sample_store import SampleStore
+from bw2landbalancer.balancing_plan import BalancingPlan
+from bw2landbalancer.classification import classify_land_flows
+from bw2landbalancer.array_balancer import LAND_IN, LAND_OUT
+from brightway2 import get_activity, Database
 
 def get_matrix_data_sums_for_test(ab, matrix_data):
     """Function to check matrix data in tests
@@ -26,6 +32,16 @@ def get_matrix_data_sums_for_test(ab, matrix_data):
     out_totals = np.sum(out_filter * samples, axis=0)
     return in_totals, out_totals
 
+def get_database_sums_for_test(wb, act_code):
+    """Function to check samples stored by a DatabaseLandBalancer in tests
+
+    Returns the sums of land in and land out samples of activity `act_code`
+    """
+    rows = [i for i, idx in enumerate(wb.matrix_indices) if idx[1] == ('test_db', act_code)]
+    in_rows = [i for i in rows if wb.matrix_indices[i][0] in wb.land_in_keys]
+    out_rows = [i for i in rows if wb.matrix_indices[i][0] in wb.land_out_keys]
+    return wb.matrix_samples[in_rows].sum(axis=0), wb.matrix_samples[out_rows].sum(axis=0)
+
 def test_no_such_database(data_for_testing):
     with pytest.raises(ValueError, match="Database no such db not imported"):
         wb = DatabaseLandBalancer(database_name="no such db")
@@ -58,6 +74,45 @@ def test_identify_exchanges(data_for_testing):
     assert set(wb.all_land_keys) == set(expected_all_keys)
     assert len(wb.all_land_keys) == len(expected_all_keys)
 
+
+def test_identify_exchanges_with_rules(data_for_testing):
+    """Classify land flows with regular expressions and categories"""
+    wb = DatabaseLandBalancer(
+        database_name="test_db", biosphere="biosphere",
+        land_from_patterns=[re.compile(r"from 1$")],
+        land_categories=[('natural resource', 'land')]
+    )
+    assert wb.land_in_keys == {("biosphere", "Transformation, from 1")}
+    assert wb.land_out_keys == {("biosphere", "Transformation, to 1"), ("biosphere", "Transformation, to 2")}
+    assert wb.land_types[("biosphere", "Transformation, from 1")] == LAND_IN
+    assert wb.land_types[("biosphere", "Transformation, to 2")] == LAND_OUT
+    wb = DatabaseLandBalancer(database_name="test_db", biosphere="biosphere", land_categories=[('air',)])
+    assert not wb.all_land_keys
+
+
+def test_classify_land_flows():
+    """ """
+    flows = [
+        (('b', '1'), 'Transformation, from forest', ('natural resource', 'land')),
+        (('b', '2'), 'Transformation, to forest', ('natural resource', 'land')),
+        (('b', '3'), 'Transformation, from forest to forest', None),
+        (('b', '4'), 'Carbon dioxide', ('air',)),
+    ]
+    land_types = classify_land_flows(flows, ['Transformation, from'], ['Transformation, to', 'to forest'])
+    assert land_types == {('b', '1'): LAND_IN, ('b', '2'): LAND_OUT, ('b', '3'): LAND_IN}
+    land_types = classify_land_flows(
+        flows, ['Transformation, from'], ['Transformation, to'], categories=[('natural resource',)]
+    )
+    assert land_types == {('b', '1'): LAND_IN, ('b', '2'): LAND_OUT}
+
+    # Flags of compiled patterns are kept, also with inline global flags
+    flows.append((('b', '5'), 'TRANSFORMATION, FROM LAKE', None))
+    land_types = classify_land_flows(
+        flows, [re.compile('transformation, from', re.I), 'Transformation, from'],
+        ['(?i)unused', re.compile('(?i)transformation, to'), re.compile('to forest$')]
+    )
+    assert land_types == {('b', '1'): LAND_IN, ('b', '2'): LAND_OUT, ('b', '3'): LAND_IN, ('b', '5'): LAND_IN}
+
 def test_land_exchange_formulas_removed(data_for_testing):
     """ Make sure formulas are properly removed from exchanges"""
     act = get_activity(("test_db", "A"))
@@ -95,7 +150,7 @@ def test_reset(data_for_testing):
 def test_rebalance_default_ratio_1(data_for_testing):
     """ """
     wb = DatabaseLandBalancer(database_name="test_db", biosphere="biosphere")
-    assert wb.matrix_indices == []
+    assert len(wb.matrix_indices) == 0
     assert wb.matrix_samples is None
     ab = ActivityLandBalancer(('test_db', 'A'), wb)
     ab._identify_strategy()
@@ -261,7 +316,7 @@ def test_rebalance_skip_no_uncertainty(data_for_testing):
 def test_all_matrix_data_and_presamples(data_for_testing):
     """ """
     wb = DatabaseLandBalancer(database_name="test_db", biosphere="biosphere")
-    assert wb.matrix_indices==[]
+    assert len(wb.matrix_indices)==0
     assert wb.matrix_samples is None
     wb.add_samples_for_all_acts(5)
     assert len(wb.matrix_indices)==18
@@ -271,3 +326,933 @@ def test_all_matrix_data_and_presamples(data_for_testing):
     samples_0 = np.load(dirpath/"{}.0.samples.npy".format(id_))
     assert indices_0.shape[0] == 18
     assert samples_0.shape[1] == 5
+
+
+def test_no_such_engine(data_for_testing):
+    with pytest.raises(ValueError, match="Engine no such engine not understood"):
+        wb = DatabaseLandBalancer(database_name="test_db", biosphere="biosphere", engine="no such engine")
+
+
+@pytest.mark.parametrize("act_code, strategy, ratio", [
+    ('A', 'default', 1), ('B', 'inverse', 1), ('C', 'default', 2), ('D', 'inverse', 0.5)
+])
+def test_numpy_engine_rebalance(data_for_testing, act_code, strategy, ratio):
+    """ """
+    wb = DatabaseLandBalancer(database_name="test_db", biosphere="biosphere", engine="numpy")
+    ab = ActivityLandBalancer(('test_db', act_code), wb)
+    matrix_data = ab.generate_samples(5)
+    assert ab.strategy == strategy
+    assert ab.static_ratio == ratio
+    assert len(matrix_data) == 1
+    assert matrix_data[0][0].shape == (4, 5)
+    in_sum, out_sum = get_matrix_data_sums_for_test(ab, matrix_data)
+    if strategy == 'default':
+        assert np.allclose(in_sum/out_sum, ratio)
+    else:
+        assert np.allclose(out_sum/in_sum, ratio)
+    # Balanced samples are not all equal to the static values
+    assert not np.allclose(matrix_data[0][0], matrix_data[0][0][:, [0]])
+
+
+@pytest.mark.parametrize("act_code, input_code", [
+    ('G', 'Transformation, from 1'), ('H', 'Transformation, to 1')
+])
+def test_numpy_engine_set_static(data_for_testing, act_code, input_code):
+    """ """
+    wb = DatabaseLandBalancer(database_name="test_db", biosphere="biosphere", engine="numpy")
+    ab = ActivityLandBalancer(('test_db', act_code), wb)
+    matrix_data = ab.generate_samples(5)
+    assert ab.strategy == 'set_static'
+    assert len(matrix_data) == 1
+    assert np.allclose(np.ones(shape=(1, 5)), matrix_data[0][0])
+    assert matrix_data[0][1] == [(("biosphere", input_code), ('test_db', act_code))]
+
+
+def test_numpy_engine_database_untouched(data_for_testing):
+    """ """
+    wb = DatabaseLandBalancer(database_name="test_db", biosphere="biosphere", engine="numpy")
+    ab = ActivityLandBalancer(('test_db', 'A'), wb)
+    ab.generate_samples(5)
+    exc = [exc for exc in get_activity(("test_db", "A")).exchanges()
+           if exc.input.key == ('biosphere', 'Transformation, from 1')][0]
+    assert exc['formula'] == 'some_formula'
+    assert 'temp_formula' not in exc
+    assert 'land_formula' not in exc
+
+
+def test_numpy_engine_same_indices_as_presamples(data_for_testing):
+    """ """
+    wb_presamples = DatabaseLandBalancer(database_name="test_db", biosphere="biosphere")
+    wb_presamples.add_samples_for_all_acts(5)
+    wb_numpy = DatabaseLandBalancer(database_name="test_db", biosphere="biosphere", engine="numpy")
+    wb_numpy.add_samples_for_all_acts(5)
+    assert sorted(wb_numpy.matrix_indices.tolist()) == sorted(wb_presamples.matrix_indices.tolist())
+    assert wb_numpy.matrix_samples.shape == wb_presamples.matrix_samples.shape
+
+
+def test_batch_requires_numpy_engine(data_for_testing):
+    wb = DatabaseLandBalancer(database_name="test_db", biosphere="biosphere")
+    with pytest.raises(ValueError, match="Batch mode requires the 'numpy' engine"):
+        wb.add_samples_for_all_acts(5, batch=True)
+
+
+def test_batch_matrix_data(data_for_testing):
+    """ """
+    wb = DatabaseLandBalancer(database_name="test_db", biosphere="biosphere", engine="numpy")
+    wb.add_samples_for_all_acts(5, batch=True)
+    assert len(wb.matrix_indices) == 18
+    assert wb.matrix_samples.shape == (18, 5)
+    wb_sequential = DatabaseLandBalancer(database_name="test_db", biosphere="biosphere", engine="numpy")
+    wb_sequential.add_samples_for_all_acts(5)
+    assert sorted(wb.matrix_indices.tolist()) == sorted(wb_sequential.matrix_indices.tolist())
+    for act_code, ratio in [('A', 1), ('C', 2)]:
+        in_sum, out_sum = get_database_sums_for_test(wb, act_code)
+        assert np.allclose(in_sum/out_sum, ratio)
+    for act_code, ratio in [('B', 1), ('D', 0.5)]:
+        in_sum, out_sum = get_database_sums_for_test(wb, act_code)
+        assert np.allclose(out_sum/in_sum, ratio)
+    static_rows = [i for i, idx in enumerate(wb.matrix_indices) if idx[1] in [('test_db', 'G'), ('test_db', 'H')]]
+    assert len(static_rows) == 2
+    assert np.allclose(wb.matrix_samples[static_rows], 1)
+
+
+def test_seed_numpy_engine(data_for_testing):
+    """ """
+    samples = []
+    for seed in [42, 42, 43]:
+        wb = DatabaseLandBalancer(database_name="test_db", biosphere="biosphere", engine="numpy")
+        wb.add_samples_for_all_acts(5, seed=seed)
+        samples.append(wb.matrix_samples)
+    assert np.array_equal(samples[0], samples[1])
+    assert not np.array_equal(samples[0], samples[2])
+
+
+@pytest.mark.parametrize("engine, batch", [('numpy', False), ('numpy', True), ('presamples', False)])
+def test_multiprocess_matrix_data(data_for_testing, engine, batch):
+    """ """
+    wb = DatabaseLandBalancer(database_name="test_db", biosphere="biosphere", engine=engine)
+    wb.add_samples_for_all_acts(5, batch=batch, processes=2, seed=42)
+    assert len(wb.matrix_indices) == 18
+    assert wb.matrix_samples.shape == (18, 5)
+    for act_code, ratio in [('A', 1), ('C', 2)]:
+        in_sum, out_sum = get_database_sums_for_test(wb, act_code)
+        assert np.allclose(in_sum/out_sum, ratio)
+    if engine == 'numpy':
+        wb_again = DatabaseLandBalancer(database_name="test_db", biosphere="biosphere", engine=engine)
+        wb_again.add_samples_for_all_acts(5, batch=batch, processes=2, seed=42)
+        assert wb_again.matrix_indices.tolist() == wb.matrix_indices.tolist()
+        assert np.array_equal(wb_again.matrix_samples, wb.matrix_samples)
+
+
+def test_read_only_requires_numpy_engine(data_for_testing):
+    with pytest.raises(ValueError, match="Read-only balancing requires the 'numpy' engine"):
+        wb = DatabaseLandBalancer(database_name="test_db", biosphere="biosphere", read_only=True)
+
+
+def test_read_only(data_for_testing):
+    """ """
+    exchanges_before = {
+        act.key: [exc.as_dict() for exc in act.exchanges()]
+        for act in Database("test_db")
+    }
+    wb = DatabaseLandBalancer(database_name="test_db", biosphere="biosphere", engine="numpy", read_only=True)
+    ab = ActivityLandBalancer(('test_db', 'A'), wb)
+    assert all(isinstance(exc, dict) for exc in ab.land_exchanges)
+    ab.generate_samples(5)
+    with pytest.raises(ValueError, match="is read-only"):
+        ab._define_balancing_parameters()
+    # All write paths are guarded, not only those of the presamples engine
+    with pytest.raises(ValueError, match="is read-only"):
+        ab._save_activity()
+    with pytest.raises(ValueError, match="is read-only"):
+        ab._save_exchanges([])
+    wb.add_samples_for_all_acts(5)
+    wb.add_samples_for_all_acts(5, processes=2)
+    assert wb.matrix_samples.shape == (36, 5)
+    exchanges_after = {
+        act.key: [exc.as_dict() for exc in act.exchanges()]
+        for act in Database("test_db")
+    }
+    assert exchanges_after == exchanges_before
+
+
+def test_sample_store(data_for_testing):
+    """ """
+    from bw2data import mapping
+    x, y = ('biosphere', 'Transformation, from 1'), ('biosphere', 'Transformation, to 1')
+    a, b, c = ('test_db', 'A'), ('test_db', 'B'), ('test_db', 'C')
+    store = SampleStore()
+    assert len(store) == 0
+    assert store.samples is None
+    assert len(store.indices) == 0
+    store.append(np.ones((2, 3)), [(x, a, 'biosphere'), (y, a, 'biosphere')])
+    store.append(np.zeros((0, 3)), [])
+    store.append(np.zeros((1, 3)), [(x, b, 'biosphere')])
+    assert len(store) == 3
+    assert store.samples.shape == (3, 3)
+    # Indices are stored integer-coded, and only decoded on access
+    assert store.id_indices.tolist() == [
+        (mapping[x], mapping[a], 2), (mapping[y], mapping[a], 2), (mapping[x], mapping[b], 2)
+    ]
+    assert store.indices['output'].tolist() == [a, a, b]
+    assert store.indices.tolist()[2] == (x, b, 'biosphere')
+    # Decoded indices are kept until the next block is added
+    assert store.indices is store.indices
+    store.append(np.zeros((1, 3)), [(y, c, 'biosphere')])
+    assert store.indices['output'].tolist() == [a, a, b, c]
+    with pytest.raises(ValueError, match="Expected 3 iterations"):
+        store.append(np.ones((1, 4)), [(x, c, 'biosphere')])
+    with pytest.raises(ValueError, match="rows of samples"):
+        store.append(np.ones((2, 3)), [(x, c, 'biosphere')])
+
+
+def test_stream_presamples(data_for_testing, tmp_path):
+    """ """
+    import json
+    from presamples.utils import md5
+    wb = DatabaseLandBalancer(database_name="test_db", biosphere="biosphere", engine="numpy")
+    wb.add_samples_for_all_acts(5, seed=42)
+    id_, dirpath = wb.create_presamples(id_="in_memory", dirpath=str(tmp_path))
+
+    wb_streamed = DatabaseLandBalancer(database_name="test_db", biosphere="biosphere", engine="numpy")
+    # Tiny buffer: each activity written as its own resource
+    wb_streamed.stream_presamples(id_="streamed", dirpath=str(tmp_path), buffer_size=1)
+    wb_streamed.add_samples_for_all_acts(5, seed=42)
+    assert len(wb_streamed.matrix_indices) == 18
+    assert wb_streamed.matrix_indices.tolist() == wb.matrix_indices.tolist()
+    assert np.array_equal(wb_streamed.matrix_samples, wb.matrix_samples)
+    streamed_id, streamed_dirpath = wb_streamed.create_presamples()
+    assert streamed_id == "streamed"
+
+    def load_package(dirpath):
+        metadata = json.load(open(dirpath / "datapackage.json"))
+        indices, samples = [], []
+        for resource in metadata['resources']:
+            assert md5(dirpath / resource['samples']['filepath']) == resource['samples']['md5']
+            indices.append(np.load(dirpath / resource['indices']['filepath']))
+            samples.append(np.load(dirpath / resource['samples']['filepath']))
+        return metadata, np.concatenate(indices), np.concatenate(samples)
+
+    metadata, indices, samples = load_package(dirpath)
+    streamed_metadata, streamed_indices, streamed_samples = load_package(streamed_dirpath)
+    assert len(streamed_metadata['resources']) > 1
+    assert streamed_metadata['ncols'] == metadata['ncols'] == 5
+    assert np.array_equal(streamed_indices, indices)
+    assert np.array_equal(streamed_samples, samples)
+
+    with pytest.raises(ValueError, match="already finalized"):
+        wb_streamed.add_samples_for_act(('test_db', 'A'), 5)
+    with pytest.raises(ValueError, match="call `stream_presamples` first"):
+        wb.stream_presamples()
+
+
+def test_load_land_exchanges(data_for_testing):
+    """ """
+    wb = DatabaseLandBalancer(database_name="test_db", biosphere="biosphere", engine="numpy")
+    land_exchanges = wb.load_land_exchanges()
+    for act in Database("test_db"):
+        expected = [exc.as_dict() for exc in act.exchanges() if exc['input'] in wb.all_land_keys]
+        assert land_exchanges.get(act.key, []) == expected
+    assert list(wb.load_land_exchanges([('test_db', 'A')])) == [('test_db', 'A')]
+    assert wb.load_land_exchanges([]) == {}
+
+    ab = ActivityLandBalancer(('test_db', 'C'), wb, land_exchanges[('test_db', 'C')])
+    ab_from_db = ActivityLandBalancer(('test_db', 'C'), wb)
+    samples = ab.generate_samples(5, np.random.RandomState(1))[0][0]
+    samples_from_db = ab_from_db.generate_samples(5, np.random.RandomState(1))[0][0]
+    assert np.array_equal(samples, samples_from_db)
+
+
+def test_numpy_engine_reads_no_exchanges_per_activity(data_for_testing, monkeypatch):
+    """Exchanges of activities, with or without land exchanges, are not read one activity at a time"""
+    from bw2data.backends.peewee import Activity
+    read = []
+    exchanges = Activity.exchanges
+    monkeypatch.setattr(Activity, 'exchanges', lambda self: read.append(self.key) or exchanges(self))
+    wb = DatabaseLandBalancer(database_name="test_db", biosphere="biosphere", engine="numpy")
+    wb.add_samples_for_all_acts(5)
+    assert read == []
+
+
+def test_load_land_exchanges_in_batches(data_for_testing, monkeypatch):
+    """Exchanges of given activities are read with one query per batch of activities"""
+    from bw2data.backends.peewee import ExchangeDataset
+    import bw2landbalancer.database_land_balancer as database_land_balancer
+    wb = DatabaseLandBalancer(database_name="test_db", biosphere="biosphere", engine="numpy")
+    land_exchanges = wb.load_land_exchanges()
+    act_keys = [act.key for act in Database("test_db")]
+    monkeypatch.setattr(database_land_balancer, 'SQLITE_MAX_VARIABLES', 0)
+    queries = []
+    select = ExchangeDataset.select
+
+    def counting_select(*args, **kwargs):
+        queries.append(args)
+        return select(*args, **kwargs)
+    monkeypatch.setattr(ExchangeDataset, 'select', counting_select)
+    assert wb.load_land_exchanges(act_keys + [('other_db', 'A')]) == land_exchanges
+    assert len(queries) == len(act_keys)
+    assert wb.load_land_exchanges([('test_db', 'C'), ('test_db', 'A')]) == {
+        key: land_exchanges[key] for key in [('test_db', 'A'), ('test_db', 'C')]
+    }
+
+
+def test_processed_data_source(data_for_testing):
+    """ """
+    with pytest.raises(ValueError, match="requires the 'numpy' engine"):
+        DatabaseLandBalancer(database_name="test_db", biosphere="biosphere", data_source="processed")
+    wb = DatabaseLandBalancer(database_name="test_db", biosphere="biosphere", engine="numpy")
+    wb_processed = DatabaseLandBalancer(
+        database_name="test_db", biosphere="biosphere", engine="numpy", data_source="processed"
+    )
+    assert wb_processed._get_act_keys() == wb._get_act_keys()
+    table = wb._get_land_exchange_table()
+    table_processed = wb_processed._get_land_exchange_table()
+    assert len(table_processed) == len(table)
+    # Processed arrays store uncertainty fields in single precision
+    for field in table.dtype.names:
+        assert np.allclose(table_processed[field], table[field], equal_nan=True)
+    assert wb_processed._keys_from_ids == wb._keys_from_ids
+
+    with pytest.raises(ValueError, match="requires batch mode"):
+        wb_processed.add_samples_for_all_acts(5)
+    wb.add_samples_for_all_acts(5, batch=True, seed=42)
+    wb_processed.add_samples_for_all_acts(5, batch=True, seed=42)
+    assert wb_processed.matrix_indices.tolist() == wb.matrix_indices.tolist()
+    assert np.allclose(wb_processed.matrix_samples, wb.matrix_samples)
+
+
+def test_classification_cache(data_for_testing, monkeypatch):
+    """ """
+    import bw2landbalancer.classification as classification
+    wb = DatabaseLandBalancer(database_name="test_db", biosphere="biosphere")
+    calls = []
+    classify_land_flows = classification.classify_land_flows
+    def counting_classify_land_flows(*args, **kwargs):
+        calls.append(1)
+        return classify_land_flows(*args, **kwargs)
+    monkeypatch.setattr(classification, 'classify_land_flows', counting_classify_land_flows)
+
+    wb_cached = DatabaseLandBalancer(database_name="test_db", biosphere="biosphere")
+    assert not calls
+    assert wb_cached.land_types == wb.land_types
+    # Different patterns are not in cache
+    DatabaseLandBalancer(database_name="test_db", biosphere="biosphere", land_from_patterns=["from 1"])
+    assert len(calls) == 1
+    DatabaseLandBalancer(database_name="test_db", biosphere="biosphere", cache_classification=False)
+    assert len(calls) == 2
+    # Modifying the biosphere invalidates the cache
+    flow = get_activity(("biosphere", "Transformation, from 2"))
+    flow['name'] = 'Something else'
+    flow.save()
+    wb_modified = DatabaseLandBalancer(database_name="test_db", biosphere="biosphere")
+    assert len(calls) == 3
+    assert ("biosphere", "Transformation, from 2") not in wb_modified.land_in_keys
+
+
+def test_balancing_plan(data_for_testing, tmp_path):
+    """ """
+    wb = DatabaseLandBalancer(database_name="test_db", biosphere="biosphere", engine="numpy")
+    plan = wb.create_balancing_plan()
+    assert len(plan) == len(plan.act_keys) == len(set(plan.act_keys))
+    strategies = dict(zip(plan.act_keys, plan.strategies))
+    assert strategies[('test_db', 'A')] == 'default'
+    assert strategies[('test_db', 'B')] == 'inverse'
+    assert strategies[('test_db', 'G')] == 'set_static'
+
+    plan.save(tmp_path / "plan.npz")
+    loaded_plan = BalancingPlan.load(tmp_path / "plan.npz")
+    assert loaded_plan.keys_from_ids == plan.keys_from_ids
+    assert loaded_plan.database_name == "test_db"
+    assert np.array_equal(loaded_plan.strategies, plan.strategies)
+    assert np.array_equal(loaded_plan.static_ratios, plan.static_ratios, equal_nan=True)
+
+    wb.add_samples_for_all_acts(5, batch=True, seed=42)
+    wb_plan = DatabaseLandBalancer(database_name="test_db", biosphere="biosphere", engine="numpy")
+    wb_plan.add_samples_from_plan(loaded_plan, 5, seed=42)
+    assert wb_plan.matrix_indices.tolist() == wb.matrix_indices.tolist()
+    assert np.array_equal(wb_plan.matrix_samples, wb.matrix_samples)
+    for act_code in ['A', 'B', 'C', 'D']:
+        in_sums, out_sums = get_database_sums_for_test(wb_plan, act_code)
+        assert np.allclose(in_sums / out_sums, 1 if act_code in 'AB' else in_sums[0] / out_sums[0])
+
+    loaded_plan.database_name = "other_db"
+    with pytest.raises(ValueError, match="Plan was created for database other_db"):
+        wb_plan.add_samples_from_plan(loaded_plan, 5)
+    wb_presamples = DatabaseLandBalancer(database_name="test_db", biosphere="biosphere")
+    with pytest.raises(ValueError, match="requires the 'numpy' engine"):
+        wb_presamples.add_samples_from_plan(plan, 5)
+
+
+def test_update_presamples(data_for_testing, tmp_path):
+    """ """
+    import json
+    from presamples.utils import md5
+    from brightway2 import mapping
+
+    def load_package(dirpath):
+        metadata = json.load(open(dirpath / "datapackage.json"))
+        rows = {}
+        for resource in metadata['resources']:
+            assert md5(dirpath / resource['samples']['filepath']) == resource['samples']['md5']
+            assert md5(dirpath / resource['indices']['filepath']) == resource['indices']['md5']
+            samples = np.load(dirpath / resource['samples']['filepath'])
+            assert list(samples.shape) == list(resource['samples']['shape'])
+            for index, row in zip(np.load(dirpath / resource['indices']['filepath']), samples):
+                rows[(int(index['input']), int(index['output']))] = row
+        return rows
+
+    wb = DatabaseLandBalancer(database_name="test_db", biosphere="biosphere", engine="numpy")
+    previous_plan = wb.create_balancing_plan()
+    wb.add_samples_from_plan(previous_plan, 5, seed=1)
+    id_, dirpath = wb.create_presamples(id_="incremental", dirpath=str(tmp_path))
+    rows_before = load_package(dirpath)
+
+    # Unchanged database: nothing to do
+    _, _, changed = wb.update_presamples(dirpath, previous_plan, seed=2)
+    assert changed == []
+    assert load_package(dirpath).keys() == rows_before.keys()
+
+    # Change amount of a land exchange of C, remove land exchanges of D
+    act = get_activity(('test_db', 'C'))
+    exc = [exc for exc in act.exchanges() if exc['input'] in wb.land_out_keys][0]
+    exc['amount'] *= 2
+    exc.save()
+    for exc in get_activity(('test_db', 'D')).exchanges():
+        if exc['input'] in wb.all_land_keys:
+            exc.delete()
+    _, _, changed = wb.update_presamples(dirpath, previous_plan, seed=2)
+    assert changed == [('test_db', 'C')]
+    rows_after = load_package(dirpath)
+
+    c_id, d_id = mapping[('test_db', 'C')], mapping[('test_db', 'D')]
+    assert not any(output == d_id for _, output in rows_after)
+    for index, row in rows_before.items():
+        if index[1] not in (c_id, d_id):
+            assert np.array_equal(rows_after[index], row)
+    c_rows = [index for index in rows_after if index[1] == c_id]
+    assert sorted(c_rows) == sorted(index for index in rows_before if index[1] == c_id)
+    assert not any(np.array_equal(rows_after[index], rows_before[index]) for index in c_rows)
+
+    plan = wb.create_balancing_plan()
+    previous_plan.database_name = "other_db"
+    with pytest.raises(ValueError, match="Plan was created for database other_db"):
+        wb.update_presamples(dirpath, previous_plan, plan)
+    with pytest.raises(ValueError, match="Plan was created for database other_db"):
+        wb.update_presamples(dirpath, plan, previous_plan)
+    wb_presamples = DatabaseLandBalancer(database_name="test_db", biosphere="biosphere")
+    with pytest.raises(ValueError, match="requires the 'numpy' engine"):
+        wb_presamples.update_presamples(dirpath, plan)
+
+
+def test_draw_samples_by_uncertainty_type():
+    """ """
+    from stats_arrays import UncertaintyBase
+    from bw2landbalancer.array_balancer import draw_samples
+    params = UncertaintyBase.from_dicts(
+        {'uncertainty_type': 0, 'loc': 3},
+        {'uncertainty_type': 2, 'loc': np.log(2), 'scale': 0.2},
+        {'uncertainty_type': 2, 'loc': np.log(2), 'scale': 0.2, 'negative': True},
+        {'uncertainty_type': 3, 'loc': 1, 'scale': 0.5, 'minimum': 0.8, 'maximum': 1.5},
+        {'uncertainty_type': 4, 'minimum': 1, 'maximum': 3},
+        {'uncertainty_type': 5, 'loc': 2, 'minimum': 1, 'maximum': 4},
+        {'uncertainty_type': 2, 'loc': np.log(2), 'scale': 0.2, 'maximum': 2},
+        {'uncertainty_type': 9, 'loc': 2, 'scale': 0.5, 'shape': 2},
+    )
+    samples = draw_samples(params, 100000, np.random.RandomState(0))
+    assert samples.shape == (8, 100000)
+    assert np.all(samples[0] == 3)
+    assert np.isclose(np.median(samples[1]), 2, rtol=0.01)
+    assert np.isclose(np.std(np.log(samples[1])), 0.2, rtol=0.01)
+    assert np.isclose(np.median(samples[2]), -2, rtol=0.01)
+    assert samples[3].min() >= 0.8 and samples[3].max() <= 1.5
+    assert np.isclose(samples[4].mean(), 2, rtol=0.01)
+    assert samples[4].min() >= 1 and samples[4].max() <= 3
+    assert np.isclose(samples[5].mean(), 7 / 3, rtol=0.01)
+    assert samples[5].min() >= 1 and samples[5].max() <= 4
+    assert samples[6].max() <= 2 and np.isclose(np.median(samples[6]), 2 * np.exp(0.2 * -0.6745), rtol=0.01)
+    assert np.isclose(samples[7].mean(), 1 + 2, rtol=0.02)
+
+    assert np.array_equal(
+        draw_samples(params, 10, np.random.RandomState(1)),
+        draw_samples(params, 10, np.random.RandomState(1))
+    )
+
+
+def test_per_activity_seeding(data_for_testing):
+    """Samples only depend on the master seed and the activity"""
+    def rows(wb):
+        return {tuple(index): row for index, row in zip(wb.matrix_indices.tolist(), wb.matrix_samples)}
+
+    runs = []
+    for kwargs in [{}, {'batch': True}, {'processes': 2}, {'batch': True, 'processes': 3}]:
+        wb = DatabaseLandBalancer(database_name="test_db", biosphere="biosphere", engine="numpy")
+        wb.add_samples_for_all_acts(5, seed=7, **kwargs)
+        runs.append(rows(wb))
+    wb = DatabaseLandBalancer(database_name="test_db", biosphere="biosphere", engine="numpy")
+    for act_key in sorted(wb._get_act_keys(), reverse=True):
+        wb.add_samples_for_act(act_key, 5, seed=7)
+    runs.append(rows(wb))
+
+    for run in runs[1:]:
+        assert run.keys() == runs[0].keys()
+        for index, row in run.items():
+            assert np.array_equal(row, runs[0][index])
+
+    wb = DatabaseLandBalancer(database_name="test_db", biosphere="biosphere", engine="numpy")
+    wb.add_samples_for_all_acts(5, seed=8)
+    assert any(not np.array_equal(row, runs[0][index]) for index, row in rows(wb).items())
+
+
+def test_create_presamples_in_blocks(data_for_testing, tmp_path):
+    """Samples generated in blocks of iterations are those generated at once"""
+    import json
+    from presamples.utils import md5
+    wb = DatabaseLandBalancer(database_name="test_db", biosphere="biosphere", engine="numpy")
+    wb.add_samples_for_all_acts(7, batch=True, seed=42)
+    _, dirpath = wb.create_presamples(id_="at_once", dirpath=str(tmp_path))
+
+    wb_blocks = DatabaseLandBalancer(database_name="test_db", biosphere="biosphere", engine="numpy")
+    _, blocks_dirpath = wb_blocks.create_presamples_in_blocks(
+        7, block_size=3, seed=42, id_="in_blocks", dirpath=str(tmp_path)
+    )
+
+    metadata = json.load(open(dirpath / "datapackage.json"))
+    blocks_metadata = json.load(open(blocks_dirpath / "datapackage.json"))
+    assert blocks_metadata['ncols'] == 7
+    resource = metadata['resources'][0]
+    blocks_resource = blocks_metadata['resources'][0]
+    assert md5(blocks_dirpath / blocks_resource['samples']['filepath']) == blocks_resource['samples']['md5']
+    assert blocks_resource['samples']['shape'] == [18, 7]
+    assert np.array_equal(
+        np.load(blocks_dirpath / blocks_resource['indices']['filepath']),
+        np.load(dirpath / resource['indices']['filepath'])
+    )
+    assert np.array_equal(
+        np.load(blocks_dirpath / blocks_resource['samples']['filepath']),
+        np.load(dirpath / resource['samples']['filepath'])
+    )
+
+    wb_presamples = DatabaseLandBalancer(database_name="test_db", biosphere="biosphere")
+    with pytest.raises(ValueError, match="requires the 'numpy' engine"):
+        wb_presamples.create_presamples_in_blocks(7)
+
+
+@pytest.mark.parametrize('engine, batch', [('presamples', False), ('numpy', False), ('numpy', True)])
+def test_float32_samples(data_for_testing, tmp_path, engine, batch):
+    """Samples can be stored and written in single precision"""
+    import json
+    wb = DatabaseLandBalancer(
+        database_name="test_db", biosphere="biosphere", engine=engine, dtype=np.float32
+    )
+    wb.add_samples_for_all_acts(10, batch=batch, seed=1)
+    assert wb.matrix_samples.dtype == np.float32
+    assert len(wb.matrix_indices) == 18
+    _, dirpath = wb.create_presamples(id_="float32", dirpath=str(tmp_path))
+    metadata = json.load(open(dirpath / "datapackage.json"))
+    for resource in metadata['resources']:
+        assert resource['samples']['dtype'] == 'float32'
+        assert np.load(dirpath / resource['samples']['filepath']).dtype == np.float32
+
+    # Ratios are conserved within single precision
+    samples = dict(zip(
+        [(index[0][1], index[1][1]) for index in wb.matrix_indices.tolist()], wb.matrix_samples
+    ))
+    in_sum = samples[('Transformation, from 1', 'A')] + samples[('Transformation, from 2', 'A')]
+    out_sum = samples[('Transformation, to 1', 'A')] + samples[('Transformation, to 2', 'A')]
+    assert np.allclose(in_sum.astype(np.float64) / out_sum, 1, rtol=1e-6)
+
+
+def test_float32_ratio_tolerance(data_for_testing):
+    with pytest.raises(ValueError, match="not a floating point type"):
+        DatabaseLandBalancer(database_name="test_db", biosphere="biosphere", dtype=int)
+    wb = DatabaseLandBalancer(
+        database_name="test_db", biosphere="biosphere", engine="numpy",
+        dtype=np.float16, ratio_tolerance=1e-9
+    )
+    with pytest.raises(ValueError, match="above the tolerance"):
+        wb.add_samples_for_all_acts(10, batch=True)
+
+
+def test_timing_report_and_callback(data_for_testing):
+    """Stages are timed per strategy and events are sent to the callback"""
+    events = []
+    wb = DatabaseLandBalancer(database_name="test_db", biosphere="biosphere", callback=events.append)
+    assert [event['message'] for event in events if event['event'] == 'message'] == [
+        "Validating data", "Getting information on land transformation exchanges"
+    ]
+    wb.add_samples_for_all_acts(5)
+    report = wb.timing_report
+    for stage in ['recalculate', 'pbm_load', 'calculate_stochastic', 'calculate_matrix_presamples']:
+        assert report.stages[stage]['calls'] == 6
+        assert report.stages[stage]['seconds'] > 0
+    assert report.strategies['default']['calculate_stochastic']['calls'] == 2
+    assert 'calculate_stochastic' not in report.strategies['skip']
+    # Skipped activities with land exchanges are also restored
+    assert report.stages['restore']['calls'] == 9
+    assert report.strategies['skip']['restore']['calls'] == 3
+    progress = [event['done'] for event in events if event['event'] == 'progress']
+    assert progress == list(range(len(wb._get_act_keys()) + 1))
+    stages = [event for event in events if event['event'] == 'stage']
+    assert sum(event['stage'] == 'restore' for event in stages) == 9
+    assert report.as_dict()['stages']['restore']['calls'] == 9
+    assert 'calculate_stochastic' in str(report)
+
+    # Timings of worker processes are merged
+    wb = DatabaseLandBalancer(database_name="test_db", biosphere="biosphere", engine="numpy",
+                              callback=events.append)
+    wb.add_samples_for_all_acts(5, processes=2)
+    assert wb.timing_report.stages['draw']['calls'] == 4
+    assert wb.timing_report.strategies['default']['draw']['calls'] == 2
+
+
+def _samples_by_index(wb):
+    return {tuple(idx): row for idx, row in zip(wb.matrix_indices.tolist(), wb.matrix_samples)}
+
+
+def test_checkpoint_resume(data_for_testing, tmp_path, monkeypatch):
+    """Interrupted runs resume from checkpoints with the same samples"""
+    reference = DatabaseLandBalancer(database_name="test_db", biosphere="biosphere", engine="numpy")
+    reference.add_samples_for_all_acts(5, seed=42)
+
+    add_samples_for_act = DatabaseLandBalancer.add_samples_for_act
+    calls = []
+
+    def interrupted(self, *args, **kwargs):
+        calls.append(args[0])
+        if len(calls) == 5:
+            raise KeyboardInterrupt
+        return add_samples_for_act(self, *args, **kwargs)
+
+    monkeypatch.setattr(DatabaseLandBalancer, 'add_samples_for_act', interrupted)
+    wb = DatabaseLandBalancer(database_name="test_db", biosphere="biosphere", engine="numpy")
+    with pytest.raises(KeyboardInterrupt):
+        wb.add_samples_for_all_acts(5, checkpoint_dir=tmp_path, checkpoint_size=2)
+    monkeypatch.undo()
+    assert len(list(tmp_path.glob("checkpoint.*.npz"))) == 2
+
+    resumed_acts = []
+    monkeypatch.setattr(
+        DatabaseLandBalancer, 'add_samples_for_act',
+        lambda self, *args, **kwargs: resumed_acts.append(args[0]) or add_samples_for_act(self, *args, **kwargs)
+    )
+    wb = DatabaseLandBalancer(database_name="test_db", biosphere="biosphere", engine="numpy")
+    wb.add_samples_for_all_acts(5, checkpoint_dir=tmp_path, checkpoint_size=2)
+    assert set(resumed_acts).isdisjoint(calls[:4])
+    assert len(resumed_acts) + 4 == len(wb._get_act_keys())
+    monkeypatch.undo()
+
+    # Seed of the interrupted run is reused
+    with open(tmp_path / "run.json") as f:
+        seed = json.load(f)['seed']
+    reference = DatabaseLandBalancer(database_name="test_db", biosphere="biosphere", engine="numpy")
+    reference.add_samples_for_all_acts(5, seed=seed)
+    expected = _samples_by_index(reference)
+    resumed = _samples_by_index(wb)
+    assert resumed.keys() == expected.keys()
+    assert all(np.array_equal(resumed[key], expected[key]) for key in expected)
+
+    with pytest.raises(ValueError, match="different run"):
+        wb.add_samples_for_all_acts(6, checkpoint_dir=tmp_path)
+
+
+@pytest.mark.parametrize('batch,processes', [(False, None), (True, None), (False, 2), (True, 2)])
+def test_checkpoint_reads_land_exchanges_once(data_for_testing, tmp_path, monkeypatch, batch, processes):
+    """Land exchanges are read once per run, not once per checkpointed chunk"""
+    reference = DatabaseLandBalancer(database_name="test_db", biosphere="biosphere", engine="numpy")
+    reference.add_samples_for_all_acts(5, seed=42)
+
+    load_land_exchanges = DatabaseLandBalancer.load_land_exchanges
+    calls = []
+
+    def counting_load_land_exchanges(self, *args, **kwargs):
+        calls.append(args)
+        return load_land_exchanges(self, *args, **kwargs)
+    monkeypatch.setattr(DatabaseLandBalancer, 'load_land_exchanges', counting_load_land_exchanges)
+    wb = DatabaseLandBalancer(database_name="test_db", biosphere="biosphere", engine="numpy")
+    wb.add_samples_for_all_acts(
+        5, batch=batch, processes=processes, seed=42, checkpoint_dir=tmp_path, checkpoint_size=2)
+    assert len(calls) == 1
+    expected = _samples_by_index(reference)
+    samples = _samples_by_index(wb)
+    assert samples.keys() == expected.keys()
+    assert all(np.array_equal(samples[key], expected[key]) for key in expected)
+
+
+def test_repair_activities(data_for_testing, tmp_path, monkeypatch):
+    """Activities left half-processed by an interrupted run are repaired"""
+    from presamples.models.parameterized import ParameterizedBrightwayModel as PBM
+    from bw2data.parameters import ActivityParameter
+    from brightway2 import parameters
+    # User group named like the balancing group, which repairs leave alone
+    parameters.new_activity_parameters(
+        [{'name': 'yield_factor', 'amount': 2, 'database': 'test_db', 'code': 'B'}], 'land_2')
+    before = {
+        act.key: (act.get('parameters'), [dict(exc.as_dict()) for exc in act.exchanges()])
+        for act in Database("test_db")
+    }
+
+    def interrupted(self, *args, **kwargs):
+        raise KeyboardInterrupt
+    monkeypatch.setattr(PBM, 'calculate_stochastic', interrupted)
+    # As if the process was killed, so that activities are not restored
+    monkeypatch.setattr(ActivityLandBalancer, '_restore_exchange_formulas', interrupted)
+    wb = DatabaseLandBalancer(database_name="test_db", biosphere="biosphere")
+    with pytest.raises(KeyboardInterrupt):
+        wb.add_samples_for_all_acts(5, checkpoint_dir=tmp_path, checkpoint_size=2)
+    monkeypatch.undo()
+
+    repaired = wb.repair_activities()
+    assert repaired
+    assert wb.repair_activities() == []
+    assert not ActivityParameter.select().where(ActivityParameter.group == wb.group).exists()
+    assert ActivityParameter.get(ActivityParameter.group == 'land_2').name == 'yield_factor'
+    for act in Database("test_db"):
+        parameters, exchanges = before[act.key]
+        assert 'parameters_temp' not in act
+        assert act.get('parameters') == parameters
+        after = [dict(exc.as_dict()) for exc in act.exchanges()]
+        for exc in after:
+            exc.pop('land_formula', None)
+        assert after == exchanges
+
+    wb.add_samples_for_all_acts(5, checkpoint_dir=tmp_path, checkpoint_size=2)
+    assert wb.matrix_samples.shape == (18, 5)
+
+
+def test_presamples_engine_restores_database(data_for_testing):
+    """Bulk writes leave exchanges as before balancing, with land formulas"""
+    from bw2data.parameters import ParameterizedExchange
+    before = {act.key: [dict(exc.as_dict()) for exc in act.exchanges()] for act in Database("test_db")}
+    for _ in range(2):
+        wb = DatabaseLandBalancer(database_name="test_db", biosphere="biosphere")
+        wb.add_samples_for_all_acts(5)
+        assert wb.matrix_samples.shape == (18, 5)
+        assert not ParameterizedExchange.select().exists()
+        for act in Database("test_db"):
+            after = [dict(exc.as_dict()) for exc in act.exchanges()]
+            land_formulas = [exc.pop('land_formula', None) for exc in after]
+            assert after == before[act.key]
+            if act['code'] == 'A':
+                assert all(formula is not None for formula, exc in zip(land_formulas, after)
+                           if exc['input'] in wb.all_land_keys)
+
+
+def test_presamples_engine_write_lock(data_for_testing, monkeypatch):
+    """Writes before evaluation share a transaction, evaluation runs without the write lock"""
+    from bw2data.backends.peewee import sqlite3_lci_db
+    from presamples.models.parameterized import ParameterizedBrightwayModel as PBM
+    commits = []
+    commit = sqlite3_lci_db.db.commit
+    monkeypatch.setattr(sqlite3_lci_db.db, 'commit', lambda: commits.append(1) or commit())
+    in_transaction = []
+    calculate_stochastic = PBM.calculate_stochastic
+
+    def checking_calculate_stochastic(self, *args, **kwargs):
+        in_transaction.append(sqlite3_lci_db.db.in_transaction())
+        return calculate_stochastic(self, *args, **kwargs)
+    monkeypatch.setattr(PBM, 'calculate_stochastic', checking_calculate_stochastic)
+    wb = DatabaseLandBalancer(database_name="test_db", biosphere="biosphere")
+    wb.add_samples_for_all_acts(5)
+    assert in_transaction and not any(in_transaction)
+    monkeypatch.undo()
+
+    # Moving formulas, writing parameters and restoring, no parameters for skipped activities
+    strategies = wb.create_balancing_plan().strategies
+    skipped = (strategies == 'skip').sum()
+    assert len(commits) == 3 * (len(strategies) - skipped) + 2 * skipped
+
+
+def test_parameter_workspace(data_for_testing):
+    """Balancing parameters never reach the project's parameter tables"""
+    from bw2data import parameters
+    from bw2data.parameters import ActivityParameter, Group, ProjectParameter
+    from bw2landbalancer.parameter_workspace import parameter_workspace
+    parameters.new_project_parameters([{'name': 'project_param', 'amount': 2}])
+    parameters.new_activity_parameters(
+        [{'name': 'user_param', 'formula': 'project_param * 2', 'database': 'test_db', 'code': 'B'}],
+        'user_group'
+    )
+    with parameter_workspace():
+        assert not ProjectParameter.select().exists()
+        assert not Group.select().exists()
+        parameters.new_activity_parameters(
+            [{'name': 'scratch', 'amount': 1, 'database': 'test_db', 'code': 'A'}], 'scratch_group'
+        )
+        assert ActivityParameter.select().count() == 1
+    assert [g.name for g in Group.select().order_by(Group.name)] == ['project', 'user_group']
+    assert ActivityParameter.get(name='user_param').amount == 4
+
+    wb = DatabaseLandBalancer(database_name="test_db", biosphere="biosphere")
+    wb.add_samples_for_all_acts(5)
+    assert wb.matrix_samples.shape == (18, 5)
+    assert [g.name for g in Group.select().order_by(Group.name)] == ['project', 'user_group']
+    assert ActivityParameter.select().count() == 1
+    assert ProjectParameter.get(name='project_param').amount == 2
+
+
+def test_presamples_engine_restores_database_on_error(data_for_testing, monkeypatch):
+    """Activities are restored if balancing fails"""
+    from presamples.models.parameterized import ParameterizedBrightwayModel as PBM
+    act = get_activity(('test_db', 'A'))
+    act['parameters'] = {'user_param': {'amount': 3}}
+    act.save()
+    before = [dict(exc.as_dict()) for exc in act.exchanges()]
+
+    def failing(self, *args, **kwargs):
+        raise RuntimeError("Balancing failed")
+    monkeypatch.setattr(PBM, 'calculate_stochastic', failing)
+    wb = DatabaseLandBalancer(database_name="test_db", biosphere="biosphere")
+    with pytest.raises(RuntimeError, match="Balancing failed"):
+        wb.add_samples_for_act(('test_db', 'A'), 5)
+    act = get_activity(('test_db', 'A'))
+    assert 'parameters_temp' not in act
+    assert act['parameters'] == {'user_param': {'amount': 3}}
+    after = [dict(exc.as_dict()) for exc in act.exchanges()]
+    for exc in after:
+        exc.pop('land_formula', None)
+    assert after == before
+    assert wb.repair_activities() == []
+
+
+def _balance_database(args):
+    project, database_name = args
+    from brightway2 import projects
+    projects.set_current(project)
+    wb = DatabaseLandBalancer(database_name=database_name, biosphere="biosphere")
+    wb.add_samples_for_all_acts(5)
+    return wb.matrix_samples.shape
+
+
+def test_concurrent_databases(data_for_testing):
+    """Several databases of a project can be balanced at the same time"""
+    import multiprocessing
+    from brightway2 import projects
+    Database("test_db").copy("test_db_copy")
+    before = {
+        act.key: [dict(exc.as_dict()) for exc in act.exchanges()]
+        for name in ("test_db", "test_db_copy") for act in Database(name)
+    }
+    with multiprocessing.Pool(2) as pool:
+        shapes = pool.map(_balance_database, [(projects.current, "test_db"), (projects.current, "test_db_copy")])
+    assert shapes == [(18, 5), (18, 5)]
+    for name in ("test_db", "test_db_copy"):
+        for act in Database(name):
+            after = [dict(exc.as_dict()) for exc in act.exchanges()]
+            for exc in after:
+                exc.pop('land_formula', None)
+            assert after == before[act.key]
+
+
+def test_prefetch():
+    """Results are yielded in order, with a bounded number computed ahead"""
+    import threading
+    from bw2landbalancer.utils import prefetch
+    lock = threading.Lock()
+    computed = []
+
+    def compute(item):
+        with lock:
+            computed.append(item)
+        return item * 2
+
+    for size in [0, 1, 3, 20]:
+        computed.clear()
+        results = prefetch(compute, range(10), size=size)
+        assert next(results) == (0, 0)
+        # Results are computed for the consumed item and at most `size` following items
+        assert len(computed) <= 1 + size
+        assert list(results) == [(i, i * 2) for i in range(1, 10)]
+        assert sorted(computed) == list(range(10))
+
+    computed.clear()
+    results = prefetch(compute, range(100), size=2)
+    next(results)
+    results.close()
+    assert len(computed) <= 3
+
+
+@pytest.mark.parametrize('engine', ['numpy', 'presamples'])
+def test_prefetch_same_samples(data_for_testing, engine):
+    """Prefetching activities does not change samples"""
+    results = []
+    for size in [0, 4]:
+        wb = DatabaseLandBalancer(database_name="test_db", biosphere="biosphere", engine=engine, prefetch=size)
+        wb.add_samples_for_all_acts(5, seed=42)
+        results.append(wb)
+    assert results[0].matrix_indices.tolist() == results[1].matrix_indices.tolist()
+    if engine == 'numpy':
+        assert np.array_equal(results[0].matrix_samples, results[1].matrix_samples)
+    else:
+        assert results[1].matrix_samples.shape == (18, 5)
+
+
+@pytest.mark.parametrize('engine, batch', [('numpy', False), ('numpy', True), ('presamples', False)])
+def test_shared_samples(data_for_testing, tmp_path, engine, batch):
+    """Workers write samples into a shared memory-mapped array, at rows assigned up front"""
+    import os
+    from brightway2 import projects
+    from bw2landbalancer.sample_store import SHARED_SAMPLES_DIRECTORY
+    wb = DatabaseLandBalancer(database_name="test_db", biosphere="biosphere", engine=engine)
+    wb.add_samples_for_all_acts(5, batch=batch, processes=2, seed=42)
+    samples = wb.matrix_samples
+    assert isinstance(samples, np.memmap)
+    assert not os.path.exists(samples.filename)
+    # Created on disk in the project directory, not in the system temporary directory
+    assert os.path.dirname(samples.filename) == os.path.join(projects.dir, SHARED_SAMPLES_DIRECTORY)
+    plan = wb.create_balancing_plan()
+    assert samples.shape == (plan.row_counts().sum(), 5)
+    if engine == 'numpy':
+        sequential = DatabaseLandBalancer(database_name="test_db", biosphere="biosphere", engine=engine)
+        sequential.add_samples_for_all_acts(5, batch=batch, seed=42)
+        assert wb.matrix_indices.tolist() == sequential.matrix_indices.tolist()
+        assert np.array_equal(samples, sequential.matrix_samples)
+
+    # Also with checkpoints, written from the shared array
+    checkpointed = DatabaseLandBalancer(database_name="test_db", biosphere="biosphere", engine=engine)
+    checkpointed.add_samples_for_all_acts(5, batch=batch, processes=2, seed=42,
+                                          checkpoint_dir=tmp_path, checkpoint_size=3)
+    assert checkpointed.matrix_samples.shape == samples.shape
+    assert os.path.dirname(checkpointed.matrix_samples.filename) == str(tmp_path)
+    resumed = DatabaseLandBalancer(database_name="test_db", biosphere="biosphere", engine=engine)
+    resumed.add_samples_for_all_acts(5, batch=batch, processes=2, seed=42, checkpoint_dir=tmp_path)
+    assert resumed.matrix_indices.tolist() == checkpointed.matrix_indices.tolist()
+    assert np.array_equal(resumed.matrix_samples, checkpointed.matrix_samples)
+
+    samples_dir = tmp_path / "samples"
+    wb = DatabaseLandBalancer(database_name="test_db", biosphere="biosphere", engine=engine)
+    wb.add_samples_for_all_acts(5, batch=batch, processes=2, seed=42, samples_dir=str(samples_dir))
+    assert os.path.dirname(wb.matrix_samples.filename) == str(samples_dir)
+    assert os.listdir(samples_dir) == []
+
+
+def test_preallocated_sample_store(data_for_testing):
+    from bw2landbalancer.sample_store import PreallocatedSampleStore
+    rows = np.zeros((5, 3))
+    store = PreallocatedSampleStore(rows[1:4])
+    indices = [(('biosphere', 'Transformation, from 1'), ('test_db', 'A'), 'biosphere')] * 2
+    store.append(np.ones((2, 3)), indices)
+    assert len(store) == 2
+    assert np.array_equal(rows[:, 0], [0, 1, 1, 0, 0])
+    assert store.indices.tolist() == indices
+    with pytest.raises(ValueError, match="preallocated"):
+        store.append(np.ones((2, 3)), indices)
+    with pytest.raises(ValueError, match="iterations"):
+        store.append(np.ones((1, 4)), indices[:1])
+
+
+def test_shared_samples_written_without_copy(data_for_testing, tmp_path, monkeypatch):
+    """Memory-mapped samples of worker processes are written to presamples in blocks of rows"""
+    from bw2landbalancer import sample_store
+    from bw2landbalancer.sample_store import format_id_indices, save_samples
+    wb = DatabaseLandBalancer(database_name="test_db", biosphere="biosphere", engine="numpy")
+    wb.add_samples_for_all_acts(5, processes=2, seed=42)
+    samples = wb.matrix_samples
+    assert format_id_indices(samples, wb._store.id_indices)[0][0] is samples
+
+    save_samples(tmp_path / "samples.npy", samples, block_size=samples[:3].nbytes)
+    assert np.array_equal(np.load(tmp_path / "samples.npy"), samples)
+
+    monkeypatch.setattr(sample_store, 'WRITE_BLOCK_SIZE', samples[:2].nbytes)
+    id_, dirpath = wb.create_presamples(dirpath=str(tmp_path))
+    resource = json.load(open(dirpath / "datapackage.json"))['resources'][0]
+    assert np.array_equal(np.load(dirpath / resource['samples']['filepath']), samples)